@@ -0,0 +1,259 @@
+"""Module for archiving raw responses in compressed, deduplicated segments."""
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Configuration variables
+segmentSize = 64*1024*1024
+compressionLevel = 6
+
+
+def _compress(raw, codec):
+    """Compress a byte string with the given codec."""
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=compressionLevel).compress(raw)
+    else:
+        return zlib.compress(raw, compressionLevel)
+
+
+def _decompress(raw, codec):
+    """Decompress a byte string with the given codec."""
+    if codec == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(raw)
+    else:
+        return zlib.decompress(raw)
+
+
+class Archive(object):
+
+    """Content-addressed store of raw payloads.
+
+    Payloads are keyed by their SHA-1, compressed once and appended to
+    segment files, so byte-identical payloads fetched on different runs take
+    space only once. An SQLite index maps (name, slug, lookback, fetch time)
+    entries to blobs and blobs to their location in a segment. Writers in
+    other processes are serialized with an flock on the archive's lock file.
+    """
+
+    def __init__(self, path, codec=None):
+        """Open (creating if needed) the archive stored under path."""
+        if codec is None:
+            codec = 'zstd' if zstandard is not None else 'zlib'
+        if codec == 'zstd' and zstandard is None:
+            raise ValueError("The zstandard package is not installed.")
+        self.path = path
+        self.codec = codec
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._lock = threading.Lock()
+        self._index = sqlite3.connect(
+            os.path.join(path, 'index.sqlite'), check_same_thread=False)
+        self._index.execute("""CREATE TABLE IF NOT EXISTS blob (
+            digest TEXT PRIMARY KEY,
+            segment INTEGER,
+            position INTEGER,
+            length INTEGER,
+            size INTEGER,
+            codec TEXT)""")
+        self._index.execute("""CREATE TABLE IF NOT EXISTS entry (
+            name TEXT,
+            slug TEXT,
+            lookback INTEGER,
+            fetch_time INTEGER,
+            digest TEXT)""")
+        self._index.execute("""CREATE INDEX IF NOT EXISTS entry_key
+            ON entry (name, slug, lookback, fetch_time)""")
+        self._index.commit()
+
+    def _segmentPath(self, segment):
+        """Path of a segment file."""
+        return os.path.join(self.path, "segment_{0}.dat".format(
+            str(segment).zfill(6)))
+
+    @contextmanager
+    def _writeLock(self):
+        """Hold the archive's thread and process write locks."""
+        with self._lock:
+            f = open(os.path.join(self.path, 'lock'), 'a')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                yield
+            finally:
+                f.close()
+
+    def _append(self, data):
+        """Append data to the newest segment, returning (segment, offset)."""
+        row = self._index.execute(
+            """SELECT MAX(segment) FROM blob""").fetchone()
+        segment = row[0] if row[0] is not None else 1
+        path = self._segmentPath(segment)
+        if os.path.exists(path) and os.path.getsize(path) >= segmentSize:
+            segment += 1
+            path = self._segmentPath(segment)
+        f = open(path, 'ab')
+        try:
+            f.seek(0, os.SEEK_END)
+            offset = f.tell()
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        return segment, offset
+
+    def put(self, content, name, slug=None, lookback=None, fetchTime=None):
+        """Archive content under the given key and return its digest."""
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+        if fetchTime is None:
+            fetchTime = int(time.time())
+        digest = hashlib.sha1(content).hexdigest()
+        with self._writeLock():
+            row = self._index.execute(
+                """SELECT 1 FROM blob WHERE digest = ?""",
+                (digest,)).fetchone()
+            if row is None:
+                data = _compress(content, self.codec)
+                segment, offset = self._append(data)
+                self._index.execute(
+                    """INSERT INTO blob VALUES (?, ?, ?, ?, ?, ?)""",
+                    (digest, segment, offset, len(data), len(content),
+                        self.codec))
+            self._index.execute(
+                """INSERT INTO entry VALUES (?, ?, ?, ?, ?)""",
+                (name, slug, lookback, fetchTime, digest))
+            self._index.commit()
+        return digest
+
+    def get(self, digest):
+        """Return the content stored under digest as unicode."""
+        with self._lock:
+            row = self._index.execute(
+                """SELECT segment, position, length, codec
+                FROM blob WHERE digest = ?""", (digest,)).fetchone()
+        if row is None:
+            raise KeyError("No blob with digest '{0}'".format(digest))
+        segment, offset, length, codec = row
+        f = open(self._segmentPath(segment), 'rb')
+        try:
+            f.seek(offset)
+            data = f.read(length)
+        finally:
+            f.close()
+        return _decompress(data, codec).decode('utf-8')
+
+    def lookup(self, name, slug=None, lookback=None, fetchTime=None):
+        """Return the digest of the latest entry fetched at or before
+        fetchTime (or the latest overall), or None."""
+        query = """SELECT digest FROM entry
+            WHERE name = ? AND slug IS ? AND lookback IS ?"""
+        params = [name, slug, lookback]
+        if fetchTime is not None:
+            query += """ AND fetch_time <= ?"""
+            params.append(fetchTime)
+        query += """ ORDER BY fetch_time DESC, rowid DESC LIMIT 1"""
+        with self._lock:
+            row = self._index.execute(query, params).fetchone()
+        return row[0] if row is not None else None
+
+    def read(self, name, slug=None, lookback=None, fetchTime=None):
+        """Return the content of the entry found by lookup, or None."""
+        digest = self.lookup(name, slug, lookback, fetchTime)
+        return self.get(digest) if digest is not None else None
+
+    def entries(self, name=None):
+        """Return (name, slug, lookback, fetchTime, digest) tuples ordered
+        by fetch time."""
+        query = """SELECT name, slug, lookback, fetch_time, digest
+            FROM entry"""
+        params = []
+        if name is not None:
+            query += """ WHERE name = ?"""
+            params.append(name)
+        query += """ ORDER BY fetch_time, rowid"""
+        with self._lock:
+            return self._index.execute(query, params).fetchall()
+
+    def close(self):
+        """Close the index."""
+        with self._lock:
+            self._index.close()
+
+
+class ArchiveTest(unittest.TestCase):
+
+    """Testing suite for archive module."""
+
+    def setUp(self):
+        """Create an empty archive directory."""
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Remove the archive directory."""
+        shutil.rmtree(self.path)
+
+    def testPutGet(self):
+        """Test put, get, lookup and deduplication."""
+        store = Archive(self.path, codec='zlib')
+        payload = u'{"price_usd_data": [[1406855058000.0, 0.00344855]]}'*100
+        first = store.put(payload, 'marketcap', 'navajo', 7, fetchTime=100)
+        second = store.put(payload, 'marketcap', 'navajo', 7, fetchTime=200)
+        self.assertEqual(first, second)
+        self.assertEqual(store.get(first), payload)
+
+        # Identical payloads are stored (and compressed) only once
+        self.assertEqual(
+            os.path.getsize(store._segmentPath(1)) < len(payload), True)
+        sizeBefore = os.path.getsize(store._segmentPath(1))
+        store.put(payload, 'marketcap', 'navajo', 30, fetchTime=300)
+        self.assertEqual(os.path.getsize(store._segmentPath(1)), sizeBefore)
+        self.assertEqual(len(store.entries()), 3)
+
+        # Lookup by key and fetch time
+        changed = store.put(
+            payload + u' ', 'marketcap', 'navajo', 7, fetchTime=400)
+        self.assertEqual(store.lookup('marketcap', 'navajo', 7), changed)
+        self.assertEqual(
+            store.lookup('marketcap', 'navajo', 7, fetchTime=399), first)
+        self.assertEqual(
+            store.lookup('marketcap', 'navajo', 7, fetchTime=99), None)
+        self.assertEqual(store.read('marketcap', 'bitcoin', 7), None)
+
+        # Entries survive reopening
+        store.close()
+        store = Archive(self.path, codec='zlib')
+        self.assertEqual(store.read('marketcap', 'navajo', 30), payload)
+        store.close()
+
+    def testSegmentRollover(self):
+        """Test that full segments are closed and new ones started."""
+        global segmentSize
+        segmentSizeOriginal = segmentSize
+        segmentSize = 10
+        try:
+            store = Archive(self.path, codec='zlib')
+            digests = [store.put(str(i)*100, 'currencylist', fetchTime=i)
+                       for i in range(3)]
+            self.assertEqual(
+                os.path.exists(store._segmentPath(3)), True)
+            for i, digest in enumerate(digests):
+                self.assertEqual(store.get(digest), str(i)*100)
+            store.close()
+        finally:
+            segmentSize = segmentSizeOriginal
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,123 @@
+"""Benchmarks of the read API in query.py against the configured DB, and
+of the memory taken by parsed rows."""
+import coinmarketcap
+from datetime import timedelta
+import logging
+import os
+import pg
+import query
+import sys
+import time
+
+# Configuration variables
+currencyCounts = [1, 10, 450]
+rangeDays = 365
+points = 500
+repeat = 5
+
+
+def _time(function, *args, **kwargs):
+    """Return the median seconds and the last result of repeated calls."""
+    timings = []
+    for i in range(repeat):
+        started = time.time()
+        result = function(*args, **kwargs)
+        timings.append(time.time() - started)
+    return sorted(timings)[len(timings)/2], result
+
+
+def benchmarkQueries():
+    """Time selectMarketCaps for each currency count and downsampling mode.
+
+    Currencies are the ones with the most recent data, and the range is
+    the rangeDays up to the latest point stored.
+    """
+    cur = pg.cursor()
+    table, condition = pg.marketCapSource(max(query.lookbacks))
+    cur.execute("""
+        SELECT currency, MAX(time)
+        FROM {0}
+        WHERE TRUE {1}
+        GROUP BY currency
+        ORDER BY 2 DESC, 1
+        LIMIT %s""".format(table, condition), (max(currencyCounts),))
+    rows = cur.fetchall()
+    cur.execute("""COMMIT""")
+    if len(rows) == 0:
+        raise Exception("No market cap data to benchmark against.")
+    end = rows[0][1]
+    start = end - timedelta(days=rangeDays)
+    modes = [('full', {}),
+             ('server', {'points': points}),
+             ('lttb', {'points': points, 'downsample': 'lttb'})]
+    for count in currencyCounts:
+        currencies = [row[0] for row in rows[:count]]
+        for mode, options in modes:
+            seconds, result = _time(
+                query.selectMarketCaps, currencies, start, end, **options)
+            logging.info(
+                "{0} currencies, {1}: {2:.1f} ms for {3} points.".format(
+                    len(currencies), mode, seconds*1000,
+                    sum(len(series['time']) for series in result.values())))
+
+
+def _deepSize(obj, seen):
+    """Return the bytes taken by obj and the objects it holds, counting
+    objects already seen once."""
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deepSize(key, seen) + _deepSize(value, seen)
+                    for key, value in obj.iteritems())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(_deepSize(value, seen) for value in obj)
+    return size
+
+
+def benchmarkRowMemory():
+    """Log the memory per million points of the example payload parsed as
+    dicts, compact rows and (with NumPy) columns."""
+    f = open("{0}/example/marketcap_navajo_7d.json".format(
+        os.path.dirname(os.path.abspath(__file__))), 'r')
+    jsonDump = f.read()
+    f.close()
+    parses = [
+        ('dicts', lambda: coinmarketcap.parseMarketCap(jsonDump, 9)),
+        ('compact rows',
+         lambda: coinmarketcap.parseMarketCap(jsonDump, 9, compact=True)),
+        ('write-behind tuples',
+         lambda: pg._marketCapRows(coinmarketcap.parseMarketCap(
+             jsonDump, 9, compact=True))[1])]
+    if coinmarketcap.numpy is not None:
+        parses.append(('columns', lambda: coinmarketcap.parseMarketCapColumns(
+            jsonDump, 9)))
+    for name, parse in parses:
+        seconds, result = _time(parse)
+        size = _deepSize(result, set())
+        points = len(result['time']) if isinstance(result, dict) else len(
+            result)
+        logging.info(
+            "Parsed as {0}: {1:.0f} MB per million points, {2:.1f} s per "
+            "million points.".format(
+                name, size*1e6/points/2**20, seconds*1e6/points))
+
+
+def main():
+    """Run the query benchmarks, optionally for the currency counts given,
+    or the row memory benchmark ("python bench.py rows")."""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s:%(message)s',
+        datefmt='%m/%d/%Y %I:%M:%S %p')
+    if sys.argv[1:] == ['rows']:
+        benchmarkRowMemory()
+        return
+    if len(sys.argv) > 1:
+        currencyCounts[:] = [int(arg) for arg in sys.argv[1:]]
+    benchmarkQueries()
+
+
+if __name__ == "__main__":
+    main()
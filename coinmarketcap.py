@@ -1,39 +1,312 @@
 """ Module for requesting data from coinmarketcap.org and parsing it. """
+from array import array
+import BaseHTTPServer
+import calendar
 import codecs
+import collections
 from datetime import datetime
 from datetime import time
 from decimal import Decimal
+import email.utils
+from io import BytesIO
+import gzip
 import json
 import logging
+import lxml.etree
 import lxml.html
 import requests
 import os
-from random import random
+import random
+import ratelimit
+import re
+import shelve
+from StringIO import StringIO
 import sys
+import threading
 import time
 import unittest
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 baseUrl = "http://coinmarketcap.com"
 countRequested = 0
-interReqTime = 1
-lastReqTime = None
+
+# Request pacing: sustained requests per second, burst size, and an optional
+# state file through which processes on one host share the same budget
+requestRate = 1.0
+requestBurst = 1
+rateLimitFile = None
+rateLimiter = None
+requestLock = threading.Lock()
+
+# Adaptive pacing: starting from requestRate, the rate and the number of
+# requests in flight grow while responses are fast and successful and back
+# off on 429/5xx responses or rising latency (see ratelimit.AdaptiveRate).
+# Throttled requests are retried up to maxRetries times after a jittered,
+# exponentially growing delay, or Retry-After if longer
+adaptivePacing = True
+minRequestRate = 0.1
+maxRequestRate = 10.0
+maxInFlight = 16
+maxRetries = 5
+retryBaseSeconds = 1.0
+retryMaxSeconds = 120.0
+pacer = None
+
+# HTTP session: size of the keep-alive connection pool and an optional shelve
+# file in which ETag/Last-Modified validators persist between runs
+poolConnections = 1
+poolMaxSize = 16
+validatorCacheFile = None
+session = None
+validatorCache = None
+stats = {'notModified': 0, 'bytesSaved': 0, 'throttled': 0, 'retried': 0}
+
+# Streaming parse: characters read per chunk and the tokens it matches
+streamChunkSize = 64*1024
+_keyPattern = re.compile(r'[\s,{]*"([^"]*)"\s*:\s*')
+_pairPattern = re.compile(
+    r'[\s,]*\[\s*(-?[\d.eE+-]+)\s*,\s*(-?[\d.eE+-]+|null)\s*\]\s*,?')
+_scalarPattern = re.compile(r'(-?[\d.eE+-]+|null|"[^"]*")\s*')
+_arrayEndPattern = re.compile(r'[\s,]*\]')
+_objectEndPattern = re.compile(r'\s*}\s*$')
+
+# Compact rows: parsed points as tuples, with times in epoch seconds
+marketCapSeries = ['market_cap_by_available_supply',
+                   'market_cap_by_total_supply', 'price_btc', 'price_usd']
+
+
+class MarketCapRow(collections.namedtuple('MarketCapRow', [
+        'currency', 'time'] + marketCapSeries + [
+        'est_available_supply', 'est_total_supply'])):
+
+    """Market cap point, as parsed with compact set."""
+
+    __slots__ = ()
+
+
+class VolumeRow(collections.namedtuple('VolumeRow', [
+        'currency', 'time', 'volume'])):
+
+    """Volume point, as parsed with compact set."""
+
+    __slots__ = ()
+
+
+# Precompiled XPath expressions for rows of the currency list
+_currencyNameXPath = lxml.etree.XPath('string((td[2]//a)[1])')
+_currencyHrefXPath = lxml.etree.XPath('(td[2]//a)[1]/@href')
+_currencySymbolXPath = lxml.etree.XPath('string(td[3])')
+_currencyExplorerXPath = lxml.etree.XPath('(td[6]//a)[1]/@href')
+
+
+class ValidatorCache(object):
+
+    """Cache of ETag/Last-Modified validators and bodies per URL."""
+
+    def __init__(self, path=None):
+        """Keep validators in memory, or in a shelve file if path is set."""
+        self._lock = threading.Lock()
+        if path is None:
+            self._store = {}
+        else:
+            self._store = shelve.open(path)
+
+    def get(self, url):
+        """Return (etag, lastModified, body) for url, or None."""
+        with self._lock:
+            return self._store.get(str(url))
+
+    def set(self, url, etag, lastModified, body):
+        """Remember the validators and body of a response."""
+        with self._lock:
+            self._store[str(url)] = (etag, lastModified, body)
+
+    def close(self):
+        """Flush the cache to disk if it is persistent."""
+        with self._lock:
+            if hasattr(self._store, 'close'):
+                self._store.close()
+
+
+def _getRateLimiter():
+    """Return the shared rate limiter, building it from the config."""
+    global rateLimiter
+    with requestLock:
+        if rateLimiter is None:
+            rateLimiter = ratelimit.TokenBucket(
+                requestRate, requestBurst, path=rateLimitFile)
+        return rateLimiter
+
+
+def _getPacer():
+    """Return the adaptive pacer of the shared rate limiter, building it
+    from the config, or None if pacing is fixed."""
+    global pacer
+    limiter = _getRateLimiter()
+    with requestLock:
+        if adaptivePacing and (pacer is None or pacer.bucket is not limiter):
+            pacer = ratelimit.AdaptiveRate(
+                limiter, minRequestRate, maxRequestRate, maxInFlight)
+        return pacer if adaptivePacing else None
+
+
+class ThrottledError(Exception):
+
+    """Server pushed back on a request with a 429 or 5xx response."""
+
+    def __init__(self, statusCode, retryAfter=None):
+        """Record the status code and Retry-After seconds, if any."""
+        Exception.__init__(
+            self, "Request throttled with status code {0}.".format(
+                statusCode))
+        self.statusCode = statusCode
+        self.retryAfter = retryAfter
+
+
+def _retryAfter(value):
+    """Return the seconds to wait given by a Retry-After header, or None."""
+    if value is None:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(email.utils.mktime_tz(parsed) - time.time(), 0.0)
+
+
+def _getSession():
+    """Return the shared keep-alive session, building it from the config."""
+    global session
+    global validatorCache
+    with requestLock:
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=poolConnections, pool_maxsize=poolMaxSize)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers['Accept-Encoding'] = 'gzip, deflate'
+            validatorCache = ValidatorCache(validatorCacheFile)
+        return session
+
+
+def closeSession():
+    """Close pooled connections and flush the validator cache."""
+    global session
+    global validatorCache
+    with requestLock:
+        if session is not None:
+            session.close()
+            validatorCache.close()
+            session = None
+            validatorCache = None
+
+
+def fetchStats():
+    """Return connection reuse, 304 and byte savings counts for this run."""
+    result = {'connectionsOpened': 0, 'connectionsReused': 0}
+    with requestLock:
+        result.update(stats)
+        if session is not None:
+            for adapter in set(session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for pool in [pools.get(key) for key in pools.keys()]:
+                    if pool is None:
+                        continue
+                    result['connectionsOpened'] += pool.num_connections
+                    result['connectionsReused'] += (
+                        pool.num_requests - pool.num_connections)
+    return result
+
+
+def _addStats(**counts):
+    """Add to the fetch statistics."""
+    with requestLock:
+        for key, count in counts.iteritems():
+            stats[key] += count
 
 
 def _request(payloadString):
-    """Private method for requesting an arbitrary query string."""
+    """Private method for requesting an arbitrary query string, retrying
+    throttled requests."""
+    for attempt in range(maxRetries + 1):
+        try:
+            return _requestOnce(payloadString)
+        except ThrottledError as e:
+            if attempt == maxRetries:
+                raise
+            # Full jitter, so throttled workers don't retry in lockstep
+            wait = max(random.uniform(0, min(
+                retryBaseSeconds*2**attempt, retryMaxSeconds)),
+                e.retryAfter or 0)
+            logging.info("{0} Retrying in {1:.1f} seconds.".format(e, wait))
+            _addStats(retried=1)
+            time.sleep(wait)
+
+
+def _requestOnce(payloadString):
+    """Request a query string once, pacing it and reporting the outcome
+    to the pacer."""
     global countRequested
-    global lastReqTime
-    if lastReqTime is not None and time.time() - lastReqTime < interReqTime:
-        timeToSleep = random()*(interReqTime-time.time()+lastReqTime)*2
-        logging.info("Sleeping for {0} seconds before request.".format(
-            timeToSleep))
-        time.sleep(timeToSleep)
+    requestPacer = _getPacer()
+    if requestPacer is not None:
+        timeSlept = requestPacer.acquire()
+    else:
+        timeSlept = _getRateLimiter().acquire()
+    if timeSlept > 0:
+        logging.info("Slept for {0} seconds before request.".format(
+            timeSlept))
+    with requestLock:
+        countRequested += 1
     logging.info("Issuing request for the following payload: {0}".format(
         payloadString))
-    r = requests.get("{0}/{1}".format(baseUrl, payloadString))
-    lastReqTime = time.time()
-    countRequested += 1
-    if r.status_code == requests.codes.ok:
+    url = "{0}/{1}".format(baseUrl, payloadString)
+    httpSession = _getSession()
+    headers = {}
+    cached = validatorCache.get(url)
+    if cached is not None:
+        etag, lastModified, body = cached
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        if lastModified is not None:
+            headers['If-Modified-Since'] = lastModified
+    started = time.time()
+    try:
+        r = httpSession.get(url, headers=headers)
+    except Exception:
+        if requestPacer is not None:
+            requestPacer.release()
+        raise
+    throttled = (r.status_code == requests.codes.too_many_requests or
+                 r.status_code >= 500)
+    retryAfter = _retryAfter(r.headers.get('Retry-After'))
+    if requestPacer is not None:
+        if throttled:
+            requestPacer.release(throttled=True, retryAfter=retryAfter)
+        elif r.status_code in (requests.codes.ok, requests.codes.not_modified):
+            requestPacer.release(latency=time.time() - started)
+        else:
+            requestPacer.release()
+    if throttled:
+        _addStats(throttled=1)
+        raise ThrottledError(r.status_code, retryAfter)
+    if r.status_code == requests.codes.not_modified and cached is not None:
+        _addStats(notModified=1, bytesSaved=len(body.encode('utf-8')))
+        return body
+    elif r.status_code == requests.codes.ok:
+        if ('gzip' in r.headers.get('Content-Encoding', '') and
+                'Content-Length' in r.headers):
+            _addStats(bytesSaved=max(
+                0, len(r.content) - int(r.headers['Content-Length'])))
+        etag = r.headers.get('ETag')
+        lastModified = r.headers.get('Last-Modified')
+        if etag is not None or lastModified is not None:
+            validatorCache.set(url, etag, lastModified, r.text)
         return r.text
     else:
         raise Exception("Could not process request. \
@@ -59,41 +332,73 @@ def requestMarketCap(currencySlug, numDays):
             currencySlug, numDays))
 
 
-def parseCurrencyListAll(html):
-    """Parse the information returned by requestCurrencyList for view 'all'."""
-    data = []
+def iterCurrencyListAll(html):
+    """Incrementally parse the information returned by requestCurrencyList
+    for view 'all', yielding each currency as soon as its row is parsed.
 
-    docRoot = lxml.html.fromstring(html)
-    currencyRows = docRoot.cssselect(
-        "table#currencies-all > tbody > tr")
+    html may be the page or a file-like object returning its bytes.
+    """
+    if isinstance(html, unicode):
+        html = html.encode('utf-8')
+    if isinstance(html, str):
+        html = BytesIO(html)
 
-    for currencyRow in currencyRows:
+    for event, row in lxml.etree.iterparse(
+            html, events=('end',), tag='tr', html=True, encoding='utf-8'):
+        body = row.getparent()
+        table = body.getparent() if body is not None else None
+        if (body is None or body.tag != 'tbody' or table is None or
+                table.tag != 'table' or
+                table.get('id') != 'currencies-all'):
+            continue
         datum = {}
-        currencyFields = currencyRow.cssselect("td")
 
         # Name and slug
-        nameField = currencyFields[1].cssselect("a")[0]
-        datum['name'] = nameField.text_content().strip()
-        datum['slug'] = nameField.attrib['href'].replace(
+        datum['name'] = _currencyNameXPath(row).strip()
+        datum['slug'] = _currencyHrefXPath(row)[0].replace(
             '/currencies/', '').replace('/', '').strip()
 
         # Symbol
-        datum['symbol'] = currencyFields[2].text_content().strip()
+        datum['symbol'] = _currencySymbolXPath(row).strip()
 
         # Explorer link
-        supplyFieldPossible = currencyFields[5].cssselect("a")
+        supplyFieldPossible = _currencyExplorerXPath(row)
         if len(supplyFieldPossible) > 0:
-            datum['explorer_link'] = supplyFieldPossible[0].attrib['href']
+            datum['explorer_link'] = supplyFieldPossible[0]
         else:
             datum['explorer_link'] = ''
 
-        data.append(datum)
+        # Free rows that have been parsed
+        row.clear()
+        while row.getprevious() is not None:
+            del body[0]
 
-    return data
+        yield datum
 
 
-def parseMarketCap(jsonDump, currency, includeVolume=False):
-    """Parse the supply and price information returned by requestMarketCap."""
+def parseCurrencyListAll(html):
+    """Parse the information returned by requestCurrencyList for view 'all'."""
+    return list(iterCurrencyListAll(html))
+
+
+def _compactRow(currency, time, values):
+    """Return a MarketCapRow from a dict of series values at time."""
+    availableCap, totalCap, priceBtc, priceUsd = [
+        values.get(field) for field in marketCapSeries]
+    estAvailable = estTotal = None
+    if availableCap is not None and priceUsd is not None:
+        estAvailable = float(availableCap / priceUsd)
+    if totalCap is not None and priceUsd is not None:
+        estTotal = float(totalCap / priceUsd)
+    return MarketCapRow(currency, time, availableCap, totalCap, priceBtc,
+                        priceUsd, estAvailable, estTotal)
+
+
+def parseMarketCap(jsonDump, currency, includeVolume=False, compact=False):
+    """Parse the supply and price information returned by requestMarketCap.
+
+    Rows are dicts, or MarketCapRow and VolumeRow tuples if compact is set.
+    """
     data = []
     rawData = json.loads(jsonDump)
 
@@ -114,6 +419,16 @@ def parseMarketCap(jsonDump, currency, includeVolume=False):
                     targetFields, [None]*len(targetFields)))
             dataIntermediate[time][targetField] = row[1]
 
+    # Compact rows are built straight from the series values
+    if compact:
+        data = [_compactRow(currency, rowTime, dataIntermediate[rowTime])
+                for rowTime in sorted(dataIntermediate.keys())]
+        if not includeVolume:
+            return data
+        return data, [
+            VolumeRow(currency, int(vdr[0]/1000), vdr[1])
+            for vdr in sorted(rawData['volume_data'], key=lambda x: x[0])]
+
     # Generate derived data & alter format
     times = sorted(dataIntermediate.keys())
     for time in times:
@@ -133,7 +448,7 @@ def parseMarketCap(jsonDump, currency, includeVolume=False):
             datum['est_total_supply'] = float(
                 datum['market_cap_by_total_supply'] / datum['price_usd'])
         else:
-            datum['est_available_supply'] = None
+            datum['est_total_supply'] = None
 
         data.append(datum)
 
@@ -153,6 +468,230 @@ def parseMarketCap(jsonDump, currency, includeVolume=False):
         return data, volData
 
 
+def parseMarketCapColumns(jsonDump, currency, includeVolume=False):
+    """Parse the information returned by requestMarketCap into columns.
+
+    Returns a dict holding the currency, a 'time' array of epoch seconds and
+    a float array per metric (NaN where parseMarketCap gives None), with the
+    same rows and values as parseMarketCap. Requires NumPy.
+    """
+    if numpy is None:
+        raise ImportError("NumPy is required for columnar parsing.")
+    rawData = json.loads(jsonDump)
+
+    # Convert each series to a (time, value) array and align them on the
+    # union of their timestamps
+    series = {}
+    for field, fieldData in rawData.iteritems():
+        if field == 'x_min' or field == 'x_max' or field == 'volume_data':
+            continue
+        fieldData = numpy.array(fieldData, dtype=float).reshape(-1, 2)
+        series[str(field.replace('_data', ''))] = (
+            (fieldData[:, 0]/1000).astype(numpy.int64), fieldData[:, 1])
+    times = numpy.unique(numpy.concatenate(
+        [seriesTimes for seriesTimes, values in series.values()] +
+        [numpy.array([], dtype=numpy.int64)]))
+    data = {'currency': currency, 'time': times}
+    for field, (seriesTimes, values) in series.iteritems():
+        column = numpy.full(len(times), numpy.nan)
+        column[numpy.searchsorted(times, seriesTimes)] = values
+        data[field] = column
+
+    # Generate derived data, leaving NaN wherever an input is missing
+    price = data['price_usd'].copy()
+    price[price == 0] = numpy.nan
+    with numpy.errstate(invalid='ignore'):
+        data['est_available_supply'] = (
+            data['market_cap_by_available_supply']/price)
+        data['est_total_supply'] = data['market_cap_by_total_supply']/price
+
+    # Section for handling volume data if specified (has different time scale!)
+    if not includeVolume:
+        return data
+    else:
+        volDataRaw = numpy.array(
+            rawData['volume_data'], dtype=float).reshape(-1, 2)
+        volDataRaw = volDataRaw[numpy.argsort(
+            volDataRaw[:, 0], kind='mergesort')]
+        volData = {
+            'currency': currency,
+            'time': (volDataRaw[:, 0]/1000).astype(numpy.int64),
+            'volume': volDataRaw[:, 1]
+        }
+        return data, volData
+
+
+def _number(token):
+    """Convert a JSON number token the way json.loads would."""
+    if token == 'null':
+        return None
+    elif '.' in token or 'e' in token or 'E' in token:
+        return float(token)
+    else:
+        return int(token)
+
+
+def _iterSeries(source, chunkSize):
+    """Yield (field, pair) events for the arrays of [x, y] pairs in a flat
+    JSON object, reading source in chunks. An array's start is signalled
+    with a pair of None and scalar members are skipped."""
+    read = StringIO(source).read if isinstance(source, basestring) \
+        else source.read
+    buf = ''
+    pos = 0
+    eof = False
+    field = None
+    while True:
+        # A match touching the end of the buffer may be cut short
+        match = None
+        if field is None:
+            match = _keyPattern.match(buf, pos)
+            if match is not None and (match.end() < len(buf) or eof):
+                if match.end() < len(buf) and buf[match.end()] == '[':
+                    field = match.group(1)
+                    pos = match.end() + 1
+                    yield field, None
+                    continue
+                match = _scalarPattern.match(buf, match.end())
+                if match is not None and (match.end() < len(buf) or eof):
+                    pos = match.end()
+                    continue
+            elif eof and _objectEndPattern.match(buf, pos):
+                return
+        else:
+            match = _arrayEndPattern.match(buf, pos)
+            if match is not None:
+                field = None
+                pos = match.end()
+                continue
+            match = _pairPattern.match(buf, pos)
+            if match is not None:
+                pos = match.end()
+                yield field, (_number(match.group(1)),
+                              _number(match.group(2)))
+                continue
+        if eof:
+            raise ValueError(
+                "Could not parse market cap JSON at: {0}".format(
+                    buf[pos:pos + 50]))
+        chunk = read(chunkSize)
+        eof = len(chunk) == 0
+        buf = buf[pos:] + chunk
+        pos = 0
+
+
+def _readSeries(source, chunkSize):
+    """Read every series of a market cap payload into compact arrays of raw
+    x values and y values (NaN for null)."""
+    series = {}
+    for field, pair in _iterSeries(source, chunkSize):
+        if pair is None:
+            series[str(field.replace('_data', ''))] = (
+                array('d'), array('d'))
+            continue
+        xs, ys = series[str(field.replace('_data', ''))]
+        xs.append(pair[0])
+        ys.append(float('nan') if pair[1] is None else pair[1])
+    return series
+
+
+def _epoch(since):
+    """Return a datetime (or None) as epoch seconds."""
+    return calendar.timegm(since.utctimetuple()) if since is not None else None
+
+
+def _iterMergedRows(series, currency, since=None, compact=False):
+    """Yield the merged rows of market cap series in time order, after
+    since if given, as MarketCapRow tuples if compact is set."""
+    targetFields = series.keys()
+    xsAll = [series[field][0] for field in targetFields]
+    ysAll = [series[field][1] for field in targetFields]
+
+    # Series normally share their timestamps, in which case rows are merged
+    # by position; otherwise fall back to a per-series lookup by time
+    times = [int(x/1000) for x in xsAll[0]] if len(xsAll) > 0 else []
+    aligned = (all(xs == xsAll[0] for xs in xsAll) and
+               all(a < b for a, b in zip(times, times[1:])))
+    if not aligned:
+        lookups = [dict((int(x/1000), y) for x, y in zip(xs, ys))
+                   for xs, ys in zip(xsAll, ysAll)]
+        times = set()
+        for lookup in lookups:
+            times.update(lookup.iterkeys())
+        times = sorted(times)
+
+    since = _epoch(since)
+    for i, rowTime in enumerate(times):
+        if since is not None and rowTime <= since:
+            continue
+        datum = {}
+        for j, field in enumerate(targetFields):
+            value = ysAll[j][i] if aligned else lookups[j].get(rowTime)
+            datum[field] = None if value is None or value != value else value
+        if compact:
+            yield _compactRow(currency, rowTime, datum)
+            continue
+        datum['currency'] = currency
+        datum['time'] = datetime.utcfromtimestamp(rowTime)
+
+        if (datum['market_cap_by_available_supply'] is not None and
+                datum['price_usd'] is not None):
+            datum['est_available_supply'] = float(
+                datum['market_cap_by_available_supply'] / datum['price_usd'])
+        else:
+            datum['est_available_supply'] = None
+
+        if (datum['market_cap_by_total_supply'] is not None and
+                datum['price_usd'] is not None):
+            datum['est_total_supply'] = float(
+                datum['market_cap_by_total_supply'] / datum['price_usd'])
+        else:
+            datum['est_total_supply'] = None
+
+        yield datum
+
+
+def _iterVolumeRows(volume, currency, since=None, compact=False):
+    """Yield volume rows in time order, after since if given, as VolumeRow
+    tuples if compact is set."""
+    xs, ys = volume
+    since = _epoch(since)
+    for i in sorted(range(len(xs)), key=xs.__getitem__):
+        if since is not None and int(xs[i]/1000) <= since:
+            continue
+        if compact:
+            yield VolumeRow(currency, int(xs[i]/1000),
+                            None if ys[i] != ys[i] else ys[i])
+            continue
+        yield {
+            'currency': currency,
+            'time': datetime.utcfromtimestamp(int(xs[i]/1000)),
+            'volume': None if ys[i] != ys[i] else ys[i]
+        }
+
+
+def streamMarketCap(source, currency, includeVolume=False,
+                    chunkSize=None, since=None, compact=False):
+    """Incrementally parse the information returned by requestMarketCap.
+
+    source may be the payload or a file-like object. Rather than loading the
+    whole document, the series are read chunk by chunk into compact arrays
+    and the same rows as parseMarketCap are yielded by a generator (two
+    generators, for rows and volume rows, if includeVolume is set). If
+    since is given, only rows after that time are built and yielded. Rows
+    are MarketCapRow and VolumeRow tuples if compact is set.
+    """
+    series = _readSeries(source, chunkSize or streamChunkSize)
+    series.pop('x_min', None)
+    series.pop('x_max', None)
+    volume = series.pop('volume', (array('d'), array('d')))
+    if not includeVolume:
+        return _iterMergedRows(series, currency, since, compact)
+    else:
+        return (_iterMergedRows(series, currency, since, compact),
+                _iterVolumeRows(volume, currency, since, compact))
+
+
 class CoinmarketcapTest(unittest.TestCase):
 
     """"Testing suite for coinmarketcap module."""
@@ -201,6 +740,121 @@ class CoinmarketcapTest(unittest.TestCase):
         ])
         self.assertEqual(set(data.keys()), headingsExpected)
 
+    def testRequestConditional(self):
+        """Test connection reuse, gzip and conditional GETs in _request."""
+        body = json.dumps({'price_usd_data': [[1406855058000.0, 0.1]]})*50
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                if self.headers.get('If-None-Match') == '"v1"':
+                    self.send_response(304)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                buf = StringIO()
+                gz = gzip.GzipFile(fileobj=buf, mode='wb')
+                gz.write(body)
+                gz.close()
+                self.send_response(200)
+                self.send_header('ETag', '"v1"')
+                self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(buf.getvalue())))
+                self.end_headers()
+                self.wfile.write(buf.getvalue())
+
+            def log_message(self, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        # Swap configuration to point at the local server
+        global baseUrl
+        global rateLimiter
+        global stats
+        original = baseUrl, rateLimiter, stats
+        baseUrl = "http://127.0.0.1:{0}".format(server.server_port)
+        rateLimiter = ratelimit.TokenBucket(1000, burst=10)
+        stats = {'notModified': 0, 'bytesSaved': 0, 'throttled': 0,
+                 'retried': 0}
+
+        closeSession()
+        try:
+            self.assertEqual(_request("datapoints.json"), body)
+            self.assertEqual(_request("datapoints.json"), body)
+            result = fetchStats()
+            self.assertEqual(result['connectionsOpened'], 1)
+            self.assertEqual(result['connectionsReused'], 1)
+            self.assertEqual(result['notModified'], 1)
+            self.assertEqual(result['bytesSaved'] > len(body), True)
+        finally:
+            closeSession()
+            server.shutdown()
+            server.server_close()
+            baseUrl, rateLimiter, stats = original
+
+    def testRequestThrottled(self):
+        """Test that throttled requests are retried and slow pacing down."""
+        responses = [(429, '1'), (503, None), (200, None)]
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                status, retryAfter = responses.pop(0)
+                self.send_response(status)
+                if retryAfter is not None:
+                    self.send_header('Retry-After', retryAfter)
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write('{}')
+
+            def log_message(self, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        # Swap configuration to point at the local server
+        global baseUrl
+        global rateLimiter
+        global stats
+        global retryBaseSeconds
+        global maxRetries
+        original = baseUrl, rateLimiter, stats, retryBaseSeconds, maxRetries
+        baseUrl = "http://127.0.0.1:{0}".format(server.server_port)
+        rateLimiter = ratelimit.TokenBucket(5, burst=10)
+        stats = {'notModified': 0, 'bytesSaved': 0, 'throttled': 0,
+                 'retried': 0}
+        retryBaseSeconds = 0.01
+
+        closeSession()
+        try:
+            started = time.time()
+            self.assertEqual(_request("datapoints.json"), '{}')
+            # The Retry-After of the 429 was waited for
+            self.assertEqual(time.time() - started >= 1, True)
+            self.assertEqual(stats['throttled'], 2)
+            self.assertEqual(stats['retried'], 2)
+            self.assertEqual(rateLimiter.rate < 5, True)
+
+            # Requests still throttled after maxRetries fail
+            maxRetries = 0
+            responses.append((429, None))
+            self.assertRaises(ThrottledError, _request, "datapoints.json")
+        finally:
+            closeSession()
+            server.shutdown()
+            server.server_close()
+            (baseUrl, rateLimiter, stats, retryBaseSeconds,
+             maxRetries) = original
+
     def testParseCurrencyListAll(self):
         """Test parseCurrencyListAll."""
         f = codecs.open("{0}/example/currencylist.html".format(
@@ -224,6 +878,14 @@ class CoinmarketcapTest(unittest.TestCase):
         }
         self.assertEqual(data[-1], expectedLast)
 
+        # The generator yields the same rows, and accepts a file
+        f = open("{0}/example/currencylist.html".format(
+            os.path.dirname(os.path.abspath(__file__))), 'rb')
+        rows = iterCurrencyListAll(f)
+        self.assertEqual(rows.next(), expectedFirst)
+        self.assertEqual([expectedFirst] + list(rows), data)
+        f.close()
+
     def testParseMarketCap(self):
         """Test parseMarketCap."""
         f = open("{0}/example/marketcap_navajo_7d.json".format(
@@ -272,5 +934,122 @@ class CoinmarketcapTest(unittest.TestCase):
             'volume': 477.609
         }
 
+    def testParseMarketCapColumns(self):
+        """Test that parseMarketCapColumns matches parseMarketCap."""
+        f = open("{0}/example/marketcap_navajo_7d.json".format(
+            os.path.dirname(os.path.abspath(__file__))), 'r')
+        jsonDump = f.read()
+        f.close()
+
+        data, volData = parseMarketCap(
+            jsonDump, 'navajo', includeVolume=True)
+        columns, volColumns = parseMarketCapColumns(
+            jsonDump, 'navajo', includeVolume=True)
+        self.assertEqual(columns['currency'], 'navajo')
+        self.assertEqual(len(columns['time']), len(data))
+        for i, datum in enumerate(data):
+            for field, value in datum.iteritems():
+                if field == 'currency':
+                    continue
+                elif field == 'time':
+                    self.assertEqual(datetime.utcfromtimestamp(
+                        columns['time'][i]), value)
+                else:
+                    self.assertEqual(columns[field][i], value)
+        self.assertEqual(len(volColumns['time']), len(volData))
+        for i, datum in enumerate(volData):
+            self.assertEqual(datetime.utcfromtimestamp(
+                volColumns['time'][i]), datum['time'])
+            self.assertEqual(volColumns['volume'][i], datum['volume'])
+
+        # Missing inputs give NaN rather than failing
+        columns = parseMarketCapColumns(json.dumps({
+            'market_cap_by_available_supply_data': [[2000.0, 10.0]],
+            'market_cap_by_total_supply_data': [[1000.0, 10.0]],
+            'price_usd_data': [[1000.0, 2.0], [2000.0, 0.0]],
+            'price_btc_data': [],
+            'volume_data': [],
+            'x_min': 1000.0,
+            'x_max': 2000.0
+        }), 'navajo')
+        self.assertEqual(list(columns['time']), [1, 2])
+        self.assertEqual(columns['est_total_supply'][0], 5.0)
+        self.assertEqual(numpy.isnan(columns['est_available_supply']).all(),
+                         True)
+        self.assertEqual(numpy.isnan(columns['price_btc']).all(), True)
+
+    def testStreamMarketCap(self):
+        """Test that streamMarketCap matches parseMarketCap."""
+        f = open("{0}/example/marketcap_navajo_7d.json".format(
+            os.path.dirname(os.path.abspath(__file__))), 'r')
+        jsonDump = f.read()
+        f.close()
+
+        data, volData = parseMarketCap(
+            jsonDump, 'navajo', includeVolume=True)
+        self.assertEqual(list(streamMarketCap(jsonDump, 'navajo')), data)
+        rows, volRows = streamMarketCap(
+            StringIO(jsonDump), 'navajo', includeVolume=True, chunkSize=7)
+        self.assertEqual(list(rows), data)
+        self.assertEqual(list(volRows), volData)
+
+        # Only rows after since
+        rows, volRows = streamMarketCap(
+            jsonDump, 'navajo', includeVolume=True, since=data[99]['time'])
+        self.assertEqual(list(rows), data[100:])
+        self.assertEqual(list(volRows), [datum for datum in volData
+                                         if datum['time'] > data[99]['time']])
+
+        # Misaligned series with gaps and nulls
+        jsonDump = json.dumps({
+            'market_cap_by_available_supply_data': [
+                [2000.0, 10.0], [1000.0, None]],
+            'market_cap_by_total_supply_data': [[1000.0, 10.0]],
+            'price_usd_data': [[1000.0, 2.0], [2000.0, 4.0]],
+            'price_btc_data': [],
+            'volume_data': [[3000.0, 1.5], [1000.0, 2.5]],
+            'x_min': 1000.0,
+            'x_max': 3000.0
+        }, indent=4)
+        data, volData = parseMarketCap(
+            jsonDump, 'navajo', includeVolume=True)
+        rows, volRows = streamMarketCap(
+            jsonDump, 'navajo', includeVolume=True, chunkSize=3)
+        self.assertEqual(list(rows), data)
+        self.assertEqual(list(volRows), volData)
+        for truncated in ['{"price_usd_data": [[1,', '{"price_usd_data": ',
+                          '{"a":']:
+            self.assertRaises(ValueError, streamMarketCap, truncated, 1)
+
+    def testParseMarketCapCompact(self):
+        """Test that compact rows hold the same points as dict rows."""
+        f = open("{0}/example/marketcap_navajo_7d.json".format(
+            os.path.dirname(os.path.abspath(__file__))), 'r')
+        jsonDump = f.read()
+        f.close()
+        data, volData = parseMarketCap(jsonDump, 9, includeVolume=True)
+        rows, volRows = parseMarketCap(
+            jsonDump, 9, includeVolume=True, compact=True)
+        self.assertEqual(len(rows), len(data))
+        for row, datum in zip(rows, data):
+            self.assertEqual(isinstance(row, MarketCapRow), True)
+            self.assertEqual(datetime.utcfromtimestamp(row.time),
+                             datum['time'])
+            self.assertEqual(row._replace(time=datum['time'])._asdict(),
+                             datum)
+        self.assertEqual([(row.currency, row.time, row.volume)
+                          for row in volRows],
+                         [(datum['currency'], _epoch(datum['time']),
+                           datum['volume']) for datum in volData])
+        # No per-row attribute dict
+        self.assertEqual(sys.getsizeof(rows[0]),
+                         sys.getsizeof(tuple(rows[0])))
+
+        # Streaming gives the same compact rows
+        streamed, volStreamed = streamMarketCap(
+            jsonDump, 9, includeVolume=True, compact=True)
+        self.assertEqual(list(streamed), rows)
+        self.assertEqual(list(volStreamed), volRows)
+
 if __name__ == "__main__":
     unittest.main()
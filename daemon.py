@@ -0,0 +1,210 @@
+"""Long-running poller appending the newest market cap points."""
+import coinmarketcap
+import logging
+import os
+import pg
+import resource
+import signal
+import sys
+import threading
+import time
+import traceback
+import unittest
+
+# Configuration
+topCount = 50
+lookback = 7
+pollSeconds = 300
+topRefreshSeconds = 3600
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s %(levelname)s:%(message)s',
+    datefmt='%m/%d/%Y %I:%M:%S %p')
+
+
+class Daemon(object):
+
+    """Poller of the lookback endpoint of the top currencies.
+
+    The time of the newest point stored per currency (its watermark) is
+    kept in memory, seeded from the database whenever the top currencies
+    are picked again. Each poll only builds the rows after the watermark
+    and appends them with pg.appendMarketCap. Nothing else accumulates
+    between cycles, so memory stays flat over long uptimes.
+    """
+
+    def __init__(self):
+        """Create a daemon that has not picked its currencies yet."""
+        self.slugs = []
+        self.watermarks = {}
+        self.pickedAt = None
+        self.stopping = threading.Event()
+        self.counts = {'cycles': 0, 'polls': 0, 'appended': 0, 'failed': 0}
+
+    def pickCurrencies(self):
+        """Pick the top currencies and seed their watermarks."""
+        self.slugs = pg.selectTopCurrencies(topCount, lookback)
+        coverage = pg.selectCoverage([lookback])
+        watermarks = {}
+        for slug in self.slugs:
+            stored = coverage.get(slug, {}).get(lookback, (None, None))[1]
+            known = self.watermarks.get(slug)
+            watermarks[slug] = max(stored, known) if (
+                stored is not None and known is not None) else (
+                stored or known)
+        self.watermarks = watermarks
+        self.pickedAt = time.time()
+        logging.info("Polling {0} currencies.".format(len(self.slugs)))
+
+    def poll(self, slug):
+        """Fetch a currency and append the points after its watermark."""
+        jsonDump = coinmarketcap.requestMarketCap(slug, lookback)
+        data = list(coinmarketcap.streamMarketCap(
+            jsonDump, pg.lookupCurrencyId(slug),
+            since=self.watermarks.get(slug)))
+        if len(data) > 0:
+            self.counts['appended'] += pg.appendMarketCap(data, lookback)
+            self.watermarks[slug] = data[-1]['time']
+        self.counts['polls'] += 1
+
+    def runCycle(self):
+        """Poll every picked currency once, isolating failures."""
+        if (self.pickedAt is None or
+                time.time() - self.pickedAt >= topRefreshSeconds):
+            self.pickCurrencies()
+        for slug in self.slugs:
+            if self.stopping.is_set():
+                return
+            try:
+                self.poll(slug)
+            except Exception:
+                self.counts['failed'] += 1
+                sys.stdout.write("\n".join([
+                    '-'*60,
+                    "Could not poll currency {0}.".format(slug),
+                    traceback.format_exc(),
+                    '-'*60,
+                    '']))
+        self.counts['cycles'] += 1
+        logging.info(
+            "Cycle {cycles}: {polls} polls appended {appended} points "
+            "({failed} failed) so far. Max RSS {0:.1f} MB.".format(
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0,
+                **self.counts))
+
+    def run(self):
+        """Run cycles every pollSeconds until stopped."""
+        while not self.stopping.is_set():
+            started = time.time()
+            self.runCycle()
+            self.stopping.wait(max(pollSeconds - (time.time() - started), 0))
+
+    def stop(self, *args):
+        """Stop after the current poll."""
+        logging.info("Stopping...")
+        self.stopping.set()
+
+
+def main():
+    """Run the daemon until SIGTERM or SIGINT."""
+    daemon = Daemon()
+    signal.signal(signal.SIGTERM, daemon.stop)
+    signal.signal(signal.SIGINT, daemon.stop)
+    try:
+        daemon.run()
+    finally:
+        coinmarketcap.closeSession()
+    logging.info("Stopped after {cycles} cycles.".format(**daemon.counts))
+
+
+class DaemonTest(unittest.TestCase):
+
+    """Testing suite for daemon module."""
+
+    testTables = ['currency', 'market_cap_7', 'market_cap_hourly',
+                  'market_cap_daily']
+
+    def setUp(self):
+        """Setup tables, currencies and a local market cap source."""
+        self.tablesOriginal = pg.tables
+        pg.tables = dict(pg.tables)
+        cur = pg.cursor()
+        for key in self.testTables:
+            pg.tables[key] = "{0}_test".format(self.tablesOriginal[key])
+            cur.execute("""CREATE TABLE {0}
+                (LIKE {1} INCLUDING ALL)""".format(
+                pg.tables[key], self.tablesOriginal[key]))
+        cur.execute("""INSERT INTO {0} (id, slug)
+            VALUES (9, 'navajo'), (10, 'bitcoin')""".format(
+            pg.tables['currency']))
+        cur.execute("""COMMIT""")
+        pg.currencyCache.invalidate()
+        f = open("{0}/example/marketcap_navajo_7d.json".format(
+            os.path.dirname(os.path.abspath(__file__))), 'r')
+        jsonDump = f.read()
+        f.close()
+        self.rows = coinmarketcap.parseMarketCap(jsonDump, 9)
+
+        def requestMarketCap(slug, numDays):
+            if slug != 'navajo':
+                raise ValueError("No payload for {0}.".format(slug))
+            return jsonDump
+
+        self.requestMarketCapOriginal = coinmarketcap.requestMarketCap
+        coinmarketcap.requestMarketCap = requestMarketCap
+
+    def tearDown(self):
+        """Teardown test tables and restore the market cap source."""
+        cur = pg.cursor()
+        for key in self.testTables:
+            cur.execute("""DROP TABLE IF EXISTS {0}""".format(pg.tables[key]))
+        cur.execute("""COMMIT""")
+        pg.tables = self.tablesOriginal
+        pg.currencyCache.invalidate()
+        coinmarketcap.requestMarketCap = self.requestMarketCapOriginal
+
+    def countStored(self):
+        """Return the number of navajo points stored and the first time."""
+        cur = pg.cursor()
+        cur.execute("""SELECT COUNT(*), MIN(time) FROM {0}
+            WHERE currency = 9""".format(pg.tables['market_cap_7']))
+        stored = cur.fetchone()
+        cur.execute("""COMMIT""")
+        return stored
+
+    def testPoll(self):
+        """Test that a poll only appends points after the watermark and
+        moves the watermark forward."""
+        daemon = Daemon()
+        daemon.watermarks['navajo'] = self.rows[99]['time']
+        daemon.poll('navajo')
+        self.assertEqual(daemon.counts['appended'], len(self.rows) - 100)
+        self.assertEqual(self.countStored(),
+                         (len(self.rows) - 100, self.rows[100]['time']))
+        self.assertEqual(daemon.watermarks['navajo'], self.rows[-1]['time'])
+
+        # Nothing is newer than the watermark any more
+        daemon.poll('navajo')
+        self.assertEqual(daemon.counts['polls'], 2)
+        self.assertEqual(daemon.counts['appended'], len(self.rows) - 100)
+        self.assertEqual(daemon.watermarks['navajo'], self.rows[-1]['time'])
+
+    def testRunCycle(self):
+        """Test that a cycle seeds watermarks from the stored points of the
+        top currencies and isolates failed polls."""
+        pg.appendMarketCap(self.rows[:100], 7)
+        pg.appendMarketCap([dict(self.rows[0], currency=10,
+                                 market_cap_by_available_supply=1e10)], 7)
+        daemon = Daemon()
+        daemon.runCycle()
+        self.assertEqual(daemon.slugs, ['bitcoin', 'navajo'])
+        self.assertEqual(daemon.counts, {
+            'cycles': 1, 'polls': 1, 'appended': len(self.rows) - 100,
+            'failed': 1})
+        self.assertEqual(self.countStored(),
+                         (len(self.rows), self.rows[0]['time']))
+        self.assertEqual(daemon.watermarks, {
+            'bitcoin': self.rows[0]['time'], 'navajo': self.rows[-1]['time']})
+
+if __name__ == "__main__":
+    main()
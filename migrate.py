@@ -0,0 +1,138 @@
+"""Migration of market cap data into the partitioned storage layout."""
+import coinmarketcap
+from datetime import datetime
+import logging
+import os
+import pg
+import sys
+import time
+import unittest
+
+# Configuration variables
+lookbacks = [365, 180, 90, 30, 7]
+
+
+def migrateMarketCap(lookbackDays):
+    """Copy one lookback's market_cap_N table into the consolidated table.
+
+    Rows are moved a month (one partition) per transaction, so the copy
+    can be stopped and rerun at any point; rows already present in the
+    consolidated table are left alone. Returns the number of rows copied.
+    """
+    sourceTable = pg.tables["market_cap_{0}".format(lookbackDays)]
+    targetTable = pg.tables["market_cap"]
+    countCopied = 0
+    with pg.checkout():
+        cur = pg.cursor()
+        cur.execute("""SELECT MIN(time), MAX(time) FROM {0}""".format(
+            sourceTable))
+        first, last = cur.fetchone()
+        if first is None:
+            return 0
+        fields = [field for field in pg._tableColumns(sourceTable, cur)
+                  if field != 'db_update_time']
+        month = datetime(first.year, first.month, 1)
+        while month <= last:
+            nextMonth = pg._nextMonth(month)
+            pg._createPartitions(targetTable, [month], cur)
+            cur.execute("""
+                INSERT INTO {0} (lookback, {2}, db_update_time)
+                (SELECT %s, {2}, db_update_time
+                FROM {1}
+                WHERE time >= %s AND time < %s)
+                ON CONFLICT DO NOTHING""".format(
+                targetTable, sourceTable, ",".join(fields)),
+                (lookbackDays, month, nextMonth))
+            countCopied += cur.rowcount
+            cur.execute("""COMMIT""")
+            month = nextMonth
+    logging.info("Copied {0} rows of {1} into {2}.".format(
+        countCopied, sourceTable, targetTable))
+    return countCopied
+
+
+def backfillRollups():
+    """Build the rollups of every market cap and volume table's history."""
+    keys = ["market_cap_{0}".format(lookback) for lookback in lookbacks]
+    if pg.storageLayout == 'partitioned':
+        keys = ['market_cap']
+    for key in keys + ['trade_volume_usd']:
+        countFound = pg.backfillRollups(pg.tables[key])
+        logging.info("Built rollups of {0} for {1} currencies.".format(
+            pg.tables[key], countFound))
+
+
+def main():
+    """Copy the lookbacks given as arguments (default all) and report, or
+    build the rollups if the argument is 'rollups'."""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s:%(message)s',
+        datefmt='%m/%d/%Y %I:%M:%S %p')
+    started = time.time()
+    if sys.argv[1:] == ['rollups']:
+        backfillRollups()
+        logging.info("Built rollups in {0:.1f}s.".format(
+            time.time() - started))
+        return
+    countCopied = 0
+    for lookback in [int(arg) for arg in sys.argv[1:]] or lookbacks:
+        countCopied += migrateMarketCap(lookback)
+    logging.info("Copied {0} rows in {1:.1f}s. Set pg.storageLayout to "
+                 "'partitioned' to load into the new table.".format(
+                     countCopied, time.time() - started))
+
+
+class MigrateTest(unittest.TestCase):
+
+    """Testing suite for migrate module."""
+
+    testTables = ['market_cap_7', 'market_cap', 'market_cap_hourly',
+                  'market_cap_daily']
+
+    def setUp(self):
+        """Setup tables for test."""
+        cur = pg.cursor()
+        cur.execute("""SELECT to_regclass(%s) IS NOT NULL""",
+                    (pg.tables['market_cap'],))
+        if not cur.fetchone()[0]:
+            self.skipTest("Partitioned layout not created.")
+        self.tablesOriginal = pg.tables
+        pg.tables = dict(pg.tables)
+        pg.partitions.clear()
+        for key in self.testTables:
+            pg.tables[key] = "{0}_test".format(self.tablesOriginal[key])
+            cur.execute("""CREATE TABLE {0}
+                (LIKE {1} INCLUDING ALL) {2}""".format(
+                pg.tables[key], self.tablesOriginal[key],
+                "PARTITION BY RANGE (time)" if key == 'market_cap' else ""))
+        cur.execute("""COMMIT""")
+
+    def tearDown(self):
+        """Teardown test tables."""
+        cur = pg.cursor()
+        for key in self.testTables:
+            cur.execute("""DROP TABLE IF EXISTS {0}""".format(pg.tables[key]))
+        cur.execute("""COMMIT""")
+        pg.tables = self.tablesOriginal
+
+    def testMigrateMarketCap(self):
+        """Test that a migration copies every row once."""
+        f = open("{0}/example/marketcap_navajo_7d.json".format(
+            os.path.dirname(os.path.abspath(__file__))), 'r')
+        data = coinmarketcap.parseMarketCap(f.read(), 9)
+        f.close()
+        pg.insertMarketCap(data, 7)
+        self.assertEqual(migrateMarketCap(7), 287)
+        self.assertEqual(migrateMarketCap(7), 0)
+
+        # The copy matches what a load into the partitioned layout gives
+        storageLayoutOriginal = pg.storageLayout
+        pg.storageLayout = 'partitioned'
+        try:
+            self.assertEqual(pg.insertMarketCap(data, 7)['untouched'], 287)
+        finally:
+            pg.storageLayout = storageLayoutOriginal
+
+if __name__ == "__main__":
+    main()
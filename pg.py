@@ -1,16 +1,34 @@
 """Module for storing coinmarketcap data in the database."""
+import atexit
 import codecs
 import coinmarketcap
+from contextlib import contextmanager
+from cStringIO import StringIO
 from datetime import datetime
 from decimal import Decimal
+import functools
+import logging
+import math
+import multiprocessing
 import os
 import psycopg2 as pg2
 import psycopg2.extras as pg2ext
 import random
+import sys
+import threading
+import time
 import unittest
 
 # Configuration variables
 batchLimit = 1000
+bulkLoadMethod = 'copy'
+poolMinSize = 1
+poolMaxSize = 8
+writeBehindRows = 50000
+writeBehindSeconds = 60
+storageLayout = 'tables'
+maintainRollups = True
+rollupUnits = [('hour', 'hourly'), ('day', 'daily')]
 tables = {
     "currency": "currency",
     "currency_historical": "currency_historical",
@@ -19,7 +37,16 @@ tables = {
     "market_cap_90": "market_cap_90",
     "market_cap_30": "market_cap_30",
     "market_cap_7": "market_cap_7",
-    "trade_volume_usd": "trade_volume_usd"
+    "market_cap": "market_cap",
+    "trade_volume_usd": "trade_volume_usd",
+    "market_cap_hourly": "market_cap_hourly",
+    "market_cap_daily": "market_cap_daily",
+    "trade_volume_usd_hourly": "trade_volume_usd_hourly",
+    "trade_volume_usd_daily": "trade_volume_usd_daily",
+    "payload_fingerprint": "payload_fingerprint",
+    "refresh_schedule": "refresh_schedule",
+    "scrape_run": "scrape_run",
+    "scrape_job": "scrape_job"
 }
 
 # Pull in postgres configuration information
@@ -37,18 +64,143 @@ dbcParams = {
 }
 dbcFile.close()
 
-# Connection variable
-conn = None
+# Connection pool, connections held by each thread, and pools inherited from
+# a parent process (kept referenced, since closing them would end the
+# parent's sessions)
+pool = None
+poolLock = threading.Lock()
+local = threading.local()
+inherited = []
+
+# Rows and seconds spent staging rows, per bulk load method
+loadStats = {}
+
+# Column names per table
+tableColumns = {}
+
+# Months known to have a partition, per partitioned table
+partitions = {}
+
+
+class ConnectionPool(object):
+
+    """Pool of connections that blocks once maxSize are checked out."""
+
+    def __init__(self, minSize, maxSize, params):
+        """Open minSize connections with the given parameters."""
+        self.pid = os.getpid()
+        self._params = params
+        self._lock = threading.Lock()
+        self._available = threading.BoundedSemaphore(maxSize)
+        self._idle = [pg2.connect(**params) for i in range(minSize)]
+        self.size = minSize
+
+    def getconn(self):
+        """Check a connection out, waiting for one if the pool is full."""
+        self._available.acquire()
+        try:
+            with self._lock:
+                while len(self._idle) > 0:
+                    conn = self._idle.pop()
+                    if not conn.closed:
+                        return conn
+                    self.size -= 1
+                self.size += 1
+            return pg2.connect(**self._params)
+        except:
+            with self._lock:
+                self.size -= 1
+            self._available.release()
+            raise
+
+    def putconn(self, conn):
+        """Return a checked out connection to the pool."""
+        with self._lock:
+            if conn.closed:
+                self.size -= 1
+            else:
+                self._idle.append(conn)
+        self._available.release()
+
+    def closeall(self):
+        """Close the idle connections."""
+        with self._lock:
+            for conn in self._idle:
+                conn.close()
+            self.size -= len(self._idle)
+            self._idle = []
+
+
+def getPool():
+    """Return this process's connection pool, creating it if needed."""
+    global pool
+    with poolLock:
+        if pool is not None and pool.pid != os.getpid():
+            inherited.append(pool)
+            pool = None
+        if pool is None:
+            pool = ConnectionPool(poolMinSize, poolMaxSize, dbcParams)
+        return pool
+
+
+def _threadState():
+    """Reset the calling thread's connections after a fork."""
+    if getattr(local, 'pid', None) != os.getpid():
+        if getattr(local, 'conn', None) is not None:
+            inherited.append(local.conn)
+        local.pid = os.getpid()
+        local.conn = None
+        local.checkedOut = None
+
+
+@contextmanager
+def checkout():
+    """Check a pooled connection out for the calling thread.
+
+    Within the block cursor() and dictCursor() use the checked out
+    connection. It is committed on success, rolled back on error and then
+    returned to the pool. Nested checkouts share the outer connection.
+    """
+    _threadState()
+    if local.checkedOut is not None:
+        yield local.checkedOut
+        return
+    connPool = getPool()
+    conn = connPool.getconn()
+    local.checkedOut = conn
+    try:
+        yield conn
+        conn.commit()
+    except:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        local.checkedOut = None
+        connPool.putconn(conn)
+
+
+def _pooled(function):
+    """Run a function within a checkout."""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with checkout():
+            return function(*args, **kwargs)
+    return wrapper
 
 
 def connect():
-    """Connect to the database."""
-    global conn
-    if conn is not None:
-        return conn
-    else:
-        conn = pg2.connect(**dbcParams)
-        return conn
+    """Connect to the database.
+
+    Within a checkout this is the checked out connection; otherwise it is a
+    connection of the calling thread's own, outside the pool.
+    """
+    _threadState()
+    if local.checkedOut is not None:
+        return local.checkedOut
+    if local.conn is None or local.conn.closed:
+        local.conn = pg2.connect(**dbcParams)
+    return local.conn
 
 
 def cursor():
@@ -62,10 +214,10 @@ def dictCursor():
 
 
 def _createStaging(tableName, cursor):
-    """Create staging table."""
+    """Create (temporary, hence unlogged) staging table."""
     stagingTable = "{0}_{1}".format(
         tableName, str(int(pow(10, random.random()*10))).zfill(10))
-    cursor.execute("""CREATE TABLE {0} (LIKE {1}
+    cursor.execute("""CREATE TEMPORARY TABLE {0} (LIKE {1}
         INCLUDING DEFAULTS)""".format(stagingTable, tableName))
     return stagingTable
 
@@ -76,6 +228,7 @@ def _dropStaging(tableName, cursor):
         DROP TABLE {0}""".format(tableName))
 
 
+@_pooled
 def insertCurrencyList(data, withHistory=True):
     """Insert parsed currency list."""
     cursor = dictCursor()
@@ -117,8 +270,10 @@ def insertCurrencyList(data, withHistory=True):
         (SELECT stg.*
         FROM {1} stg
         LEFT JOIN {0} tgt ON tgt.slug = stg.slug
-        WHERE tgt.name IS NULL)""".format(
+        WHERE tgt.name IS NULL)
+        RETURNING slug, id""".format(
         targetTable, stagingTable))
+    insertedIds = dict((row['slug'], row['id']) for row in cursor.fetchall())
 
     # If requested, merge data into the historical table
     if withHistory:
@@ -142,39 +297,295 @@ def insertCurrencyList(data, withHistory=True):
     # Commit
     cursor.execute("""COMMIT""")
 
+    # Newly inserted slugs go straight into the currency cache
+    currencyCache.update(insertedIds)
+
+
+def _marketCapRows(data):
+    """Return (fields, rows as tuples) for parsed market cap data.
+
+    Accepts the list of dicts or compact rows (MarketCapRow or VolumeRow
+    tuples) from coinmarketcap.parseMarketCap or the columns from
+    coinmarketcap.parseMarketCapColumns.
+    """
+    if not isinstance(data, dict):
+        if isinstance(data[0], tuple):
+            # Compact rows are tuples already; only times need converting
+            fields = list(data[0]._fields)
+            i = fields.index('time')
+            return fields, [
+                row[:i] + (datetime.utcfromtimestamp(row[i]),) + row[i + 1:]
+                for row in data]
+        fields = data[0].keys()
+        return fields, [tuple(datum[field] for field in fields)
+                        for datum in data]
+
+    # Columnar data: epoch times become timestamps and NaN becomes NULL
+    fields = [field for field in data.keys() if field != 'currency']
+    columns = []
+    for field in fields:
+        if field == 'time':
+            column = [datetime.utcfromtimestamp(value)
+                      for value in data[field].tolist()]
+        else:
+            column = [None if value != value else value
+                      for value in data[field].tolist()]
+        columns.append(column)
+    currency = [data['currency']]*len(data['time'])
+    return ['currency'] + fields, zip(currency, *columns)
+
+
+def _withLookback(fields, rows, lookbackDays):
+    """Prepend a lookback column to (fields, rows)."""
+    return (['lookback'] + list(fields),
+            [(lookbackDays,) + tuple(row) for row in rows])
+
+
+def _nextMonth(value):
+    """Return the start of the month after the one containing value."""
+    return datetime(value.year + value.month // 12, value.month % 12 + 1, 1)
+
+
+def _createPartitions(targetTable, times, cursor):
+    """Create the monthly partitions of targetTable that times fall in.
+
+    Partitions are created in their own transaction, under an advisory lock
+    so concurrent loads don't race to create the same month.
+    """
+    known = partitions.setdefault(targetTable, set())
+    months = set(datetime(value.year, value.month, 1)
+                 for value in times) - known
+    if len(months) == 0:
+        return
+    cursor.execute("""SELECT pg_advisory_xact_lock(hashtext(%s))""",
+                   (targetTable,))
+    for month in sorted(months):
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS {0}_p{1}
+            PARTITION OF {0}
+            FOR VALUES FROM (%s) TO (%s)""".format(
+            targetTable, month.strftime('%Y%m')), (month, _nextMonth(month)))
+    cursor.execute("""COMMIT""")
+    known.update(months)
+
+
+def _rollupSource(targetTable):
+    """Return (rollup table key prefix, lookback expression) for a table
+    whose loads maintain rollups, or None."""
+    for key, table in tables.iteritems():
+        if table != targetTable:
+            continue
+        if key == 'market_cap':
+            return 'market_cap', "src.lookback"
+        elif key.startswith('market_cap_') and key[11:].isdigit():
+            return 'market_cap', key[11:]
+        elif key == 'trade_volume_usd':
+            return 'trade_volume_usd', None
+    return None
 
-def _insertMarketCap(data, targetTable):
-    """Insert market cap data (private)."""
+
+def _createTouched(tableName, cursor):
+    """Create the (temporary) table of hour buckets to recompute."""
+    cursor.execute("""CREATE TEMPORARY TABLE {0} (
+        currency INTEGER,
+        lookback INTEGER,
+        bucket TIMESTAMP)""".format(tableName))
+    return tableName
+
+
+def _updateRollups(targetTable, touchedTable, cursor):
+    """Recompute the rollup buckets of targetTable that contain the
+    (currency, lookback, hour) buckets listed in touchedTable."""
+    prefix, lookback = _rollupSource(targetTable)
+    for unit, suffix in rollupUnits:
+        keyColumns = "currency, bucket"
+        keySelect = "src.currency, t.bucket"
+        grouping = "src.currency, t.bucket"
+        lookbackJoin = ""
+        if prefix == 'market_cap':
+            keyColumns = "currency, lookback, bucket"
+            keySelect = "src.currency, {0}, t.bucket".format(lookback)
+            if lookback == "src.lookback":
+                grouping = "src.currency, src.lookback, t.bucket"
+                lookbackJoin = "AND src.lookback = t.lookback"
+            columns = "open, high, low, close, num_points"
+            aggregates = """
+                (array_agg(src.price_usd ORDER BY src.time)
+                    FILTER (WHERE src.price_usd IS NOT NULL))[1],
+                MAX(src.price_usd),
+                MIN(src.price_usd),
+                (array_agg(src.price_usd ORDER BY src.time DESC)
+                    FILTER (WHERE src.price_usd IS NOT NULL))[1],
+                COUNT(*)"""
+        else:
+            # Volumes are trailing 24 hour volumes, so the last one stands
+            # for the bucket
+            columns = "volume, num_points"
+            aggregates = """
+                (array_agg(src.volume ORDER BY src.time DESC)
+                    FILTER (WHERE src.volume IS NOT NULL))[1],
+                COUNT(*)"""
+        cursor.execute("""
+            INSERT INTO {0} ({1}, {2})
+            (SELECT {3}, {4}
+            FROM (SELECT DISTINCT currency, lookback,
+                    date_trunc('{5}', bucket) AS bucket
+                FROM {6}) t
+            JOIN {7} src ON src.currency = t.currency {8}
+                AND src.time >= t.bucket
+                AND src.time < t.bucket + INTERVAL '1 {5}'
+            GROUP BY {9})
+            ON CONFLICT ({1}) DO UPDATE
+            SET {10}, db_update_time = current_timestamp""".format(
+            tables["{0}_{1}".format(prefix, suffix)],
+            keyColumns, columns, keySelect, aggregates, unit, touchedTable,
+            targetTable, lookbackJoin, grouping,
+            ",".join("{0} = EXCLUDED.{0}".format(column.strip())
+                     for column in columns.split(','))))
+
+
+def _copyValue(value):
+    """Format a value for COPY's text format."""
+    if value is None:
+        return '\\N'
+    elif isinstance(value, float):
+        return repr(value)
+    elif isinstance(value, datetime):
+        return value.isoformat()
+    elif isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return str(value).replace('\\', '\\\\').replace(
+        '\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def _stageRows(fields, rows, stagingTable, cursor):
+    """Move rows into the staging table with the configured method."""
+    started = time.time()
+    if bulkLoadMethod == 'copy':
+        buf = StringIO("".join(
+            "\t".join(_copyValue(value) for value in row) + "\n"
+            for row in rows))
+        cursor.copy_expert("""COPY {0} ({1}) FROM STDIN""".format(
+            stagingTable, ",".join(fields)), buf)
+    else:
+        batchCount = 0
+        while batchCount*batchLimit < len(rows):
+            cursor.executemany(
+                """INSERT INTO {0} ({1}) VALUES ({2})""".format(
+                    stagingTable,
+                    ",".join(fields),
+                    ",".join(["%s"]*len(fields))
+                ), rows[(batchCount*batchLimit):((batchCount+1)*batchLimit)])
+            batchCount += 1
+    elapsed = max(time.time() - started, 1e-6)
+
+    # Keep track of throughput so the load methods can be compared
+    stats = loadStats.setdefault(bulkLoadMethod, {'rows': 0, 'seconds': 0})
+    stats['rows'] += len(rows)
+    stats['seconds'] += elapsed
+    logging.info("Staged {0} rows via {1} at {2:.0f} rows/s.".format(
+        len(rows), bulkLoadMethod, len(rows)/elapsed))
+
+
+def _tableColumns(tableName, cursor):
+    """Return the column names of a table."""
+    if tableName not in tableColumns:
+        cursor.execute("""SELECT * FROM {0} LIMIT 0""".format(tableName))
+        tableColumns[tableName] = [
+            column[0] for column in cursor.description]
+    return tableColumns[tableName]
+
+
+def _insertMarketCap(data, targetTable, lookbackDays=None):
+    """Insert market cap data (private).
+
+    If lookbackDays is given, rows are tagged with it and keyed on it, as
+    the consolidated market cap table requires.
+    Returns counts of rows inserted, updated and left untouched.
+    """
+    if len(data) == 0 or (isinstance(data, dict) and len(data['time']) == 0):
+        return {'inserted': 0, 'updated': 0, 'untouched': 0}
+    fields, rows = _marketCapRows(data)
+    keyFields = ('currency', 'time')
+    if lookbackDays is not None:
+        fields, rows = _withLookback(fields, rows, lookbackDays)
+        keyFields = ('currency', 'lookback', 'time')
+    return _mergeRows(fields, rows, targetTable, keyFields)
+
+
+@_pooled
+def _mergeRows(fields, rows, targetTable, keyFields):
+    """Stage rows (tuples of fields) and merge them into the target table."""
     cursor = dictCursor()
-    if len(data) == 0:
-        return True
-    fields = data[0].keys()
+
+    # Make sure the partitions the rows go to exist
+    if (storageLayout == 'partitioned' and
+            targetTable == tables.get('market_cap')):
+        timeIndex = fields.index('time')
+        _createPartitions(
+            targetTable, [row[timeIndex] for row in rows], cursor)
 
     # Create staging table
     stagingTable = _createStaging(targetTable, cursor)
 
     # Move data into staging table
-    batchCount = 0
-    while batchCount*batchLimit < len(data):
-        cursor.executemany("""INSERT INTO {0} ({1}) VALUES ({2})""".format(
-            stagingTable,
-            ",".join(fields),
-            ",".join(["%({0})s".format(field) for field in fields])
-            ), data[(batchCount*batchLimit):((batchCount+1)*batchLimit)])
-        batchCount += 1
-
-    # Delete out rows with content similar to what we are about to insert
-    cursor.execute("""
-        DELETE FROM {0} as tgt
-        USING {1} as stg
-        WHERE tgt.currency = stg.currency
-        AND tgt.time = stg.time""".format(targetTable, stagingTable))
+    _stageRows(fields, rows, stagingTable, cursor)
 
-    # Insert the new data into the target table
+    # Merge into the target table, writing only rows that are new or whose
+    # values differ from what is already stored. Rows that already existed
+    # are counted in the same statement (xmax, which would tell inserts from
+    # updates, can't be returned from partitioned tables). If the table has
+    # rollups, the hours of the rows written are noted to recompute them
+    valueFields = [field for field in fields if field not in keyFields]
+    updates = ["{0} = EXCLUDED.{0}".format(field) for field in valueFields]
+    if 'db_update_time' in _tableColumns(targetTable, cursor):
+        updates.append("db_update_time = current_timestamp")
+    touchedTable = None
+    returning = "1"
+    touched = ""
+    if maintainRollups and _rollupSource(targetTable) is not None:
+        touchedTable = _createTouched(
+            "{0}_touched".format(stagingTable), cursor)
+        lookback = "lookback" if 'lookback' in keyFields else "NULL::integer"
+        returning = "currency, {0} AS lookback, time".format(lookback)
+        touched = """,
+        touched AS (
+            INSERT INTO {0}
+            (SELECT DISTINCT currency, lookback, date_trunc('hour', time)
+            FROM merged))""".format(touchedTable)
     cursor.execute("""
-        INSERT INTO {0}
-        (SELECT *
-        FROM {1})""".format(targetTable, stagingTable))
+        WITH existing AS (
+            SELECT COUNT(*) AS cnt
+            FROM {1} stg
+            JOIN {0} tgt USING ({3})),
+        merged AS (
+            INSERT INTO {0} AS tgt ({2})
+            (SELECT {2}
+            FROM {1})
+            ON CONFLICT ({3}) DO UPDATE
+            SET {4}
+            WHERE ({5}) IS DISTINCT FROM ({6})
+            RETURNING {7}){8}
+        SELECT %s - existing.cnt AS inserted,
+            (SELECT COUNT(*) FROM merged) - (%s - existing.cnt) AS updated
+        FROM existing""".format(
+        targetTable,
+        stagingTable,
+        ",".join(fields),
+        ",".join(keyFields),
+        ",".join(updates),
+        ",".join(["tgt.{0}".format(field) for field in valueFields]),
+        ",".join(["EXCLUDED.{0}".format(field) for field in valueFields]),
+        returning,
+        touched),
+        (len(rows), len(rows)))
+    counts = dict(cursor.fetchone())
+    counts['untouched'] = len(rows) - counts['inserted'] - counts['updated']
+
+    # Recompute the rollup buckets the rows written fall in
+    if touchedTable is not None:
+        _updateRollups(targetTable, touchedTable, cursor)
+        _dropStaging(touchedTable, cursor)
 
     # Drop staging table
     _dropStaging(stagingTable, cursor)
@@ -183,39 +594,725 @@ def _insertMarketCap(data, targetTable):
     cursor.execute("""COMMIT""")
 
     # Return
-    return True
+    return counts
+
+
+class WriteBehindBuffer(object):
+
+    """Buffer of market cap rows from many currencies per target table.
+
+    Each table's rows are loaded with one staged merge once maxRows are
+    buffered or maxAge seconds have passed since its oldest buffered row,
+    and on flush() or close(). The age is checked on every add and by a
+    timer thread, so rows don't wait for the next add to go out. A later
+    row for the same (currency, time) replaces a buffered one, as it would
+    replace a loaded one. The onFlush callback of an add runs only after
+    its rows are committed, so callers can defer marking work as done until
+    then. If a merge fails its rows are dropped and their callbacks never
+    run; the other tables of the flush are still merged.
+    """
+
+    def __init__(self, maxRows=None, maxAge=None):
+        """Create an empty buffer with the given flush thresholds."""
+        self.maxRows = maxRows if maxRows is not None else writeBehindRows
+        self.maxAge = maxAge if maxAge is not None else writeBehindSeconds
+        self.counts = {'inserted': 0, 'updated': 0, 'untouched': 0}
+        self.flushes = 0
+        self._lock = threading.Lock()
+        self._flushLock = threading.Lock()
+        self._pending = {}
+        self._timer = None
+        self._closing = None
+        # Stopped before interpreter teardown, which breaks running threads
+        atexit.register(self._stopTimer)
+
+    def _startTimer(self):
+        """Start the timer thread, unless it is running (in this process).
+        Called with the lock held."""
+        if self._timer is None or not self._timer.is_alive():
+            self._closing = threading.Event()
+            self._timer = threading.Thread(target=self._flushOld,
+                                           args=(self._closing,))
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _flushOld(self, closing):
+        """Flush the tables whose oldest row is maxAge seconds old, every
+        half maxAge, until closing is set."""
+        while not closing.wait(max(self.maxAge/2.0, 0.05)):
+            with self._lock:
+                old = [table for table, pending in self._pending.iteritems()
+                       if time.time() - pending['since'] >= self.maxAge]
+            for table in old:
+                try:
+                    self.flush(table)
+                except Exception:
+                    logging.exception(
+                        "Could not flush rows buffered for {0}.".format(table))
+
+    def add(self, data, targetTable, onFlush=None, lookbackDays=None):
+        """Buffer parsed market cap data (rows or columns) for a table,
+        tagged with lookbackDays if given."""
+        keyFields = ('currency', 'time')
+        if len(data) == 0 or (
+                isinstance(data, dict) and len(data['time']) == 0):
+            fields, rows = None, []
+        else:
+            fields, rows = _marketCapRows(data)
+            if lookbackDays is not None:
+                fields, rows = _withLookback(fields, rows, lookbackDays)
+        if lookbackDays is not None:
+            keyFields = ('currency', 'lookback', 'time')
+        flushFirst = False
+        with self._lock:
+            pending = self._pending.get(targetTable)
+            if (pending is not None and fields is not None and
+                    pending['fields'] is not None and
+                    set(pending['fields']) != set(fields)):
+                flushFirst = True
+        if flushFirst:
+            self.flush(targetTable)
+        with self._lock:
+            pending = self._pending.setdefault(targetTable, {
+                'fields': None, 'keyFields': keyFields, 'rows': {},
+                'callbacks': [], 'since': time.time()})
+            if fields is not None and pending['fields'] is not None and \
+                    set(pending['fields']) == set(fields):
+                # Same columns in another order
+                order = [fields.index(field) for field in pending['fields']]
+                fields = pending['fields']
+                rows = [tuple(row[i] for i in order) for row in rows]
+            if fields is not None:
+                pending['fields'] = fields
+                key = [fields.index(field) for field in keyFields]
+                for row in rows:
+                    pending['rows'][tuple(row[i] for i in key)] = row
+            if onFlush is not None:
+                pending['callbacks'].append(onFlush)
+            due = (len(pending['rows']) >= self.maxRows or
+                   time.time() - pending['since'] >= self.maxAge)
+            self._startTimer()
+        if due:
+            self.flush(targetTable)
+
+    def flush(self, targetTable=None):
+        """Load buffered rows for one or all tables, then run callbacks.
+        If a merge fails, the other tables are still merged and the first
+        error is raised afterwards."""
+        with self._flushLock:
+            with self._lock:
+                if targetTable is None:
+                    taken = self._pending
+                    self._pending = {}
+                else:
+                    taken = {}
+                    if targetTable in self._pending:
+                        taken[targetTable] = self._pending.pop(targetTable)
+            error = None
+            for table, pending in taken.iteritems():
+                if len(pending['rows']) > 0:
+                    try:
+                        counts = _mergeRows(
+                            pending['fields'], pending['rows'].values(),
+                            table, pending['keyFields'])
+                    except Exception:
+                        if error is None:
+                            error = sys.exc_info()
+                        continue
+                    with self._lock:
+                        self.flushes += 1
+                        for key, count in counts.iteritems():
+                            self.counts[key] += count
+                for callback in pending['callbacks']:
+                    callback()
+            if error is not None:
+                raise error[0], error[1], error[2]
+
+    def _stopTimer(self):
+        """Stop the timer thread, if running."""
+        with self._lock:
+            timer, closing = self._timer, self._closing
+            self._timer = None
+        if timer is not None:
+            closing.set()
+            if timer is not threading.current_thread():
+                timer.join()
+
+    def close(self):
+        """Stop the timer thread and flush everything still buffered."""
+        self._stopTimer()
+        self.flush()
+
+
+@_pooled
+def backfillRollups(targetTable):
+    """Build the rollups of the existing history of a table, one currency
+    per transaction. Returns the number of currencies found."""
+    cursor = dictCursor()
+    cursor.execute("""SELECT id FROM {0} ORDER BY id""".format(
+        tables['currency']))
+    currencies = [row['id'] for row in cursor.fetchall()]
+    lookback = ("lookback" if 'lookback' in _tableColumns(targetTable, cursor)
+                else "NULL::integer")
+    countFound = 0
+    for currency in currencies:
+        touchedTable = _createTouched("{0}_touched_{1}".format(
+            targetTable, currency), cursor)
+        cursor.execute("""
+            INSERT INTO {0}
+            (SELECT DISTINCT currency, {1}, date_trunc('hour', time)
+            FROM {2}
+            WHERE currency = %s)""".format(
+            touchedTable, lookback, targetTable), (currency,))
+        if cursor.rowcount > 0:
+            countFound += 1
+            _updateRollups(targetTable, touchedTable, cursor)
+        _dropStaging(touchedTable, cursor)
+        cursor.execute("""COMMIT""")
+    return countFound
 
 
 def insertMarketCap(data, lookbackDays):
-    """Insert the non-volume market cap data."""
+    """Insert the non-volume market cap data (rows or columns)."""
+    if storageLayout == 'partitioned':
+        return _insertMarketCap(data, tables["market_cap"], lookbackDays)
     return _insertMarketCap(
         data, tables["market_cap_{0}".format(lookbackDays)])
 
 
 def insertMarketCapVolume(data):
-    """Insert the volume market cap data."""
+    """Insert the volume market cap data (rows or columns)."""
     return _insertMarketCap(
         data, tables["trade_volume_usd"])
 
 
+def bufferMarketCap(data, lookbackDays, onFlush=None):
+    """Buffer non-volume market cap data in the write-behind buffer."""
+    if storageLayout == 'partitioned':
+        writeBehind.add(data, tables["market_cap"], onFlush, lookbackDays)
+    else:
+        writeBehind.add(
+            data, tables["market_cap_{0}".format(lookbackDays)], onFlush)
+
+
+def bufferMarketCapVolume(data, onFlush=None):
+    """Buffer volume market cap data in the write-behind buffer."""
+    writeBehind.add(data, tables["trade_volume_usd"], onFlush)
+
+
+@_pooled
+def appendMarketCap(data, lookbackDays):
+    """Append non-volume market cap rows, skipping the staging table.
+
+    Meant for small batches of points newer than anything stored: rows
+    already stored are left alone rather than merged. Returns the number of
+    rows appended.
+    """
+    if len(data) == 0:
+        return 0
+    fields, rows = _marketCapRows(data)
+    cur = cursor()
+    if storageLayout == 'partitioned':
+        targetTable = tables['market_cap']
+        fields, rows = _withLookback(fields, rows, lookbackDays)
+        keyFields = ('currency', 'lookback', 'time')
+        lookback = "lookback"
+        timeIndex = fields.index('time')
+        _createPartitions(targetTable, [row[timeIndex] for row in rows], cur)
+    else:
+        targetTable = tables["market_cap_{0}".format(lookbackDays)]
+        keyFields = ('currency', 'time')
+        lookback = "NULL::integer"
+    cur.execute("""
+        INSERT INTO {0} ({1})
+        VALUES {2}
+        ON CONFLICT ({3}) DO NOTHING
+        RETURNING currency, {4}, time""".format(
+        targetTable,
+        ",".join(fields),
+        ",".join(cur.mogrify(
+            "(" + ",".join(["%s"]*len(fields)) + ")", row) for row in rows),
+        ",".join(keyFields),
+        lookback))
+    appended = cur.fetchall()
+
+    # Recompute the rollup buckets of the rows appended
+    if maintainRollups and len(appended) > 0:
+        _updateRollups(targetTable, """(VALUES {0})
+            AS touched (currency, lookback, bucket)""".format(",".join(
+            cur.mogrify("(%s, %s::integer, %s)", (
+                currency, rowLookback, rowTime.replace(
+                    minute=0, second=0, microsecond=0)))
+            for currency, rowLookback, rowTime in appended)), cur)
+    cur.execute("""COMMIT""")
+    return len(appended)
+
+
+@_pooled
+def selectTopCurrencies(count, lookbackDays):
+    """Select the slugs of the count currencies with the largest latest
+    market_cap_by_available_supply stored for lookbackDays."""
+    table, condition = marketCapSource(lookbackDays)
+    cur = cursor()
+    cur.execute("""
+        SELECT slug
+        FROM (SELECT c.slug,
+                (SELECT market_cap_by_available_supply
+                FROM {1}
+                WHERE currency = c.id {2}
+                ORDER BY time DESC
+                LIMIT 1) AS cap
+            FROM {0} c) latest
+        WHERE cap IS NOT NULL
+        ORDER BY cap DESC, slug
+        LIMIT %s""".format(tables['currency'], table, condition), (count,))
+    return [row[0] for row in cur.fetchall()]
+
+
 def selectCurrencyId(slug):
     """Select the ID associated with the passed slug."""
     cur = cursor()
-    cur.execute("""SELECT id FROM {0} WHERE slug = '{1}'""".format(
-        tables['currency'], slug))
+    cur.execute("""SELECT id FROM {0} WHERE slug = %s""".format(
+        tables['currency']), (slug,))
     rows = cur.fetchall()
     if len(rows) == 0:
         raise Exception(
-            "Couldn't find any currency ID matching slug '{0}'").format(
-            slug)
+            "Couldn't find any currency ID matching slug '{0}'".format(
+                slug))
     elif len(rows) > 1:
         raise Exception(
-            "DB Error. Found >1 currency IDs for slug '{0}'").format(
-            slug)
+            "DB Error. Found >1 currency IDs for slug '{0}'".format(
+                slug))
     else:
         return rows[0][0]
 
 
+class CurrencyCache(object):
+
+    """In-memory map of currency slugs to IDs.
+
+    The whole currency table is loaded on first use and reloaded when a slug
+    is missing. insertCurrencyList adds the IDs of the slugs it inserts.
+    """
+
+    def __init__(self):
+        """Create an empty cache."""
+        self._lock = threading.Lock()
+        self._ids = None
+        self._table = None
+
+    @_pooled
+    def _load(self):
+        """Load every slug and ID from the currency table."""
+        cur = cursor()
+        cur.execute("""SELECT slug, id FROM {0}""".format(
+            tables['currency']))
+        self._ids = dict(cur.fetchall())
+        self._table = tables['currency']
+
+    def get(self, slug):
+        """Return the ID of slug, refreshing the cache on a miss."""
+        with self._lock:
+            if (self._ids is None or self._table != tables['currency'] or
+                    slug not in self._ids):
+                self._load()
+            if slug not in self._ids:
+                raise Exception(
+                    "Couldn't find any currency ID matching slug '{0}'".format(
+                        slug))
+            return self._ids[slug]
+
+    def update(self, ids):
+        """Add slug to ID mappings, if the cache is loaded."""
+        with self._lock:
+            if self._ids is not None and self._table == tables['currency']:
+                self._ids.update(ids)
+
+    def invalidate(self):
+        """Drop the cache so it is reloaded on next use."""
+        with self._lock:
+            self._ids = None
+
+
+currencyCache = CurrencyCache()
+writeBehind = WriteBehindBuffer()
+
+
+def lookupCurrencyId(slug):
+    """Return the ID associated with the passed slug, from the cache."""
+    return currencyCache.get(slug)
+
+
+def marketCapSource(lookbackDays):
+    """Return (table, extra condition) holding a lookback's market caps."""
+    if storageLayout == 'partitioned':
+        return tables['market_cap'], "AND lookback = {0}".format(
+            int(lookbackDays))
+    return tables["market_cap_{0}".format(lookbackDays)], ""
+
+
+@_pooled
+def selectCoverage(lookbacks):
+    """Select the first and last time stored per currency slug and
+    lookback, as {slug: {lookback: (first, last)}}."""
+    cur = cursor()
+    cur.execute(" UNION ALL ".join(
+        """(SELECT c.slug, {0},
+            (SELECT MIN(time) FROM {2} WHERE currency = c.id {3}),
+            (SELECT MAX(time) FROM {2} WHERE currency = c.id {3})
+        FROM {1} c)""".format(
+            lookback, tables['currency'], *marketCapSource(lookback))
+        for lookback in lookbacks))
+    coverage = {}
+    for slug, lookback, first, last in cur.fetchall():
+        if first is not None:
+            coverage.setdefault(slug, {})[lookback] = (first, last)
+    return coverage
+
+
+@_pooled
+def selectFingerprints():
+    """Select the last loaded payload digest per (slug, lookback)."""
+    cur = cursor()
+    cur.execute("""SELECT slug, lookback, digest FROM {0}""".format(
+        tables['payload_fingerprint']))
+    return dict(((row[0], row[1]), row[2]) for row in cur.fetchall())
+
+
+@_pooled
+def upsertFingerprints(fingerprints):
+    """Record the digests of the payloads last loaded, given as
+    (slug, lookback, digest) tuples."""
+    if len(fingerprints) == 0:
+        return
+    cur = cursor()
+    cur.execute("""
+        INSERT INTO {0} (slug, lookback, digest)
+        VALUES {1}
+        ON CONFLICT (slug, lookback) DO UPDATE
+        SET digest = EXCLUDED.digest,
+            db_update_time = EXCLUDED.db_update_time""".format(
+        tables['payload_fingerprint'],
+        ",".join(cur.mogrify("(%s, %s, %s)", fingerprint)
+                 for fingerprint in dict(
+                     ((slug, lookback), (slug, lookback, digest))
+                     for slug, lookback, digest in fingerprints).values())))
+    cur.execute("""COMMIT""")
+
+
+def upsertFingerprint(slug, lookback, digest):
+    """Record the digest of the payload last loaded for (slug, lookback)."""
+    upsertFingerprints([(slug, lookback, digest)])
+
+
+@_pooled
+def selectSchedule():
+    """Select the refresh schedule as {(slug, lookback): (last fetch time,
+    next due time)}."""
+    cur = cursor()
+    cur.execute("""
+        SELECT slug, lookback, last_fetch_time, next_due_time
+        FROM {0}""".format(tables['refresh_schedule']))
+    return dict(((row[0], row[1]), (row[2], row[3]))
+                for row in cur.fetchall())
+
+
+@_pooled
+def upsertSchedule(entries):
+    """Record refresh schedule entries, given as (slug, lookback, last fetch
+    time, next due time, interval seconds) tuples."""
+    if len(entries) == 0:
+        return
+    cur = cursor()
+    cur.execute("""
+        INSERT INTO {0} (slug, lookback, last_fetch_time, next_due_time,
+            interval_seconds)
+        VALUES {1}
+        ON CONFLICT (slug, lookback) DO UPDATE
+        SET last_fetch_time = EXCLUDED.last_fetch_time,
+            next_due_time = EXCLUDED.next_due_time,
+            interval_seconds = EXCLUDED.interval_seconds""".format(
+        tables['refresh_schedule'],
+        ",".join(cur.mogrify("(%s, %s, %s, %s, %s)", entry)
+                 for entry in entries)))
+    cur.execute("""COMMIT""")
+
+
+@_pooled
+def selectRefreshMetrics(lookbackDays, volatilityDays):
+    """Select {slug: (rank, volatility)} per currency with data.
+
+    The rank is by the latest market_cap_by_available_supply stored for
+    lookbackDays, and the volatility the standard deviation of the hourly
+    log returns of price_usd over the volatilityDays up to the latest
+    hourly close (None if there are too few).
+    """
+    table, condition = marketCapSource(lookbackDays)
+    cur = cursor()
+    cur.execute("""
+        WITH latest AS (
+            SELECT c.id, c.slug,
+                (SELECT market_cap_by_available_supply
+                FROM {1}
+                WHERE currency = c.id {2}
+                ORDER BY time DESC
+                LIMIT 1) AS cap
+            FROM {0} c),
+        returns AS (
+            SELECT currency,
+                LN(close/NULLIF(LAG(close) OVER (
+                    PARTITION BY currency ORDER BY bucket), 0)) AS ret
+            FROM {3}
+            WHERE lookback = %s AND close > 0
+            AND bucket >= (SELECT MAX(bucket) FROM {3}
+                WHERE lookback = %s) - %s * INTERVAL '1 day'),
+        volatility AS (
+            SELECT currency, STDDEV(ret) AS volatility
+            FROM returns
+            GROUP BY currency)
+        SELECT latest.slug,
+            RANK() OVER (ORDER BY latest.cap DESC),
+            volatility.volatility::float8
+        FROM latest
+        LEFT JOIN volatility ON volatility.currency = latest.id
+        WHERE latest.cap IS NOT NULL""".format(
+        tables['currency'], table, condition, tables['market_cap_hourly']),
+        (lookbackDays, lookbackDays, volatilityDays))
+    return dict((row[0], (row[1], row[2])) for row in cur.fetchall())
+
+
+@_pooled
+def createRun(abandon=True):
+    """Start a scrape run, abandoning any unfinished one unless told not
+    to, and return its ID."""
+    cur = cursor()
+    if abandon:
+        cur.execute("""
+            UPDATE {0}
+            SET status = 'abandoned', finish_time = current_timestamp
+            WHERE status = 'running'""".format(tables['scrape_run']))
+    cur.execute("""
+        INSERT INTO {0} DEFAULT VALUES
+        RETURNING id""".format(tables['scrape_run']))
+    runId = cur.fetchone()[0]
+    cur.execute("""COMMIT""")
+    return runId
+
+
+@_pooled
+def selectUnfinishedRun():
+    """Select the ID of the latest run still running, or None."""
+    cur = cursor()
+    cur.execute("""
+        SELECT MAX(id) FROM {0}
+        WHERE status = 'running'""".format(tables['scrape_run']))
+    return cur.fetchone()[0]
+
+
+@_pooled
+def selectRunEnumerated(runId):
+    """Tell whether all the jobs of a run have been recorded."""
+    cur = cursor()
+    cur.execute("""
+        SELECT enumerated FROM {0}
+        WHERE id = %s""".format(tables['scrape_run']), (runId,))
+    return cur.fetchone()[0]
+
+
+@_pooled
+def markRunEnumerated(runId):
+    """Mark all the jobs of a run recorded."""
+    cur = cursor()
+    cur.execute("""
+        UPDATE {0}
+        SET enumerated = TRUE
+        WHERE id = %s""".format(tables['scrape_run']), (runId,))
+    cur.execute("""COMMIT""")
+
+
+@_pooled
+def finishRun(runId):
+    """Mark a run finished."""
+    cur = cursor()
+    cur.execute("""
+        UPDATE {0}
+        SET status = 'finished', finish_time = current_timestamp
+        WHERE id = %s""".format(tables['scrape_run']), (runId,))
+    cur.execute("""COMMIT""")
+
+
+@_pooled
+def insertJobs(runId, jobs):
+    """Record (slug, lookback, includeVolume) jobs of a run as pending,
+    numbered after the run's jobs recorded before so that they are claimed
+    and resumed in the order given. Jobs already recorded are left alone.
+    Returns the (slug, lookback) of the jobs recorded."""
+    if len(jobs) == 0:
+        return []
+    cur = cursor()
+    cur.execute("""
+        INSERT INTO {0} (run_id, slug, lookback, include_volume, seq)
+        (SELECT %s, v.slug, v.lookback, v.include_volume, last.seq + v.seq
+        FROM (VALUES {1}) AS v (slug, lookback, include_volume, seq),
+            (SELECT COALESCE(MAX(seq), 0) AS seq
+            FROM {0} WHERE run_id = %s) last)
+        ON CONFLICT DO NOTHING
+        RETURNING slug, lookback""".format(
+        tables['scrape_job'],
+        ",".join(cur.mogrify("(%s, %s::integer, %s::boolean, %s::integer)",
+                             tuple(job) + (seq,))
+                 for seq, job in enumerate(jobs, 1))),
+        (runId, runId))
+    recorded = cur.fetchall()
+    cur.execute("""COMMIT""")
+    return sorted(recorded)
+
+
+@_pooled
+def updateJobs(runId, statuses, worker=None):
+    """Record the status of jobs of a run, given as (slug, lookback,
+    status) tuples. If a worker is given, only jobs it still holds a claim
+    on are updated. Returns the number of jobs updated."""
+    if len(statuses) == 0:
+        return 0
+    cur = cursor()
+    cur.execute("""
+        UPDATE {0} job
+        SET status = v.status, db_update_time = current_timestamp
+        FROM (VALUES {1}) AS v (slug, lookback, status)
+        WHERE job.run_id = %s
+        AND job.slug = v.slug AND job.lookback = v.lookback
+        {2}""".format(
+        tables['scrape_job'],
+        ",".join(cur.mogrify("(%s, %s::integer, %s)", status)
+                 for status in statuses),
+        "AND job.worker = %s AND job.status = 'claimed'"
+        if worker is not None else ""),
+        (runId, worker) if worker is not None else (runId,))
+    countUpdated = cur.rowcount
+    cur.execute("""COMMIT""")
+    return countUpdated
+
+
+@_pooled
+def claimJobs(worker, count, leaseSeconds, maxAttempts):
+    """Claim up to count jobs of running runs for a worker.
+
+    Pending jobs are claimed first, then jobs whose lease expired (their
+    worker stopped heartbeating) or that failed, if they have had fewer
+    than maxAttempts, each in the order they were recorded. Rows locked by
+    other claims are skipped rather than waited on. Returns (run ID, slug,
+    lookback, includeVolume) tuples in that order, by run.
+    """
+    cur = cursor()
+    cur.execute("""
+        WITH claimable AS (
+            SELECT job.run_id, job.slug, job.lookback
+            FROM {0} job
+            JOIN {1} run ON run.id = job.run_id
+            WHERE run.status = 'running'
+            AND ((job.status = 'pending' AND job.worker IS NULL) OR
+                ((job.status = 'failed' OR
+                    (job.status = 'claimed' AND
+                        job.lease_until < current_timestamp)) AND
+                    job.attempt < %s))
+            ORDER BY job.worker IS NOT NULL, job.run_id, job.seq
+            LIMIT %s
+            FOR UPDATE OF job SKIP LOCKED)
+        UPDATE {0} job
+        SET status = 'claimed', worker = %s,
+            attempt = job.attempt + CASE WHEN job.worker IS NULL AND
+                job.status = 'pending' THEN 0 ELSE 1 END,
+            lease_until = current_timestamp + %s * INTERVAL '1 second',
+            heartbeat_time = current_timestamp,
+            db_update_time = current_timestamp
+        FROM claimable
+        WHERE job.run_id = claimable.run_id
+        AND job.slug = claimable.slug AND job.lookback = claimable.lookback
+        RETURNING job.run_id, job.seq, job.slug, job.lookback,
+            job.include_volume""".format(
+        tables['scrape_job'], tables['scrape_run']),
+        (maxAttempts, count, worker, leaseSeconds))
+    jobs = cur.fetchall()
+    cur.execute("""COMMIT""")
+    return [(job[0],) + job[2:] for job in sorted(jobs)]
+
+
+@_pooled
+def heartbeatJobs(worker, leaseSeconds):
+    """Extend the leases of the jobs a worker holds. Returns their
+    number."""
+    cur = cursor()
+    cur.execute("""
+        UPDATE {0}
+        SET lease_until = current_timestamp + %s * INTERVAL '1 second',
+            heartbeat_time = current_timestamp
+        WHERE worker = %s AND status = 'claimed'""".format(
+        tables['scrape_job']), (leaseSeconds, worker))
+    countHeld = cur.rowcount
+    cur.execute("""COMMIT""")
+    return countHeld
+
+
+@_pooled
+def finishDrainedRuns(maxAttempts):
+    """Mark running runs with no job left to claim or finish finished.
+    Returns their IDs.
+
+    Claimed jobs whose lease expired after their last attempt (their
+    worker died on each of them) are given up on as failed first, since
+    they can't be claimed again.
+    """
+    cur = cursor()
+    cur.execute("""
+        UPDATE {0}
+        SET status = 'failed', db_update_time = current_timestamp
+        WHERE status = 'claimed' AND lease_until < current_timestamp
+        AND attempt >= %s""".format(tables['scrape_job']), (maxAttempts,))
+    cur.execute("""
+        UPDATE {0} run
+        SET status = 'finished', finish_time = current_timestamp
+        WHERE run.status = 'running'
+        AND NOT EXISTS (
+            SELECT 1 FROM {1} job
+            WHERE job.run_id = run.id
+            AND (job.status IN ('pending', 'claimed') OR
+                (job.status = 'failed' AND job.attempt < %s)))
+        RETURNING run.id""".format(
+        tables['scrape_run'], tables['scrape_job']), (maxAttempts,))
+    runIds = [row[0] for row in cur.fetchall()]
+    cur.execute("""COMMIT""")
+    return runIds
+
+
+@_pooled
+def resumeJobs(runId, maxAttempts):
+    """Start another attempt at the pending and failed jobs of a run that
+    have had fewer than maxAttempts, returning them as (slug, lookback,
+    includeVolume, previous status) tuples in the order they were
+    recorded."""
+    cur = cursor()
+    cur.execute("""
+        WITH resumed AS (
+            SELECT slug, lookback, status
+            FROM {0}
+            WHERE run_id = %s AND status IN ('pending', 'failed')
+            AND attempt < %s
+            FOR UPDATE)
+        UPDATE {0} job
+        SET status = 'pending', attempt = attempt + 1,
+            db_update_time = current_timestamp
+        FROM resumed
+        WHERE job.run_id = %s
+        AND job.slug = resumed.slug AND job.lookback = resumed.lookback
+        RETURNING job.seq, job.slug, job.lookback, job.include_volume,
+            resumed.status""".format(tables['scrape_job']),
+        (runId, maxAttempts, runId))
+    jobs = cur.fetchall()
+    cur.execute("""COMMIT""")
+    return [job[1:] for job in sorted(jobs)]
+
+
 class PgTest(unittest.TestCase):
 
     """Testing suite for pg module."""
@@ -231,13 +1328,22 @@ class PgTest(unittest.TestCase):
         global batchLimit
         self.batchLimitOriginal = batchLimit
         batchLimit = 20
+        currencyCache.invalidate()
+        partitions.clear()
 
-        # Create test tables
+        # Create test tables (the consolidated market cap table only if the
+        # partitioned layout has been created)
         cur = cursor()
+        cur.execute("""SELECT to_regclass(%s) IS NOT NULL""",
+                    (self.tablesOriginal['market_cap'],))
+        self.hasPartitioned = cur.fetchone()[0]
         for key, table in tables.iteritems():
+            if key == 'market_cap' and not self.hasPartitioned:
+                continue
             cur.execute("""CREATE TABLE IF NOT EXISTS
-                {0} (LIKE {1} INCLUDING ALL)""".format(
-                table, self.tablesOriginal[key]))
+                {0} (LIKE {1} INCLUDING ALL) {2}""".format(
+                table, self.tablesOriginal[key],
+                "PARTITION BY RANGE (time)" if key == 'market_cap' else ""))
         cur.execute("""CREATE SEQUENCE {0}_id_seq""".format(
             tables['currency']))
         cur.execute("""ALTER TABLE {0}
@@ -350,6 +1456,199 @@ class PgTest(unittest.TestCase):
         insertCurrencyList([datum], withHistory=False)
         self.assertEqual(selectCurrencyId('bitcoin'), 1)
 
+    def testLookupCurrencyId(self):
+        """Test lookupCurrencyId and the currency cache."""
+        datum = {
+            'name': 'Bitcoin',
+            'slug': 'bitcoin',
+            'symbol': 'BTC',
+            'explorer_link': 'http://blockchain.info'
+        }
+        insertCurrencyList([datum], withHistory=False)
+        self.assertEqual(lookupCurrencyId('bitcoin'), 1)
+        self.assertRaises(Exception, lookupCurrencyId, 'navajo')
+
+        # Merging in a new slug updates the loaded cache
+        datum = dict(datum, name='Navajo', slug='navajo', symbol='NAV')
+        insertCurrencyList([datum], withHistory=False)
+        self.assertEqual(currencyCache._ids, {'bitcoin': 1, 'navajo': 2})
+        self.assertEqual(lookupCurrencyId('navajo'), 2)
+
+        # Slugs inserted elsewhere are picked up on a miss
+        cur = cursor()
+        cur.execute("""INSERT INTO {0} (name, symbol, slug)
+            VALUES ('Marscoin', 'MRS', 'marscoin')""".format(
+            tables['currency']))
+        cur.execute("""COMMIT""")
+        self.assertEqual(lookupCurrencyId('marscoin'), 3)
+
+    def testFingerprints(self):
+        """Test selectFingerprints and upsertFingerprint functions."""
+        self.assertEqual(selectFingerprints(), {})
+        upsertFingerprint('navajo', 7, 'a'*40)
+        upsertFingerprint('navajo', 30, 'b'*40)
+        upsertFingerprints([('navajo', 7, 'c'*40), ('bitcoin', 7, 'd'*40),
+                            ('bitcoin', 7, 'e'*40)])
+        self.assertEqual(selectFingerprints(), {
+            ('navajo', 7): 'c'*40,
+            ('navajo', 30): 'b'*40,
+            ('bitcoin', 7): 'e'*40
+        })
+
+    def testRuns(self):
+        """Test the run and job functions."""
+        cur = cursor()
+        cur.execute("""CREATE SEQUENCE {0}_id_seq""".format(
+            tables['scrape_run']))
+        cur.execute("""ALTER TABLE {0}
+            ALTER COLUMN id SET DEFAULT
+            nextval('{0}_id_seq'::regclass)""".format(tables['scrape_run']))
+        cur.execute("""COMMIT""")
+        try:
+            self.assertEqual(selectUnfinishedRun(), None)
+            first = createRun()
+            self.assertEqual(selectUnfinishedRun(), first)
+            insertJobs(first, [('bitcoin', 365, True), ('bitcoin', 7, False),
+                               ('navajo', 7, False)])
+            updateJobs(first, [('bitcoin', 365, 'done'),
+                               ('bitcoin', 7, 'failed')])
+            self.assertEqual(resumeJobs(first, 3), [
+                ('bitcoin', 7, False, 'failed'),
+                ('navajo', 7, False, 'pending')])
+            updateJobs(first, [('bitcoin', 7, 'failed')])
+            self.assertEqual(resumeJobs(first, 3), [
+                ('bitcoin', 7, False, 'failed'),
+                ('navajo', 7, False, 'pending')])
+
+            # Jobs are given up on after maxAttempts
+            self.assertEqual(resumeJobs(first, 3), [])
+
+            # Only jobs not recorded yet are, until the run is enumerated
+            self.assertEqual(insertJobs(first, [('navajo', 7, False),
+                                                ('navajo', 30, False)]),
+                             [('navajo', 30)])
+            self.assertEqual(selectRunEnumerated(first), False)
+            markRunEnumerated(first)
+            self.assertEqual(selectRunEnumerated(first), True)
+
+            # A new run abandons the unfinished one
+            second = createRun()
+            self.assertEqual(selectUnfinishedRun(), second)
+            finishRun(second)
+            self.assertEqual(selectUnfinishedRun(), None)
+            cur.execute("""SELECT id, status FROM {0}
+                ORDER BY id""".format(tables['scrape_run']))
+            self.assertEqual(cur.fetchall(), [
+                (first, 'abandoned'), (second, 'finished')])
+        finally:
+            cur.execute("""ROLLBACK""")
+            cur.execute("""DROP TABLE {0}""".format(tables['scrape_run']))
+            cur.execute("""DROP SEQUENCE {0}_id_seq""".format(
+                tables['scrape_run']))
+            cur.execute("""COMMIT""")
+
+    def testClaimJobs(self):
+        """Test claims, leases and drained runs of the job queue."""
+        first = createRun()
+        second = createRun(abandon=False)
+        insertJobs(first, [('bitcoin', 7, False), ('navajo', 7, False)])
+        insertJobs(second, [('bitcoin', 30, False)])
+        self.assertEqual(claimJobs('a', 2, 300, 3), [
+            (first, 'bitcoin', 7, False), (first, 'navajo', 7, False)])
+        self.assertEqual(claimJobs('b', 2, 0, 3), [
+            (second, 'bitcoin', 30, False)])
+        self.assertEqual(heartbeatJobs('a', 300), 2)
+
+        # b's lease ran out, so its job goes to a and b's status is ignored
+        self.assertEqual(claimJobs('a', 2, 300, 3), [
+            (second, 'bitcoin', 30, False)])
+        self.assertEqual(updateJobs(second, [('bitcoin', 30, 'done')],
+                                    worker='b'), 0)
+        self.assertEqual(updateJobs(first, [('bitcoin', 7, 'done'),
+                                            ('navajo', 7, 'failed')],
+                                    worker='a'), 2)
+        self.assertEqual(finishDrainedRuns(3), [])
+
+        # Failed jobs are claimed again until maxAttempts
+        for attempt in [2, 3]:
+            self.assertEqual(claimJobs('b', 2, 300, 3), [
+                (first, 'navajo', 7, False)])
+            updateJobs(first, [('navajo', 7, 'failed')], worker='b')
+        self.assertEqual(claimJobs('b', 2, 300, 3), [])
+        self.assertEqual(finishDrainedRuns(3), [first])
+        updateJobs(second, [('bitcoin', 30, 'done')], worker='a')
+        self.assertEqual(finishDrainedRuns(3), [second])
+
+    def testClaimJobsDeadWorkers(self):
+        """Test that a job whose worker dies on every attempt is given up
+        on, so that its run finishes."""
+        runId = createRun(abandon=False)
+        insertJobs(runId, [('navajo', 7, False)])
+        for worker in ['a', 'b', 'c']:
+            self.assertEqual(claimJobs(worker, 1, 0, 3), [
+                (runId, 'navajo', 7, False)])
+        self.assertEqual(claimJobs('d', 1, 0, 3), [])
+        self.assertEqual(finishDrainedRuns(3), [runId])
+        cur = cursor()
+        cur.execute("""SELECT status, attempt FROM {0}""".format(
+            tables['scrape_job']))
+        self.assertEqual(cur.fetchall(), [('failed', 3)])
+        cur.execute("""COMMIT""")
+        self.assertEqual(selectUnfinishedRun(), None)
+
+    def testClaimJobsInOrder(self):
+        """Test that jobs are claimed and resumed in the order recorded."""
+        runId = createRun(abandon=False)
+        insertJobs(runId, [('navajo', 30, False), ('bitcoin', 7, False)])
+        insertJobs(runId, [('navajo', 7, False), ('aurora', 365, True)])
+        self.assertEqual(claimJobs('a', 3, 300, 3), [
+            (runId, 'navajo', 30, False), (runId, 'bitcoin', 7, False),
+            (runId, 'navajo', 7, False)])
+        self.assertEqual(claimJobs('a', 3, 300, 3), [
+            (runId, 'aurora', 365, True)])
+        updateJobs(runId, [('navajo', 30, 'failed'), ('bitcoin', 7, 'failed'),
+                           ('navajo', 7, 'failed'), ('aurora', 365, 'failed')])
+        self.assertEqual([job[:2] for job in resumeJobs(runId, 3)], [
+            ('navajo', 30), ('bitcoin', 7), ('navajo', 7), ('aurora', 365)])
+
+    def testSchedule(self):
+        """Test selectSchedule, upsertSchedule and selectRefreshMetrics."""
+        due = datetime(2016, 1, 2)
+        upsertSchedule([('navajo', 7, datetime(2016, 1, 1), due, 86400.0)])
+        upsertSchedule([('navajo', 7, due, datetime(2016, 1, 3), 86400.0),
+                        ('bitcoin', 7, due, due, 0.0)])
+        self.assertEqual(selectSchedule(), {
+            ('navajo', 7): (due, datetime(2016, 1, 3)),
+            ('bitcoin', 7): (due, due)})
+
+        # Navajo ranks below bitcoin, and its volatility is that of its
+        # hourly closes
+        cur = cursor()
+        cur.execute("""INSERT INTO {0} (id, slug)
+            VALUES (9, 'navajo'), (10, 'bitcoin'), (11, 'dead')""".format(
+            tables['currency']))
+        cur.execute("""COMMIT""")
+        f = open("{0}/example/marketcap_navajo_7d.json".format(
+            os.path.dirname(os.path.abspath(__file__))), 'r')
+        data = coinmarketcap.parseMarketCap(f.read(), 9)
+        f.close()
+        insertMarketCap(data, 7)
+        insertMarketCap([dict(data[-1], currency=10,
+                              market_cap_by_available_supply=1e10)], 7)
+        metrics = selectRefreshMetrics(7, 7)
+        self.assertEqual(sorted(metrics.keys()), ['bitcoin', 'navajo'])
+        self.assertEqual(metrics['bitcoin'], (1, None))
+        self.assertEqual(metrics['navajo'][0], 2)
+        closes = {}
+        for datum in data:
+            closes[datum['time'].replace(minute=0, second=0)] = (
+                datum['price_usd'])
+        closes = [close for hour, close in sorted(closes.items())]
+        returns = [math.log(b/a) for a, b in zip(closes, closes[1:])]
+        mean = sum(returns)/len(returns)
+        self.assertAlmostEqual(metrics['navajo'][1], math.sqrt(
+            sum((ret - mean)**2 for ret in returns)/(len(returns) - 1)))
+
     def testInsertMarketCap(self):
         """Test insertMarketCap and insertMarketCapVolume functions."""
         f = open("{0}/example/marketcap_navajo_7d.json".format(
@@ -438,5 +1737,375 @@ class PgTest(unittest.TestCase):
         }
         self.assertEqual(datumVolLast, expectedVolLast)
 
+        # Reloads only write rows that are new or changed
+        self.assertEqual(insertMarketCap(data, 7), {
+            'inserted': 0, 'updated': 0, 'untouched': 287})
+        data[0]['price_usd'] = 0.5
+        data[1]['price_btc'] = None
+        extra = dict(data[-1])
+        extra['time'] = datetime.utcfromtimestamp(1407458054)
+        self.assertEqual(insertMarketCap(data + [extra], 7), {
+            'inserted': 1, 'updated': 2, 'untouched': 285})
+        cur.execute("""SELECT price_usd, price_btc
+            FROM {0}
+            ORDER BY currency, time
+            ASC LIMIT 2""".format(
+            tables['market_cap_7']))
+        self.assertEqual(cur.fetchall(), [
+            {'price_usd': Decimal('0.5'),
+                'price_btc': Decimal('.00000588286')},
+            {'price_usd': Decimal('0.00343028'), 'price_btc': None}])
+        self.assertEqual(insertMarketCapVolume(volData), {
+            'inserted': 0, 'updated': 0, 'untouched': 7})
+
+    def testBulkLoadMethods(self):
+        """Test that COPY and executemany staging load the same rows."""
+        f = open("{0}/example/marketcap_navajo_7d.json".format(
+            os.path.dirname(os.path.abspath(__file__))), 'r')
+        jsonDump = f.read()
+        f.close()
+        data = coinmarketcap.parseMarketCap(jsonDump, 9)
+        global bulkLoadMethod
+        bulkLoadMethodOriginal = bulkLoadMethod
+        try:
+            bulkLoadMethod = 'executemany'
+            insertMarketCap(data, 30)
+            bulkLoadMethod = 'copy'
+            insertMarketCap(data, 7)
+        finally:
+            bulkLoadMethod = bulkLoadMethodOriginal
+        self.assertEqual(loadStats['copy']['rows'] >= 287, True)
+        self.assertEqual(loadStats['executemany']['rows'] >= 287, True)
+
+        cur = dictCursor()
+        query = """SELECT currency, time, market_cap_by_available_supply,
+                market_cap_by_total_supply, price_usd, price_btc,
+                est_available_supply, est_total_supply
+            FROM {0}
+            ORDER BY currency, time"""
+        cur.execute(query.format(tables['market_cap_7']))
+        rowsCopy = cur.fetchall()
+        cur.execute(query.format(tables['market_cap_30']))
+        rowsExecutemany = cur.fetchall()
+        self.assertEqual(len(rowsCopy), 287)
+        self.assertEqual(rowsCopy, rowsExecutemany)
+
+    def testParallelWriters(self):
+        """Test concurrent loads through the pool, including from a fork."""
+        f = open("{0}/example/marketcap_navajo_7d.json".format(
+            os.path.dirname(os.path.abspath(__file__))), 'r')
+        jsonDump = f.read()
+        f.close()
+        errors = []
+
+        def load(currency):
+            try:
+                data = coinmarketcap.parseMarketCap(jsonDump, currency)
+                insertMarketCap(data, 7)
+                insertMarketCap(data, 30)
+            except Exception as e:
+                errors.append(e)
+
+        global pool
+        global poolMaxSize
+        poolMaxSizeOriginal = poolMaxSize
+        getPool().closeall()
+        pool = None
+        poolMaxSize = 2
+        try:
+            threads = [threading.Thread(target=load, args=(currency,))
+                       for currency in range(6)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(errors, [])
+            self.assertEqual(getPool().size <= 2, True)
+
+            # A forked worker opens its own connections, leaving the parent's
+            # pooled connections usable
+            process = multiprocessing.Process(target=load, args=(6,))
+            process.start()
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+            load(7)
+            self.assertEqual(errors, [])
+        finally:
+            getPool().closeall()
+            pool = None
+            poolMaxSize = poolMaxSizeOriginal
+
+        cur = dictCursor()
+        for lookback in [7, 30]:
+            cur.execute("""SELECT COUNT(*) cnt, COUNT(DISTINCT currency) cur
+                FROM {0}""".format(tables['market_cap_{0}'.format(lookback)]))
+            self.assertEqual(cur.fetchone(), {'cnt': 287*8, 'cur': 8})
+
+    def testWriteBehind(self):
+        """Test the write-behind buffer."""
+        f = open("{0}/example/marketcap_navajo_7d.json".format(
+            os.path.dirname(os.path.abspath(__file__))), 'r')
+        jsonDump = f.read()
+        f.close()
+        flushed = []
+        cur = dictCursor()
+
+        def count():
+            cur.execute("""SELECT COUNT(*) cnt FROM {0}""".format(
+                tables['market_cap_7']))
+            return cur.fetchone()['cnt']
+
+        # Rows from several currencies are held until the row threshold
+        buf = WriteBehindBuffer(maxRows=600, maxAge=3600)
+        for currency in range(2):
+            buf.add(coinmarketcap.parseMarketCap(jsonDump, currency),
+                    tables['market_cap_7'],
+                    lambda currency=currency: flushed.append(currency))
+        self.assertEqual((count(), flushed), (0, []))
+
+        # A later row for the same key replaces the buffered one
+        data = coinmarketcap.parseMarketCap(jsonDump, 1)
+        data[0]['price_usd'] = 0.5
+        buf.add(data, tables['market_cap_7'])
+        self.assertEqual(count(), 0)
+        columns = coinmarketcap.parseMarketCapColumns(jsonDump, 2)
+        buf.add(columns, tables['market_cap_7'],
+                lambda: flushed.append(2))
+        self.assertEqual((count(), flushed), (287*3, [0, 1, 2]))
+        self.assertEqual((buf.flushes, buf.counts['inserted']), (1, 287*3))
+        cur.execute("""SELECT price_usd FROM {0}
+            WHERE currency = 1 ORDER BY time LIMIT 1""".format(
+            tables['market_cap_7']))
+        self.assertEqual(cur.fetchone()['price_usd'], Decimal('0.5'))
+
+        # Rows are flushed once old enough, and on close
+        buf.maxAge = 0
+        buf.add(coinmarketcap.parseMarketCap(jsonDump, 3),
+                tables['market_cap_7'])
+        self.assertEqual(count(), 287*4)
+        buf.maxAge = 3600
+        buf.add(coinmarketcap.parseMarketCap(jsonDump, 4),
+                tables['market_cap_7'], lambda: flushed.append(4))
+        self.assertEqual(count(), 287*4)
+        buf.close()
+        self.assertEqual((count(), flushed), (287*5, [0, 1, 2, 4]))
+
+        # Old rows are flushed by the timer without another add
+        buf = WriteBehindBuffer(maxRows=600, maxAge=0.2)
+        buf.add(coinmarketcap.parseMarketCap(jsonDump, 5),
+                tables['market_cap_7'], lambda: flushed.append(5))
+        waited = 0
+        while 5 not in flushed and waited < 50:
+            time.sleep(0.1)
+            waited += 1
+        self.assertEqual((count(), flushed), (287*6, [0, 1, 2, 4, 5]))
+        buf.close()
+
+        # A failed merge doesn't take the other tables' rows with it
+        buf = WriteBehindBuffer(maxRows=600, maxAge=3600)
+        buf.add(coinmarketcap.parseMarketCap(jsonDump, 6),
+                tables['market_cap_7'], lambda: flushed.append(6))
+        buf.add(coinmarketcap.parseMarketCap(jsonDump, 6),
+                "{0}_missing".format(tables['market_cap_7']),
+                lambda: flushed.append('missing'))
+        self.assertRaises(pg2.ProgrammingError, buf.flush)
+        self.assertEqual((count(), flushed), (287*7, [0, 1, 2, 4, 5, 6]))
+        buf.close()
+
+    def testInsertMarketCapColumns(self):
+        """Test insertMarketCap with columnar data and compact rows."""
+        f = open("{0}/example/marketcap_navajo_7d.json".format(
+            os.path.dirname(os.path.abspath(__file__))), 'r')
+        jsonDump = f.read()
+        f.close()
+        data = coinmarketcap.parseMarketCap(jsonDump, 9)
+        columns, volColumns = coinmarketcap.parseMarketCapColumns(
+            jsonDump, 9, includeVolume=True)
+        rows, volRows = coinmarketcap.parseMarketCap(
+            jsonDump, 9, includeVolume=True, compact=True)
+        insertMarketCap(columns, 7)
+        insertMarketCap(data, 30)
+        insertMarketCap(rows, 90)
+        insertMarketCapVolume(volColumns)
+        self.assertEqual(insertMarketCapVolume(volRows)['untouched'], 7)
+
+        # Columnar, compact and row inserts give identical tables
+        cur = dictCursor()
+        query = """SELECT currency, time, market_cap_by_available_supply,
+                market_cap_by_total_supply, price_usd, price_btc,
+                est_available_supply, est_total_supply
+            FROM {0}
+            ORDER BY currency, time"""
+        cur.execute(query.format(tables['market_cap_7']))
+        rowsColumns = cur.fetchall()
+        cur.execute(query.format(tables['market_cap_30']))
+        rowsData = cur.fetchall()
+        self.assertEqual(len(rowsColumns), 287)
+        self.assertEqual(rowsColumns, rowsData)
+        cur.execute(query.format(tables['market_cap_90']))
+        self.assertEqual(cur.fetchall(), rowsData)
+        cur.execute("""SELECT COUNT(*) cnt FROM {0}""".format(
+            tables['trade_volume_usd']))
+        self.assertEqual(cur.fetchone()['cnt'], 7)
+
+    def testAppendMarketCap(self):
+        """Test appendMarketCap and selectTopCurrencies."""
+        f = open("{0}/example/marketcap_navajo_7d.json".format(
+            os.path.dirname(os.path.abspath(__file__))), 'r')
+        data = coinmarketcap.parseMarketCap(f.read(), 9)
+        f.close()
+        insertMarketCap(data[:100], 7)
+        self.assertEqual(appendMarketCap(data[90:110], 7), 10)
+        self.assertEqual(appendMarketCap([], 7), 0)
+        cur = dictCursor()
+        cur.execute("""SELECT COUNT(*) cnt FROM {0}""".format(
+            tables['market_cap_7']))
+        self.assertEqual(cur.fetchone()['cnt'], 110)
+
+        # Rollups match those of a merge of the same rows
+        cur.execute("""SELECT bucket, open, high, low, close, num_points
+            FROM {0} ORDER BY bucket""".format(tables['market_cap_hourly']))
+        appended = cur.fetchall()
+        insertMarketCap(data[:110], 30)
+        cur.execute("""SELECT bucket, open, high, low, close, num_points
+            FROM {0} WHERE lookback = 30 ORDER BY bucket""".format(
+            tables['market_cap_hourly']))
+        self.assertEqual(cur.fetchall(), appended)
+
+        # The top currencies are those with the largest latest market cap
+        cur.execute("""INSERT INTO {0} (id, slug)
+            VALUES (9, 'navajo'), (10, 'bitcoin'), (11, 'dead')""".format(
+            tables['currency']))
+        cur.execute("""COMMIT""")
+        appendMarketCap([dict(data[-1], currency=10,
+                              market_cap_by_available_supply=1e10)], 7)
+        self.assertEqual(selectTopCurrencies(5, 7), ['bitcoin', 'navajo'])
+        self.assertEqual(selectTopCurrencies(1, 7), ['bitcoin'])
+
+    def testSelectCoverage(self):
+        """Test selectCoverage."""
+        cur = cursor()
+        cur.execute("""INSERT INTO {0} (id, slug)
+            VALUES (9, 'navajo'), (10, 'bitcoin')""".format(
+            tables['currency']))
+        cur.execute("""COMMIT""")
+        f = open("{0}/example/marketcap_navajo_7d.json".format(
+            os.path.dirname(os.path.abspath(__file__))), 'r')
+        data = coinmarketcap.parseMarketCap(f.read(), 9)
+        f.close()
+        insertMarketCap(data, 7)
+        insertMarketCap(data[:10], 30)
+        self.assertEqual(selectCoverage([7, 30, 90]), {'navajo': {
+            7: (data[0]['time'], data[-1]['time']),
+            30: (data[0]['time'], data[9]['time'])}})
+
+    def testRollups(self):
+        """Test that loads maintain the hourly and daily rollups."""
+        f = open("{0}/example/marketcap_navajo_7d.json".format(
+            os.path.dirname(os.path.abspath(__file__))), 'r')
+        data, volData = coinmarketcap.parseMarketCap(
+            f.read(), 9, includeVolume=True)
+        f.close()
+        insertMarketCap(data, 7)
+        insertMarketCapVolume(volData)
+
+        # Candles match the ones computed from the parsed rows
+        hours = {}
+        for datum in data:
+            hours.setdefault(datum['time'].replace(
+                minute=0, second=0, microsecond=0), []).append(
+                datum['price_usd'])
+        cur = dictCursor()
+        query = """SELECT bucket, open, high, low, close, num_points,
+                db_update_time
+            FROM {0}
+            WHERE currency = 9 AND lookback = 7
+            ORDER BY bucket"""
+        cur.execute(query.format(tables['market_cap_hourly']))
+        hourly = cur.fetchall()
+        self.assertEqual(
+            [(row['bucket'], float(row['open']), float(row['high']),
+              float(row['low']), float(row['close']), row['num_points'])
+             for row in hourly],
+            [(hour, prices[0], max(prices), min(prices), prices[-1],
+              len(prices)) for hour, prices in sorted(hours.items())])
+        cur.execute(query.format(tables['market_cap_daily']))
+        daily = cur.fetchall()
+        self.assertEqual(sum(row['num_points'] for row in daily), len(data))
+        cur.execute("""SELECT bucket, volume FROM {0}
+            ORDER BY bucket""".format(tables['trade_volume_usd_daily']))
+        self.assertEqual(
+            [(row['bucket'].date(), float(row['volume']))
+             for row in cur.fetchall()],
+            [(datum['time'].date(), datum['volume']) for datum in volData])
+
+        # Only the bucket of a changed row is recomputed
+        cur.execute("""COMMIT""")
+        changed = dict(data[100], price_usd=Decimal('1'))
+        insertMarketCap([changed], 7)
+        cur.execute("""SELECT bucket, high FROM {0}
+            WHERE db_update_time > %s""".format(
+            tables['market_cap_hourly']),
+            (max(row['db_update_time'] for row in hourly),))
+        self.assertEqual(
+            cur.fetchall(),
+            [{'bucket': changed['time'].replace(minute=0, second=0),
+              'high': Decimal('1')}])
+
+        # Backfilling rebuilds the same rollups
+        insertMarketCap(data, 7)
+        cur.execute("""INSERT INTO {0} (id, slug)
+            VALUES (9, 'navajo')""".format(tables['currency']))
+        cur.execute("""DELETE FROM {0}""".format(
+            tables['market_cap_hourly']))
+        cur.execute("""DELETE FROM {0}""".format(
+            tables['market_cap_daily']))
+        cur.execute("""COMMIT""")
+        self.assertEqual(backfillRollups(tables['market_cap_7']), 1)
+        cur.execute(query.format(tables['market_cap_hourly']))
+        self.assertEqual(
+            [row['high'] for row in cur.fetchall()],
+            [row['high'] for row in hourly])
+        cur.execute(query.format(tables['market_cap_daily']))
+        self.assertEqual(
+            [row['close'] for row in cur.fetchall()],
+            [row['close'] for row in daily])
+
+    def testPartitionedLayout(self):
+        """Test market cap loads into the partitioned table."""
+        if not self.hasPartitioned:
+            self.skipTest("Partitioned layout not created.")
+        global storageLayout
+        storageLayoutOriginal = storageLayout
+        storageLayout = 'partitioned'
+        try:
+            f = open("{0}/example/marketcap_navajo_7d.json".format(
+                os.path.dirname(os.path.abspath(__file__))), 'r')
+            jsonDump = f.read()
+            f.close()
+            data = coinmarketcap.parseMarketCap(jsonDump, 9)
+            columns = coinmarketcap.parseMarketCapColumns(jsonDump, 9)
+            self.assertEqual(insertMarketCap(data, 7)['inserted'], 287)
+            self.assertEqual(insertMarketCap(columns, 30)['inserted'], 287)
+            self.assertEqual(insertMarketCap(data, 7)['untouched'], 287)
+            bufferMarketCap(data, 90)
+            writeBehind.flush()
+
+            # One partition per month of data, and every lookback kept apart
+            cur = dictCursor()
+            cur.execute("""SELECT COUNT(*) cnt FROM pg_inherits
+                WHERE inhparent = %s::regclass""", (tables['market_cap'],))
+            months = set((datum['time'].year, datum['time'].month)
+                         for datum in data)
+            self.assertEqual(cur.fetchone()['cnt'], len(months))
+            cur.execute("""SELECT lookback, COUNT(*) cnt FROM {0}
+                GROUP BY lookback ORDER BY lookback""".format(
+                tables['market_cap']))
+            self.assertEqual(
+                [(row['lookback'], row['cnt']) for row in cur.fetchall()],
+                [(7, 287), (30, 287), (90, 287)])
+        finally:
+            storageLayout = storageLayoutOriginal
+
 if __name__ == "__main__":
     unittest.main()
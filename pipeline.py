@@ -0,0 +1,233 @@
+"""Module for running items through stages connected by bounded queues."""
+import logging
+import Queue
+import sys
+import threading
+import time
+import traceback
+import unittest
+
+# Configuration variables
+queueSize = 16
+reportSeconds = 60
+
+# Marks the end of a stage's input
+_done = object()
+
+
+class Stage(object):
+
+    """Step of a pipeline run by threads over a bounded input queue.
+
+    function is called with each item and returns the item for the next
+    stage, or None to pass nothing on. A full queue blocks whoever feeds
+    it, so a slow stage holds back the ones before it instead of letting
+    items pile up in memory.
+    """
+
+    def __init__(self, name, function, threads=1, size=None):
+        """Create a stage of threads running function, fed by a queue of
+        size items (queueSize by default)."""
+        self.name = name
+        self.function = function
+        self.threads = threads
+        self.size = size or queueSize
+        self.queue = Queue.Queue(self.size)
+        self.next = None
+        self._lock = threading.Lock()
+        self._running = threads
+        self.stats = {'items': 0, 'failed': 0, 'busySeconds': 0.0,
+                      'maxDepth': 0, 'depthSum': 0}
+
+    def put(self, item):
+        """Queue an item, blocking while the queue is full."""
+        self.queue.put(item)
+
+    def _finish(self):
+        """End the next stage's input once every thread has finished."""
+        with self._lock:
+            self._running -= 1
+            last = self._running == 0
+        if last and self.next is not None:
+            for i in range(self.next.threads):
+                self.next.put(_done)
+
+    def work(self, stopping):
+        """Run items through function until the input ends, dropping them
+        unprocessed once stopping is set."""
+        try:
+            while True:
+                depth = self.queue.qsize()
+                item = self.queue.get()
+                if item is _done:
+                    return
+                if stopping.is_set():
+                    continue
+                started = time.time()
+                try:
+                    result = self.function(item)
+                except Exception:
+                    result = None
+                    sys.stdout.write("\n".join([
+                        '-'*60,
+                        "Stage {0} failed on an item.".format(self.name),
+                        traceback.format_exc(),
+                        '-'*60,
+                        '']))
+                    with self._lock:
+                        self.stats['failed'] += 1
+                with self._lock:
+                    self.stats['items'] += 1
+                    self.stats['busySeconds'] += time.time() - started
+                    self.stats['maxDepth'] = max(self.stats['maxDepth'],
+                                                 depth)
+                    self.stats['depthSum'] += depth
+                if result is not None and self.next is not None:
+                    self.next.put(result)
+        finally:
+            self._finish()
+
+    def summary(self, seconds):
+        """Return a description of the stage's work over seconds."""
+        stats = self.stats
+        return (
+            "Stage {0} ({1} threads): {2} items ({3} failed) at {4:.1f} "
+            "items/s, busy {5:.0%}, queue depth {6:.1f} on average and {7} "
+            "at most of {8}.".format(
+                self.name, self.threads, stats['items'], stats['failed'],
+                stats['items']/max(seconds, 1e-6),
+                stats['busySeconds']/max(seconds*self.threads, 1e-6),
+                float(stats['depthSum'])/max(stats['items'], 1),
+                stats['maxDepth'], self.size))
+
+
+class Pipeline(object):
+
+    """Chain of stages, each feeding the next, run until its input ends.
+
+    Every stage runs on its own threads, so a stage waiting on the network
+    overlaps with one busy parsing (in a process pool, say) and one waiting
+    on the database. The queue depth of every stage is logged every
+    reportSeconds while running and summarised at the end.
+    """
+
+    def __init__(self, stages):
+        """Create a pipeline of stages, in order."""
+        self.stages = stages
+        for stage, nextStage in zip(stages, stages[1:]):
+            stage.next = nextStage
+        self.stopping = threading.Event()
+        self.seconds = 0.0
+
+    def _report(self, finished):
+        """Log the queue depths every reportSeconds until finished."""
+        while not finished.wait(reportSeconds):
+            logging.info("Pipeline queues: {0}.".format(", ".join(
+                "{0} {1}/{2} ({3} done)".format(
+                    stage.name, stage.queue.qsize(), stage.size,
+                    stage.stats['items'])
+                for stage in self.stages)))
+
+    def run(self, items):
+        """Run items (possibly a generator) through the stages, returning
+        once all of them are through. On an error or interrupt while
+        feeding, queued items are dropped and the stages shut down."""
+        started = time.time()
+        threads = []
+        for stage in self.stages:
+            for i in range(stage.threads):
+                thread = threading.Thread(target=stage.work,
+                                          args=(self.stopping,))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+        finished = threading.Event()
+        reporter = threading.Thread(target=self._report, args=(finished,))
+        reporter.daemon = True
+        reporter.start()
+        first = self.stages[0]
+        try:
+            for item in items:
+                first.put(item)
+        except BaseException:
+            self.stopping.set()
+            raise
+        finally:
+            for i in range(first.threads):
+                first.put(_done)
+            for thread in threads:
+                # Wait in slices so that interrupts still get through
+                while thread.is_alive():
+                    thread.join(1)
+            finished.set()
+            reporter.join()
+            self.seconds = time.time() - started
+
+    def summary(self):
+        """Return a description of each stage's work, one line each."""
+        return [stage.summary(self.seconds) for stage in self.stages]
+
+
+class PipelineTest(unittest.TestCase):
+
+    """Testing suite for pipeline module."""
+
+    def testRun(self):
+        """Test that items go through every stage, skipping dropped ones
+        and failures."""
+        loaded = []
+
+        def parse(item):
+            if item == 3:
+                raise ValueError("Unparseable.")
+            return item*10 if item % 2 == 0 else None
+
+        stages = [Stage('fetch', lambda item: item, threads=3, size=2),
+                  Stage('parse', parse, threads=2, size=2),
+                  Stage('load', loaded.append, size=2)]
+        pipeline = Pipeline(stages)
+        pipeline.run(iter(range(20)))
+        self.assertEqual(sorted(loaded), range(0, 200, 20))
+        self.assertEqual([stage.stats['items'] for stage in stages],
+                         [20, 20, 10])
+        self.assertEqual(stages[1].stats['failed'], 1)
+        self.assertEqual(all(stage.stats['maxDepth'] <= 2
+                             for stage in stages), True)
+        self.assertEqual(len(pipeline.summary()), 3)
+
+    def testBackpressure(self):
+        """Test that a slow stage holds back the feeding of items."""
+        fed = []
+        release = threading.Event()
+
+        def items():
+            for item in range(10):
+                fed.append(item)
+                yield item
+
+        pipeline = Pipeline([Stage('fetch', lambda item: item, size=1),
+                             Stage('load', lambda item: release.wait(),
+                                   size=1)])
+        thread = threading.Thread(target=pipeline.run, args=(items(),))
+        thread.start()
+        time.sleep(0.2)
+        # One item in each queue and one in each stage, plus the next one
+        self.assertEqual(len(fed) <= 5, True)
+        release.set()
+        thread.join()
+        self.assertEqual(len(fed), 10)
+
+    def testStop(self):
+        """Test that an error while feeding shuts the stages down."""
+        processed = []
+
+        def items():
+            yield 1
+            raise KeyboardInterrupt()
+
+        pipeline = Pipeline([Stage('load', processed.append, threads=2)])
+        self.assertRaises(KeyboardInterrupt, pipeline.run, items())
+        self.assertEqual(pipeline.stopping.is_set(), True)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,151 @@
+"""Module for planning which market cap lookbacks need fetching."""
+from datetime import datetime
+from datetime import timedelta
+import pg
+import unittest
+
+# Configuration variables
+freshFraction = 0.1
+listingMargin = timedelta(days=1)
+volumeLookback = 365
+
+
+class FetchPlan(object):
+
+    """Plan of the (slug, lookback, includeVolume) jobs worth fetching.
+
+    Given the first and last time stored per currency and lookback, a
+    lookback is skipped when:
+
+    - it is fresh: its last point is less than freshFraction of the window
+      old, so refetching now would add little; the window is refetched well
+      before its data could fall out of it, so no gap opens up.
+    - it is covered: the currency was listed more recently than a smaller
+      lookback reaches back (less listingMargin), so the larger lookbacks
+      would return the same life span at a coarser resolution. The smallest
+      such lookback then also brings the volume series.
+
+    Currencies without stored data get every lookback. Set skipFresh to
+    False to leave timing to a scheduler and only skip covered lookbacks.
+    """
+
+    def __init__(self, lookbacks, coverage=None, now=None, skipFresh=True):
+        """Create a plan for lookbacks from the coverage stored in the DB
+        (see pg.selectCoverage) as of now."""
+        self.lookbacks = lookbacks
+        self.skipFresh = skipFresh
+        self.coverage = (coverage if coverage is not None
+                         else pg.selectCoverage(lookbacks))
+        self.now = now if now is not None else datetime.utcnow()
+        self.counts = dict((lookback, {'fetch': 0, 'fresh': 0, 'covered': 0})
+                           for lookback in lookbacks)
+
+    def _listedAt(self, stored):
+        """Return when a currency was listed, if its series starts within
+        the largest lookback stored for it, or None."""
+        if len(stored) == 0:
+            return None
+        largest = max(stored.keys())
+        first, last = stored[largest]
+        if last - first < timedelta(days=largest) - listingMargin:
+            return first
+        return None
+
+    def jobs(self, slug):
+        """Return the jobs to fetch for a currency slug."""
+        stored = self.coverage.get(slug, {})
+        listedAt = self._listedAt(stored)
+        covering = None
+        if listedAt is not None:
+            covering = min([lookback for lookback in self.lookbacks
+                            if timedelta(days=lookback) - listingMargin >=
+                            self.now - listedAt] or [None])
+        jobs = []
+        for lookback in self.lookbacks:
+            last = stored.get(lookback, (None, None))[1]
+            if covering is not None and lookback > covering:
+                reason = 'covered'
+            elif self.skipFresh and last is not None and \
+                    self.now - last < timedelta(
+                    days=lookback*freshFraction):
+                reason = 'fresh'
+            else:
+                reason = 'fetch'
+                jobs.append((slug, lookback, lookback == volumeLookback or (
+                    lookback == covering and volumeLookback > covering and
+                    volumeLookback in self.lookbacks)))
+            self.counts[lookback][reason] += 1
+        return jobs
+
+    def summary(self):
+        """Return a description of the plan so far, one line per lookback
+        and a total."""
+        lines = []
+        for lookback in self.lookbacks:
+            counts = self.counts[lookback]
+            lines.append(
+                "Lookback {0}: fetching {1}, skipping {2} fresh and {3} "
+                "covered by a smaller lookback.".format(
+                    lookback, counts['fetch'], counts['fresh'],
+                    counts['covered']))
+        planned = sum(counts['fetch'] for counts in self.counts.values())
+        total = sum(sum(counts.values()) for counts in self.counts.values())
+        lines.append("Planned {0} of {1} requests, saving {2}.".format(
+            planned, total, total - planned))
+        return lines
+
+
+class PlannerTest(unittest.TestCase):
+
+    """Testing suite for planner module."""
+
+    def setUp(self):
+        """Setup a clock."""
+        self.now = datetime(2016, 6, 1)
+
+    def ago(self, days):
+        """Return the time days before now."""
+        return self.now - timedelta(days=days)
+
+    def testNoData(self):
+        """Test that currencies without data get every lookback."""
+        plan = FetchPlan([365, 30, 7], coverage={}, now=self.now)
+        self.assertEqual(plan.jobs('bitcoin'), [
+            ('bitcoin', 365, True), ('bitcoin', 30, False),
+            ('bitcoin', 7, False)])
+
+    def testFresh(self):
+        """Test that fresh lookbacks are skipped."""
+        coverage = {'bitcoin': {
+            365: (self.ago(900), self.ago(10)),
+            30: (self.ago(900), self.ago(10)),
+            7: (self.ago(900), self.ago(0.5))}}
+        plan = FetchPlan([365, 30, 7], coverage=coverage, now=self.now)
+        self.assertEqual(plan.jobs('bitcoin'), [('bitcoin', 30, False)])
+        self.assertEqual(plan.counts[365], {
+            'fetch': 0, 'fresh': 1, 'covered': 0})
+        self.assertEqual(plan.summary()[-1],
+                         "Planned 1 of 3 requests, saving 2.")
+        plan = FetchPlan([365, 30, 7], coverage=coverage, now=self.now,
+                         skipFresh=False)
+        self.assertEqual(len(plan.jobs('bitcoin')), 3)
+
+    def testYoungCurrency(self):
+        """Test that a young currency is fetched with the smallest lookback
+        that reaches back to its listing, with its volume."""
+        coverage = {'navajo': {
+            365: (self.ago(5), self.ago(2)),
+            7: (self.ago(5), self.ago(2))}}
+        plan = FetchPlan([365, 180, 30, 7], coverage=coverage, now=self.now)
+        self.assertEqual(plan.jobs('navajo'), [('navajo', 7, True)])
+        self.assertEqual(plan.counts[365]['covered'], 1)
+
+        # Once it outgrows a lookback, the next one up is fetched
+        coverage['navajo'][365] = (self.ago(40), self.ago(2))
+        plan = FetchPlan([365, 180, 30, 7], coverage=coverage, now=self.now)
+        self.assertEqual(plan.jobs('navajo'), [
+            ('navajo', 180, True), ('navajo', 30, False),
+            ('navajo', 7, False)])
+
+if __name__ == "__main__":
+    unittest.main()
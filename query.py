@@ -0,0 +1,275 @@
+"""Module for reading market cap series back out of the database."""
+from array import array
+import coinmarketcap
+from datetime import datetime
+from datetime import timedelta
+import os
+import pg
+import unittest
+
+# Configuration variables
+lookbacks = [7, 30, 90, 180, 365]
+defaultFields = ['price_usd', 'price_btc', 'market_cap_by_available_supply',
+                 'market_cap_by_total_supply']
+lttbField = 'price_usd'
+
+
+def chooseLookbacks(currencies, start):
+    """Pick the lookback to read each currency from.
+
+    Coarser lookbacks reach further back, so each currency gets the finest
+    lookback whose data starts at or before start or, if none does, the one
+    whose data starts earliest. Currencies without data are left out.
+    """
+    cur = pg.cursor()
+    cur.execute(" UNION ALL ".join(
+        """(SELECT c.currency, {0},
+            (SELECT MIN(time) FROM {1}
+            WHERE currency = c.currency {2})
+        FROM unnest(%(currencies)s::integer[]) AS c(currency))""".format(
+            lookback, *pg.marketCapSource(lookback))
+        for lookback in lookbacks), {'currencies': list(currencies)})
+    choice = {}
+    for currency, lookback, first in cur.fetchall():
+        if first is None:
+            continue
+        key = (max(first, start), lookback)
+        if currency not in choice or key < choice[currency][0]:
+            choice[currency] = (key, lookback)
+    return dict((currency, lookback)
+                for currency, (key, lookback) in choice.iteritems())
+
+
+def _newSeries(currency, fields):
+    """Return an empty series of compact arrays."""
+    series = {'currency': currency, 'time': array('d')}
+    for field in fields:
+        series[field] = array('d')
+    return series
+
+
+def _fetchSeries(currencies, lookbackDays, start, end, fields, bucketSeconds):
+    """Read the series of currencies from one lookback, averaged over
+    buckets of bucketSeconds if given."""
+    table, condition = pg.marketCapSource(lookbackDays)
+    if bucketSeconds is None:
+        timeColumn = "EXTRACT(EPOCH FROM time)::float8"
+        valueColumns = ["{0}::float8".format(field) for field in fields]
+        grouping = ""
+    else:
+        timeColumn = (
+            "FLOOR(EXTRACT(EPOCH FROM time)/{0})*{0}".format(
+                float(bucketSeconds)))
+        valueColumns = ["AVG({0})::float8".format(field) for field in fields]
+        grouping = "GROUP BY 1, 2"
+    cur = pg.cursor()
+    cur.execute("""
+        SELECT currency, {0}, {1}
+        FROM {2}
+        WHERE currency = ANY(%s) AND time >= %s AND time <= %s {3}
+        {4}
+        ORDER BY 1, 2""".format(
+        timeColumn, ",".join(valueColumns), table, condition, grouping),
+        (list(currencies), start, end))
+    result = {}
+    nan = float('nan')
+    for row in cur:
+        if row[0] not in result:
+            result[row[0]] = _newSeries(row[0], fields)
+        series = result[row[0]]
+        series['time'].append(row[1])
+        for field, value in zip(fields, row[2:]):
+            series[field].append(nan if value is None else value)
+    return result
+
+
+def lttb(xs, ys, threshold):
+    """Return the indices of the points kept by Largest-Triangle-Three-
+    Buckets downsampling of (xs, ys) to threshold points.
+
+    The first and last points are always kept; from every bucket in between
+    the point forming the largest triangle with the previous kept point and
+    the average of the next bucket is kept. NaN values are never picked over
+    numbers.
+    """
+    count = len(xs)
+    if threshold >= count or threshold < 3:
+        return range(count)
+    kept = [0]
+    every = float(count - 2)/(threshold - 2)
+    previous = 0
+    for i in range(threshold - 2):
+        # Average of the next bucket (the last point, for the last bucket)
+        nextStart = int((i + 1)*every) + 1
+        nextEnd = min(int((i + 2)*every) + 1, count)
+        nextValues = [(xs[j], ys[j]) for j in range(nextStart, nextEnd)
+                      if ys[j] == ys[j]]
+        if len(nextValues) == 0:
+            nextValues = [(xs[count - 1], ys[count - 1])]
+        avgX = sum(x for x, y in nextValues)/len(nextValues)
+        avgY = sum(y for x, y in nextValues)/len(nextValues)
+
+        # Point of this bucket with the largest triangle
+        bucketStart = int(i*every) + 1
+        bucketEnd = int((i + 1)*every) + 1
+        chosen, largest = bucketStart, -1.0
+        for j in range(bucketStart, bucketEnd):
+            area = abs((xs[previous] - avgX)*(ys[j] - ys[previous]) -
+                       (xs[previous] - xs[j])*(avgY - ys[previous]))
+            if area > largest:
+                chosen, largest = j, area
+        kept.append(chosen)
+        previous = chosen
+    kept.append(count - 1)
+    return kept
+
+
+def _downsample(series, fields, points):
+    """Downsample a series to points with LTTB on lttbField."""
+    kept = lttb(series['time'], series[lttbField], points)
+    result = _newSeries(series['currency'], fields)
+    for field in ['time'] + fields:
+        column = series[field]
+        result[field] = array('d', (column[i] for i in kept))
+    return result
+
+
+def selectMarketCaps(currencies, start, end, fields=None, points=None,
+                     downsample='server'):
+    """Select the market cap series of currencies between start and end.
+
+    Each currency is read from the finest lookback covering the range (see
+    chooseLookbacks). If points is given, series are downsampled to about
+    that many points, by averaging equal time buckets in the database
+    (downsample='server') or with LTTB on lttbField (downsample='lttb').
+    Returns a dict by currency ID of series like those of
+    coinmarketcap.parseMarketCapColumns, but held in arrays: a 'time' array
+    of epoch seconds and a float array per field, NaN for nulls.
+    """
+    fields = list(fields or defaultFields)
+    if downsample == 'lttb' and lttbField not in fields:
+        fields.append(lttbField)
+    bucketSeconds = None
+    if points is not None and downsample == 'server':
+        bucketSeconds = max((end - start).total_seconds()/points, 1)
+    result = {}
+    with pg.checkout():
+        choice = chooseLookbacks(currencies, start)
+        for lookback in lookbacks:
+            chosen = [currency for currency, currencyLookback
+                      in choice.iteritems() if currencyLookback == lookback]
+            if len(chosen) > 0:
+                result.update(_fetchSeries(
+                    chosen, lookback, start, end, fields, bucketSeconds))
+    if points is not None and downsample == 'lttb':
+        for currency, series in result.iteritems():
+            result[currency] = _downsample(series, fields, points)
+    return result
+
+
+def selectMarketCap(currency, start, end, fields=None, points=None,
+                    downsample='server'):
+    """Select the market cap series of one currency (see selectMarketCaps),
+    or None if there is no data for it."""
+    return selectMarketCaps(
+        [currency], start, end, fields, points, downsample).get(currency)
+
+
+class QueryTest(unittest.TestCase):
+
+    """Testing suite for query module."""
+
+    testTables = ['market_cap_7', 'market_cap_30', 'market_cap_hourly',
+                  'market_cap_daily']
+
+    def setUp(self):
+        """Setup and fill tables for test."""
+        self.tablesOriginal = pg.tables
+        pg.tables = dict(pg.tables)
+        cur = pg.cursor()
+        for key in self.testTables:
+            pg.tables[key] = "{0}_test".format(self.tablesOriginal[key])
+            cur.execute("""CREATE TABLE {0}
+                (LIKE {1} INCLUDING ALL)""".format(
+                pg.tables[key], self.tablesOriginal[key]))
+        cur.execute("""COMMIT""")
+        self.lookbacksOriginal = lookbacks[:]
+        lookbacks[:] = [7, 30]
+
+        # The 30 day lookback has all points, the 7 day one the later half
+        f = open("{0}/example/marketcap_navajo_7d.json".format(
+            os.path.dirname(os.path.abspath(__file__))), 'r')
+        self.data = coinmarketcap.parseMarketCap(f.read(), 9)
+        f.close()
+        pg.insertMarketCap(self.data, 30)
+        pg.insertMarketCap(self.data[len(self.data)/2:], 7)
+        self.start = self.data[0]['time']
+        self.middle = self.data[len(self.data)/2]['time']
+        self.end = self.data[-1]['time']
+
+    def tearDown(self):
+        """Teardown test tables."""
+        cur = pg.cursor()
+        for key in self.testTables:
+            cur.execute("""DROP TABLE IF EXISTS {0}""".format(
+                pg.tables[key]))
+        cur.execute("""COMMIT""")
+        pg.tables = self.tablesOriginal
+        lookbacks[:] = self.lookbacksOriginal
+
+    def testChooseLookbacks(self):
+        """Test that the finest lookback covering the range is chosen."""
+        with pg.checkout():
+            self.assertEqual(chooseLookbacks([9, 10], self.start), {9: 30})
+            self.assertEqual(chooseLookbacks([9], self.middle), {9: 7})
+            self.assertEqual(
+                chooseLookbacks([9], self.start - timedelta(days=1)), {9: 30})
+
+    def testSelectMarketCap(self):
+        """Test full resolution and downsampled selects."""
+        series = selectMarketCap(9, self.start, self.end)
+        self.assertEqual(len(series['time']), len(self.data))
+        self.assertEqual(isinstance(series['price_usd'], array), True)
+        self.assertEqual(
+            datetime.utcfromtimestamp(series['time'][0]), self.start)
+        self.assertAlmostEqual(
+            series['price_usd'][-1], float(self.data[-1]['price_usd']))
+        series = selectMarketCap(9, self.middle, self.end, ['price_btc'])
+        self.assertEqual(sorted(series.keys()),
+                         ['currency', 'price_btc', 'time'])
+        self.assertEqual(len(series['time']), len(self.data) -
+                         len(self.data)/2)
+        self.assertEqual(selectMarketCap(10, self.start, self.end), None)
+
+        # Server side buckets average the points within them
+        series = selectMarketCap(9, self.start, self.end, points=10)
+        self.assertEqual(len(series['time']) <= 11, True)
+        prices = [float(datum['price_usd']) for datum in self.data]
+        self.assertAlmostEqual(
+            sum(series['price_usd'])/len(series['price_usd']),
+            sum(prices)/len(prices), places=3)
+
+        # LTTB keeps actual points, including the first and last
+        series = selectMarketCap(9, self.start, self.end, points=10,
+                                 downsample='lttb')
+        self.assertEqual(len(series['time']), 10)
+        self.assertEqual(series['price_usd'][0], prices[0])
+        self.assertEqual(series['price_usd'][-1], prices[-1])
+        self.assertEqual(all(price in prices
+                             for price in series['price_usd']), True)
+
+    def testLttb(self):
+        """Test that LTTB keeps peaks."""
+        xs = range(100)
+        ys = [0.0]*100
+        ys[37] = 5.0
+        ys[62] = -5.0
+        kept = lttb(xs, ys, 6)
+        self.assertEqual(len(kept), 6)
+        self.assertEqual(kept[0], 0)
+        self.assertEqual(kept[-1], 99)
+        self.assertEqual(37 in kept and 62 in kept, True)
+        self.assertEqual(lttb(xs, ys, 200), range(100))
+
+if __name__ == "__main__":
+    unittest.main()
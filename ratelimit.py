@@ -0,0 +1,318 @@
+"""Module for pacing requests with a shared token bucket."""
+import fcntl
+import os
+import struct
+import tempfile
+import threading
+import time
+import unittest
+
+
+class TokenBucket(object):
+
+    """Token bucket rate limiter.
+
+    Tokens accrue at `rate` per second up to `burst`. Every acquire takes a
+    token; when none are left the token is reserved ahead of time and the
+    caller sleeps until it is due, so callers are released at exactly the
+    sustained rate and never faster.
+
+    By default the bucket state lives in memory and is shared between threads.
+    If `path` is given the state is kept in that file under an exclusive
+    flock, which lets every process on the host draw from the same bucket
+    (point it at /dev/shm to keep the state in shared memory).
+    """
+
+    stateFormat = 'dd'
+
+    def __init__(self, rate, burst=1, path=None,
+                 clock=time.time, sleep=time.sleep):
+        """Create a bucket refilling at rate tokens/second up to burst."""
+        if rate <= 0 or burst < 1:
+            raise ValueError("Rate must be positive and burst at least 1.")
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.path = path
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._state = None
+
+    def _take(self, state, now):
+        """Take a token from state, returning (wait, newState)."""
+        if state is None:
+            tokens, stamp = self.burst, now
+        else:
+            tokens, stamp = state
+        tokens = min(self.burst, tokens + max(0, now - stamp)*self.rate) - 1
+        wait = -tokens/self.rate if tokens < 0 else 0.0
+        return wait, (tokens, max(now, stamp))
+
+    def _takeShared(self, now):
+        """Take a token from the state file."""
+        size = struct.calcsize(self.stateFormat)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            raw = os.read(fd, size)
+            state = None
+            if len(raw) == size:
+                state = struct.unpack(self.stateFormat, raw)
+            wait, state = self._take(state, now)
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.write(fd, struct.pack(self.stateFormat, *state))
+        finally:
+            # Closing the descriptor releases the flock
+            os.close(fd)
+        return wait
+
+    def reserve(self):
+        """Take a token and return how long to wait before using it."""
+        with self._lock:
+            now = self._clock()
+            if self.path is None:
+                wait, self._state = self._take(self._state, now)
+            else:
+                wait = self._takeShared(now)
+        return wait
+
+    def acquire(self):
+        """Block until a token is available. Returns the time slept."""
+        wait = self.reserve()
+        if wait > 0:
+            self._sleep(wait)
+        return wait
+
+    def setRate(self, rate):
+        """Change the sustained rate, keeping the tokens accrued so far."""
+        with self._lock:
+            self.rate = float(rate)
+
+
+class AdaptiveRate(object):
+
+    """AIMD controller of a token bucket's rate and of requests in flight.
+
+    Every fast, successful response adds about `increase` requests/second
+    per second of successes to the rate, and one request in flight per
+    round of that many in flight, up to maxRate and maxInFlight. A
+    throttled response (429/5xx), or a smoothed latency above
+    latencyFactor times the best seen, multiplies both by backoffFactor,
+    down to minRate and one in flight; responses to requests sent before
+    a backoff don't trigger another one for holdSeconds. A Retry-After
+    holds every request back until it has passed.
+    """
+
+    def __init__(self, bucket, minRate, maxRate, maxInFlight, increase=0.1,
+                 backoffFactor=0.5, latencyFactor=2.0, holdSeconds=5.0,
+                 smoothing=0.2, clock=time.time, sleep=time.sleep):
+        """Control bucket's rate between minRate and maxRate, with up to
+        maxInFlight requests in flight, starting from one."""
+        if not 0 < minRate <= maxRate or maxInFlight < 1:
+            raise ValueError("Rates must be positive and ordered and "
+                             "maxInFlight at least 1.")
+        self.bucket = bucket
+        self.minRate = float(minRate)
+        self.maxRate = float(maxRate)
+        self.maxInFlight = maxInFlight
+        self.increase = increase
+        self.backoffFactor = backoffFactor
+        self.latencyFactor = latencyFactor
+        self.holdSeconds = holdSeconds
+        self.smoothing = smoothing
+        self._clock = clock
+        self._sleep = sleep
+        self._condition = threading.Condition()
+        self.rate = min(max(bucket.rate, self.minRate), self.maxRate)
+        bucket.setRate(self.rate)
+        self.inFlightLimit = 1.0
+        self.inFlight = 0
+        self.latency = None
+        self.bestLatency = None
+        self.heldUntil = 0.0
+        self.pausedUntil = 0.0
+        self.counts = {'throttled': 0, 'slow': 0, 'backoffs': 0}
+
+    def acquire(self):
+        """Block until a request may be sent. Returns the time slept for
+        pacing; callers must report the outcome with release."""
+        with self._condition:
+            while self.inFlight >= int(self.inFlightLimit):
+                self._condition.wait()
+            self.inFlight += 1
+            pause = self.pausedUntil - self._clock()
+        slept = 0.0
+        if pause > 0:
+            self._sleep(pause)
+            slept += pause
+        return slept + self.bucket.acquire()
+
+    def _backoff(self, now):
+        """Shrink the rate and requests in flight, once per holdSeconds."""
+        if now < self.heldUntil:
+            return
+        self.counts['backoffs'] += 1
+        self.rate = max(self.rate*self.backoffFactor, self.minRate)
+        self.inFlightLimit = max(self.inFlightLimit*self.backoffFactor, 1.0)
+        self.heldUntil = now + self.holdSeconds
+        self.bucket.setRate(self.rate)
+
+    def _grow(self, now):
+        """Grow the rate and requests in flight after a success."""
+        if now < self.heldUntil:
+            return
+        self.rate = min(self.rate + self.increase/self.rate, self.maxRate)
+        self.inFlightLimit = min(self.inFlightLimit + 1/self.inFlightLimit,
+                                 self.maxInFlight)
+        self.bucket.setRate(self.rate)
+
+    def release(self, latency=None, throttled=False, retryAfter=None):
+        """Report the outcome of a request: its latency in seconds if it
+        succeeded, throttled (with the Retry-After seconds, if any) if the
+        server pushed back, or neither if it failed otherwise."""
+        with self._condition:
+            self.inFlight -= 1
+            now = self._clock()
+            if throttled:
+                self.counts['throttled'] += 1
+                if retryAfter is not None:
+                    self.pausedUntil = max(self.pausedUntil,
+                                           now + retryAfter)
+                self._backoff(now)
+            elif latency is not None:
+                if self.latency is None:
+                    self.latency = latency
+                else:
+                    self.latency += self.smoothing*(latency - self.latency)
+                self.bestLatency = min(self.bestLatency or self.latency,
+                                       self.latency)
+                if self.latency > self.latencyFactor*self.bestLatency:
+                    self.counts['slow'] += 1
+                    self._backoff(now)
+                else:
+                    self._grow(now)
+            self._condition.notify_all()
+
+
+class RateLimitTest(unittest.TestCase):
+
+    """Testing suite for ratelimit module."""
+
+    def setUp(self):
+        """Setup a fake clock."""
+        self.now = 1000.0
+
+    def clock(self):
+        """Return the fake time."""
+        return self.now
+
+    def testBurstThenRate(self):
+        """Test that a burst is served immediately and then paced."""
+        bucket = TokenBucket(2, burst=3, clock=self.clock)
+        waits = [bucket.reserve() for i in range(5)]
+        self.assertEqual(waits, [0, 0, 0, 0.5, 1.0])
+
+        # After idling the bucket refills, but never beyond the burst size
+        self.now += 100
+        waits = [bucket.reserve() for i in range(4)]
+        self.assertEqual(waits, [0, 0, 0, 0.5])
+
+    def testSharedFile(self):
+        """Test that buckets sharing a state file share one budget."""
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            first = TokenBucket(1, path=path, clock=self.clock)
+            second = TokenBucket(1, path=path, clock=self.clock)
+            self.assertEqual(first.reserve(), 0)
+            self.assertEqual(second.reserve(), 1.0)
+            self.assertEqual(first.reserve(), 2.0)
+            self.now += 3
+            self.assertEqual(second.reserve(), 0)
+        finally:
+            os.remove(path)
+
+    def testThreads(self):
+        """Test that concurrent acquires never exceed the rate."""
+        slept = []
+        bucket = TokenBucket(
+            10, burst=2, clock=self.clock, sleep=slept.append)
+        threads = [threading.Thread(target=bucket.acquire)
+                   for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(
+            sorted(slept), [(i + 1)/10.0 for i in range(8)])
+
+    def testAdaptiveRate(self):
+        """Test additive growth and multiplicative backoff."""
+        slept = []
+        bucket = TokenBucket(1, burst=100, clock=self.clock)
+        pacer = AdaptiveRate(bucket, 0.5, 4, 4, increase=1,
+                             clock=self.clock, sleep=slept.append)
+        for i in range(12):
+            pacer.acquire()
+            pacer.release(latency=0.1)
+        self.assertEqual(bucket.rate > 2, True)
+        self.assertEqual(int(pacer.inFlightLimit), 4)
+
+        # Throttling halves both, once per hold
+        rate = pacer.rate
+        pacer.acquire()
+        pacer.acquire()
+        pacer.release(throttled=True)
+        pacer.release(throttled=True)
+        self.assertEqual(bucket.rate, rate/2)
+        self.assertEqual(int(pacer.inFlightLimit), 2)
+        self.assertEqual(pacer.counts['backoffs'], 1)
+
+        # Nor does it grow again before the hold is over
+        pacer.acquire()
+        pacer.release(latency=0.1)
+        self.assertEqual(bucket.rate, rate/2)
+
+        # Rising latency backs off too
+        self.now += 10
+        for i in range(10):
+            pacer.acquire()
+            pacer.release(latency=1.0)
+        self.assertEqual(bucket.rate, rate/4)
+        self.assertEqual(pacer.counts['slow'] > 0, True)
+
+        # Retry-After holds requests back
+        self.now += 10
+        pacer.acquire()
+        pacer.release(throttled=True, retryAfter=30)
+        self.assertEqual(bucket.rate, 0.5)
+        del slept[:]
+        pacer.acquire()
+        self.assertEqual(slept[0], 30)
+
+    def testAdaptiveInFlight(self):
+        """Test that no more requests than allowed are in flight."""
+        pacer = AdaptiveRate(TokenBucket(1000, burst=1000), 1, 1000, 3)
+        pacer.inFlightLimit = 2.0
+        lock = threading.Lock()
+        inFlight = [0, 0]
+
+        def request():
+            pacer.acquire()
+            with lock:
+                inFlight[0] += 1
+                inFlight[1] = max(inFlight)
+            time.sleep(0.01)
+            with lock:
+                inFlight[0] -= 1
+            pacer.release()
+
+        threads = [threading.Thread(target=request) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(inFlight[1], 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,418 @@
+"""Offline replay of archived payloads into the database."""
+import archive
+import coinmarketcap
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import pg
+import planner
+import re
+import scrape
+import shutil
+import signal
+import sys
+import tempfile
+import time
+import unittest
+
+# Configuration variables
+dataDir = scrape.dataDir
+processes = multiprocessing.cpu_count()
+windowSize = 200
+volumeLookback = planner.volumeLookback
+_filePattern = re.compile(
+    r'^(?:marketcap_(?P<slug>.+)_(?P<lookback>\d+)d|currencylist)_'
+    r'(?P<time>\d+)\.(?:json|html)$')
+
+# Archive opened by each parse process
+_archive = None
+
+
+def scanPayloads(folder):
+    """Return the payloads saved under folder, as (kind, fetchTime, slug,
+    lookback, source) keys in load order: currency lists, then market caps,
+    each in fetch time order.
+
+    Payloads are the marketcap_{slug}_{N}d_{ts}.json and
+    currencylist_{ts}.html files saved before the archive existed, and the
+    archive's entries. The source is a file path or an archive digest.
+    """
+    payloads = []
+    for name in os.listdir(folder):
+        match = _filePattern.match(name)
+        if match is None:
+            continue
+        lookback = match.group('lookback')
+        payloads.append((
+            1 if lookback is not None else 0, int(match.group('time')),
+            match.group('slug'), int(lookback) if lookback else None,
+            os.path.join(folder, name)))
+    archivePath = os.path.join(folder, 'archive')
+    if os.path.isdir(archivePath):
+        store = archive.Archive(archivePath)
+        try:
+            for name, slug, lookback, fetchTime, digest in store.entries():
+                payloads.append((1 if name == 'marketcap' else 0, fetchTime,
+                                 slug, lookback, digest))
+        finally:
+            store.close()
+    return sorted(payloads)
+
+
+def _openArchive(archivePath):
+    """Open the archive in a parse process, ignoring interrupts."""
+    global _archive
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if os.path.isdir(archivePath):
+        _archive = archive.Archive(archivePath)
+
+
+def _bringsVolume(lookback, fetchTime, data):
+    """Tell whether a market cap payload's volume is loaded: that of
+    volumeLookback payloads, as well as that of payloads reaching back to
+    the currency's listing, which planner.FetchPlan fetches with volume in
+    its place."""
+    if lookback == volumeLookback:
+        return True
+    if len(data) == 0:
+        return False
+    listingMargin = planner.listingMargin.total_seconds()
+    return data[0].time >= fetchTime - lookback*86400 + listingMargin
+
+
+def _parsePayload(task):
+    """Read and parse a payload in a parse process.
+
+    task is a payload key and, for market caps, the currency ID. Returns
+    (key, digest, parsed rows or None, error message or None); market cap
+    rows come with their volume rows, or None if it isn't loaded (see
+    _bringsVolume).
+    """
+    key, currencyId = task
+    kind, fetchTime, slug, lookback, source = key
+    try:
+        if os.path.sep in source:
+            f = open(source, 'r')
+            content = f.read().decode('utf-8')
+            f.close()
+            digest = hashlib.sha1(content.encode('utf-8')).hexdigest()
+        else:
+            content = _archive.get(source)
+            digest = source
+        if kind == 0:
+            return key, digest, coinmarketcap.parseCurrencyListAll(
+                content), None
+        data, volData = coinmarketcap.parseMarketCap(
+            content, currencyId, includeVolume=True, compact=True)
+        if not _bringsVolume(lookback, fetchTime, data):
+            volData = None
+        return key, digest, (data, volData), None
+    except Exception as e:
+        return key, None, None, "{0}: {1}".format(type(e).__name__, e)
+
+
+def _checkpointPath(schema):
+    """Return the path of the checkpoint of replays into schema."""
+    return os.path.join(dataDir, "replay_{0}.checkpoint".format(
+        schema or 'public'))
+
+
+def _readCheckpoint(schema):
+    """Return the key of the last payload loaded per kind, as
+    {kind: key}."""
+    path = _checkpointPath(schema)
+    if not os.path.exists(path):
+        return {}
+    f = open(path, 'r')
+    keys = [tuple(key) for key in json.load(f)]
+    f.close()
+    return dict((key[0], key) for key in keys)
+
+
+def _writeCheckpoint(schema, checkpoint):
+    """Record the key of the last payload loaded per kind, atomically."""
+    path = _checkpointPath(schema)
+    f = open(path + '.tmp', 'w')
+    json.dump([list(key) for kind, key in sorted(checkpoint.items())], f)
+    f.close()
+    os.rename(path + '.tmp', path)
+
+
+def useSchema(schema):
+    """Point every connection at schema, creating it and its tables (see
+    the sql directory) if it doesn't exist yet."""
+    pg.dbcParams['options'] = '-c search_path={0}'.format(schema)
+    cur = pg.cursor()
+    cur.execute("""SELECT 1 FROM information_schema.schemata
+        WHERE schema_name = %s""", (schema,))
+    if cur.fetchone() is None:
+        cur.execute("""CREATE SCHEMA {0}""".format(schema))
+        files = ['create.sql']
+        if pg.storageLayout == 'partitioned':
+            files.append('create_partitioned.sql')
+        for name in files:
+            f = open(os.path.join(os.path.dirname(
+                os.path.abspath(__file__)), 'sql', name), 'r')
+            cur.execute(f.read())
+            f.close()
+        logging.info("Created schema {0}.".format(schema))
+    cur.execute("""COMMIT""")
+
+
+def _tasks(window, failed):
+    """Return the parse tasks of a window of payload keys, dropping market
+    caps of currencies without an ID."""
+    tasks = []
+    for key in window:
+        currencyId = None
+        if key[0] == 1:
+            try:
+                currencyId = pg.lookupCurrencyId(key[2])
+            except Exception as e:
+                logging.info("Skipping {0}: {1}".format(key[4], e))
+                failed.append(key)
+                continue
+        tasks.append((key, currencyId))
+    return tasks
+
+
+def _load(results, failed):
+    """Load the parsed payloads of a window in order. Returns the
+    fingerprints of the market cap payloads loaded."""
+    loaded = []
+    for key, digest, parsed, error in results:
+        kind, fetchTime, slug, lookback, source = key
+        if error is not None:
+            logging.info("Could not parse {0}: {1}".format(source, error))
+            failed.append(key)
+        elif kind == 0:
+            # Currency lists come first, so IDs exist for the market caps
+            pg.writeBehind.flush()
+            pg.insertCurrencyList(parsed, withHistory=True)
+        else:
+            parsed, volData = parsed
+            if volData is not None:
+                pg.bufferMarketCapVolume(volData)
+            pg.bufferMarketCap(parsed, lookback)
+            loaded.append((slug, lookback, digest))
+    return loaded
+
+
+def replay(schema=None):
+    """Replay every payload under dataDir not replayed yet into the
+    database, or into schema if given.
+
+    Windows of windowSize payloads are parsed by processes parse processes
+    while the previous window loads, then committed through the write-
+    behind buffer. The key of the last payload of each committed window is
+    checkpointed for its kind, so a replay can be stopped and rerun at any
+    point, and currency lists fetched since the last replay are still
+    loaded ahead of the market caps fetched since; remove the checkpoint
+    file to replay everything again. No requests are
+    made. Returns the numbers of payloads replayed and failed.
+    """
+    if schema is not None:
+        useSchema(schema)
+    checkpoint = _readCheckpoint(schema)
+    payloads = [key for key in scanPayloads(dataDir)
+                if key[0] not in checkpoint or key > checkpoint[key[0]]]
+    logging.info("Replaying {0} payloads{1}...".format(
+        len(payloads), "" if len(checkpoint) == 0 else
+        " after the checkpoint"))
+    windows = []
+    for kind in [0, 1]:
+        ofKind = [key for key in payloads if key[0] == kind]
+        windows.extend(ofKind[i:i + windowSize]
+                       for i in range(0, len(ofKind), windowSize))
+    pool = multiprocessing.Pool(processes, _openArchive,
+                                (os.path.join(dataDir, 'archive'),))
+    failed = []
+    countReplayed = 0
+    started = time.time()
+    try:
+        pending = None
+        for window in windows:
+            # Market caps need the IDs of every currency list loaded, so
+            # parsing only runs ahead of loading within a kind
+            if pending is not None and pending[0][0][0] != window[0][0]:
+                countReplayed += _commit(schema, pending, failed, checkpoint)
+                pending = None
+            parsing = (window, pool.map_async(
+                _parsePayload, _tasks(window, failed)))
+            if pending is not None:
+                countReplayed += _commit(schema, pending, failed, checkpoint)
+            pending = parsing
+            logging.info("Replayed {0} of {1} payloads ({2:.1f} "
+                         "files/s).".format(
+                             countReplayed, len(payloads),
+                             countReplayed/max(time.time() - started, 1e-6)))
+        if pending is not None:
+            countReplayed += _commit(schema, pending, failed, checkpoint)
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    seconds = time.time() - started
+    logging.info("Replayed {0} payloads ({1} failed) in {2:.1f}s, {3:.1f} "
+                 "files/s.".format(countReplayed, len(failed), seconds,
+                                   countReplayed/max(seconds, 1e-6)))
+    return countReplayed, len(failed)
+
+
+def _commit(schema, pending, failed, checkpoint):
+    """Load a parsed window, commit it and checkpoint its last payload in
+    checkpoint. Returns the number of payloads in it."""
+    window, parsing = pending
+    loaded = _load(parsing.get(), failed)
+    pg.writeBehind.flush()
+    pg.upsertFingerprints(loaded)
+    checkpoint[window[-1][0]] = window[-1]
+    _writeCheckpoint(schema, checkpoint)
+    return len(window)
+
+
+def main():
+    """Replay the archive into the database, or into the schema given
+    ("python replay.py [schema]")."""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s:%(message)s',
+        datefmt='%m/%d/%Y %I:%M:%S %p')
+    try:
+        replay(sys.argv[1] if len(sys.argv) > 1 else None)
+    finally:
+        pg.writeBehind.close()
+
+
+class ReplayTest(unittest.TestCase):
+
+    """Testing suite for replay module."""
+
+    testTables = ['currency', 'currency_historical', 'market_cap_7',
+                  'market_cap_30', 'market_cap_365', 'trade_volume_usd',
+                  'market_cap_hourly', 'market_cap_daily',
+                  'trade_volume_usd_hourly', 'trade_volume_usd_daily',
+                  'payload_fingerprint']
+
+    def setUp(self):
+        """Setup tables and a data directory with files and an archive."""
+        self.tablesOriginal = pg.tables
+        pg.tables = dict(pg.tables)
+        cur = pg.cursor()
+        for key in self.testTables:
+            pg.tables[key] = "{0}_test".format(self.tablesOriginal[key])
+            cur.execute("""CREATE TABLE {0}
+                (LIKE {1} INCLUDING ALL)""".format(
+                pg.tables[key], self.tablesOriginal[key]))
+        cur.execute("""COMMIT""")
+        pg.currencyCache.invalidate()
+        global dataDir
+        self.dataDirOriginal = dataDir
+        dataDir = tempfile.mkdtemp()
+        folder = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'example')
+        shutil.copy(os.path.join(folder, 'currencylist.html'),
+                    os.path.join(dataDir, 'currencylist_1000.html'))
+        shutil.copy(os.path.join(folder, 'marketcap_navajo_7d.json'),
+                    os.path.join(dataDir, 'marketcap_navajo_7d_1100.json'))
+        f = open(os.path.join(folder, 'marketcap_navajo_7d.json'), 'r')
+        self.jsonDump = f.read()
+        f.close()
+        store = archive.Archive(os.path.join(dataDir, 'archive'))
+        store.put(self.jsonDump, 'marketcap', 'navajo', 365, fetchTime=1200)
+        store.put(self.jsonDump, 'marketcap', 'nocoin', 7, fetchTime=1300)
+        store.close()
+
+    def tearDown(self):
+        """Teardown test tables and the data directory."""
+        global dataDir
+        cur = pg.cursor()
+        for key in self.testTables:
+            cur.execute("""DROP TABLE IF EXISTS {0}""".format(pg.tables[key]))
+        cur.execute("""COMMIT""")
+        pg.tables = self.tablesOriginal
+        pg.currencyCache.invalidate()
+        shutil.rmtree(dataDir)
+        dataDir = self.dataDirOriginal
+
+    def testScanPayloads(self):
+        """Test that currency lists come first, then market caps in fetch
+        time order."""
+        self.assertEqual([key[:4] for key in scanPayloads(dataDir)], [
+            (0, 1000, None, None), (1, 1100, 'navajo', 7),
+            (1, 1200, 'navajo', 365), (1, 1300, 'nocoin', 7)])
+
+    def testReplay(self):
+        """Test that payloads are loaded once, across restarts."""
+        global windowSize
+        windowSizeOriginal = windowSize
+        windowSize = 2
+        try:
+            self.assertEqual(replay(), (4, 1))
+        finally:
+            windowSize = windowSizeOriginal
+        cur = pg.cursor()
+        for key, count in [('market_cap_7', 287), ('market_cap_365', 287),
+                           ('trade_volume_usd', 7)]:
+            cur.execute("""SELECT COUNT(*) FROM {0}""".format(
+                pg.tables[key]))
+            self.assertEqual(cur.fetchone()[0], count)
+        cur.execute("""SELECT COUNT(*) FROM {0}""".format(
+            pg.tables['currency']))
+        self.assertEqual(cur.fetchone()[0] > 100, True)
+        digest = hashlib.sha1(self.jsonDump).hexdigest()
+        self.assertEqual(pg.selectFingerprints(), {
+            ('navajo', 7): digest, ('navajo', 365): digest})
+        cur.execute("""COMMIT""")
+
+        # Only payloads after the checkpoint are replayed
+        self.assertEqual(replay(), (0, 0))
+        shutil.copy(os.path.join(dataDir, 'marketcap_navajo_7d_1100.json'),
+                    os.path.join(dataDir, 'marketcap_navajo_7d_1400.json'))
+        self.assertEqual(replay(), (1, 0))
+
+        # Currency lists fetched after the last market cap replayed are
+        # still replayed
+        shutil.copy(os.path.join(dataDir, 'currencylist_1000.html'),
+                    os.path.join(dataDir, 'currencylist_1500.html'))
+        self.assertEqual(replay(), (1, 0))
+        self.assertEqual(replay(), (0, 0))
+
+    def testReplayYoungCurrency(self):
+        """Test that the volume of a currency younger than volumeLookback
+        comes from the payload reaching back to its listing."""
+        fetchTime = max(row[0] for row in json.loads(self.jsonDump)[
+            'price_usd_data'])/1000 + 3600
+        os.remove(os.path.join(dataDir, 'marketcap_navajo_7d_1100.json'))
+        shutil.rmtree(os.path.join(dataDir, 'archive'))
+        path = os.path.join(dataDir, 'archive')
+
+        # A full 7 day window doesn't reach back to the listing
+        store = archive.Archive(path)
+        store.put(self.jsonDump, 'marketcap', 'navajo', 7,
+                  fetchTime=fetchTime)
+        store.close()
+        self.assertEqual(replay(), (2, 0))
+        cur = pg.cursor()
+        cur.execute("""SELECT COUNT(*) FROM {0}""".format(
+            pg.tables['trade_volume_usd']))
+        self.assertEqual(cur.fetchone()[0], 0)
+        cur.execute("""COMMIT""")
+        store = archive.Archive(path)
+        store.put(self.jsonDump, 'marketcap', 'navajo', 30,
+                  fetchTime=fetchTime + 1)
+        store.close()
+        self.assertEqual(replay(), (1, 0))
+        for key, count in [('market_cap_7', 287), ('market_cap_30', 287),
+                           ('trade_volume_usd', 7)]:
+            cur.execute("""SELECT COUNT(*) FROM {0}""".format(
+                pg.tables[key]))
+            self.assertEqual(cur.fetchone()[0], count)
+        cur.execute("""COMMIT""")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,173 @@
+"""Module for scheduling market cap refreshes by priority."""
+from datetime import datetime
+from datetime import timedelta
+import pg
+import threading
+import unittest
+
+# Configuration variables
+requestsPerHour = 3600
+intervalFraction = 0.1
+minIntervalFraction = 0.01
+maxIntervalFraction = 0.5
+rankScale = 100.0
+volatilityScale = 0.02
+metricsLookback = 7
+volatilityDays = 7
+
+
+class Scheduler(object):
+
+    """Priority scheduler of (slug, lookback, includeVolume) jobs.
+
+    Each (slug, lookback) is refreshed every intervalFraction of its window,
+    stretched for low ranked currencies (by rankScale ranks) and shrunk for
+    volatile ones (by volatilityScale of hourly log return deviation), but
+    kept between minIntervalFraction and maxIntervalFraction of the window
+    so that no gap can open up. Jobs are run most overdue first, relative
+    to their interval, and each run spends at most requestsPerHour for the
+    time since the previous run. When each job was last fetched and is due
+    next is kept in the database between runs.
+    """
+
+    def __init__(self, schedule=None, metrics=None, now=None):
+        """Create a scheduler from the stored schedule and currency metrics
+        (see pg.selectSchedule and pg.selectRefreshMetrics) as of now."""
+        self.schedule = (schedule if schedule is not None
+                         else pg.selectSchedule())
+        self.metrics = (metrics if metrics is not None
+                        else pg.selectRefreshMetrics(
+                            metricsLookback, volatilityDays))
+        self.now = now if now is not None else datetime.utcnow()
+        self.counts = {'due': 0, 'notDue': 0, 'overBudget': 0, 'done': 0}
+        self._done = []
+        self._lock = threading.Lock()
+
+    def interval(self, slug, lookback):
+        """Return the refresh interval of a (slug, lookback)."""
+        rank, volatility = self.metrics.get(slug, (None, None))
+        factor = 1.0
+        if rank is not None:
+            factor *= 1 + (rank - 1)/rankScale
+        if volatility is not None:
+            factor /= 1 + volatility/volatilityScale
+        factor = min(max(factor*intervalFraction, minIntervalFraction),
+                     maxIntervalFraction)
+        return timedelta(days=lookback*factor)
+
+    def budget(self):
+        """Return the number of requests this run may make."""
+        lastRun = max([last for last, due in self.schedule.values()] or
+                      [None])
+        hours = 1.0
+        if lastRun is not None:
+            hours = min((self.now - lastRun).total_seconds()/3600, 1.0)
+        return int(requestsPerHour*hours)
+
+    def _overdue(self, job):
+        """Return how overdue a job is, in multiples of its interval."""
+        slug, lookback = job[:2]
+        if (slug, lookback) not in self.schedule:
+            return float('inf')
+        due = self.schedule[(slug, lookback)][1]
+        return ((self.now - due).total_seconds() /
+                self.interval(slug, lookback).total_seconds())
+
+    def order(self, jobs, budget=None):
+        """Return the due jobs, most overdue (then highest ranked) first,
+        up to the budget."""
+        if budget is None:
+            budget = self.budget()
+        due = []
+        for job in jobs:
+            overdue = self._overdue(job)
+            if overdue < 0:
+                self.counts['notDue'] += 1
+            else:
+                rank = self.metrics.get(job[0], (None, None))[0]
+                due.append((-overdue, rank or float('inf'), job))
+        due.sort()
+        self.counts['due'] += min(len(due), budget)
+        self.counts['overBudget'] += max(len(due) - budget, 0)
+        return [entry[2] for entry in due[:budget]]
+
+    def done(self, job):
+        """Record that a job was fetched."""
+        slug, lookback = job[:2]
+        interval = self.interval(slug, lookback)
+        now = datetime.utcnow()
+        with self._lock:
+            self.counts['done'] += 1
+            self._done.append((slug, lookback, now, now + interval,
+                               interval.total_seconds()))
+
+    def save(self):
+        """Store the schedule of the jobs done."""
+        with self._lock:
+            done = self._done[:]
+            del self._done[:]
+        pg.upsertSchedule(done)
+
+    def summary(self):
+        """Return a description of the run."""
+        return ("Scheduled {due} due jobs ({done} done), leaving {notDue} "
+                "not yet due and {overBudget} over budget.".format(
+                    **self.counts))
+
+
+class SchedulerTest(unittest.TestCase):
+
+    """Testing suite for scheduler module."""
+
+    def setUp(self):
+        """Setup a clock."""
+        self.now = datetime(2016, 6, 1)
+
+    def ago(self, days):
+        """Return the time days before now."""
+        return self.now - timedelta(days=days)
+
+    def testInterval(self):
+        """Test that intervals follow rank and volatility, within bounds."""
+        scheduler = Scheduler(schedule={}, metrics={
+            'bitcoin': (1, None), 'navajo': (101, None),
+            'volatile': (101, 0.02), 'dead': (100000, None)}, now=self.now)
+        self.assertEqual(scheduler.interval('bitcoin', 10),
+                         timedelta(days=1))
+        self.assertEqual(scheduler.interval('navajo', 10),
+                         timedelta(days=2))
+        self.assertEqual(scheduler.interval('volatile', 10),
+                         timedelta(days=1))
+        self.assertEqual(scheduler.interval('unknown', 10),
+                         timedelta(days=1))
+        self.assertEqual(scheduler.interval('dead', 10), timedelta(days=5))
+
+    def testOrder(self):
+        """Test that due jobs run most overdue first, within budget."""
+        schedule = {
+            ('bitcoin', 10): (self.ago(2), self.ago(1)),
+            ('navajo', 10): (self.ago(3), self.ago(1)),
+            ('dead', 10): (self.ago(1), self.ago(-1))}
+        metrics = {'bitcoin': (1, None), 'navajo': (101, None),
+                   'dead': (201, None), 'new': (1000, None)}
+        scheduler = Scheduler(schedule=schedule, metrics=metrics,
+                              now=self.now)
+        jobs = [(slug, 10, False)
+                for slug in ['dead', 'navajo', 'bitcoin', 'new', 'newer']]
+        self.assertEqual(scheduler.order(jobs, budget=3), [
+            ('new', 10, False), ('newer', 10, False), ('bitcoin', 10, False)])
+        self.assertEqual(scheduler.counts, {
+            'due': 3, 'notDue': 1, 'overBudget': 1, 'done': 0})
+
+    def testBudget(self):
+        """Test that the budget covers the time since the last run."""
+        scheduler = Scheduler(schedule={
+            ('bitcoin', 7): (self.now - timedelta(minutes=15), self.now)},
+            metrics={}, now=self.now)
+        self.assertEqual(scheduler.budget(), requestsPerHour/4)
+        self.assertEqual(
+            Scheduler(schedule={}, metrics={}, now=self.now).budget(),
+            requestsPerHour)
+
+if __name__ == "__main__":
+    unittest.main()
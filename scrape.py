@@ -1,88 +1,715 @@
 """ Core scraper for coinmarketcap.com. """
-import codecs
+import archive
 import coinmarketcap
-from datetime import datetime
+import functools
+import itertools
 import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
 import pg
+import pipeline
+import planner
+import scheduler
+import shutil
+import signal
 import sys
+import tempfile
+import threading
 import traceback
+import unittest
 
 # Configuration
 lookbacks = [365, 180, 90, 30, 7]
+concurrency = 8
+streamParse = False
+compactRows = True
+writeBehind = True
+planFetches = True
+scheduleFetches = True
+maxAttempts = 3
+progressBatch = 50
+currencyListBatch = 100
+pipelined = True
+parseProcesses = multiprocessing.cpu_count()
+loadThreads = 2
+dataDir = "{0}/data".format(os.path.dirname(os.path.abspath(__file__)))
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s %(levelname)s:%(message)s',
     datefmt='%m/%d/%Y %I:%M:%S %p')
 
+# Guards the fingerprints and run statistics shared by workers
+statsLock = threading.Lock()
 
-def _saveToFile(content, prefix, extension):
-    """Save given entity to a file."""
-    f = codecs.open("{0}/data/{1}_{2}.{3}".format(
-        os.path.dirname(os.path.abspath(__file__)),
-        prefix,
-        int((datetime.utcnow() - datetime(1970, 1, 1)).total_seconds()),
-        extension),
-        'w', 'utf-8')
-    f.write(content)
-    f.close()
+# Raw response archive, opened on first use
+rawArchive = None
+archiveLock = threading.Lock()
+
+# Digest of the payload last loaded per (slug, lookback), loaded on first use
+fingerprints = None
+# (slug, lookback, digest) of payloads committed but not yet fingerprinted
+loadedPayloads = []
+
+# ID of the current run, and (slug, lookback, status) of its jobs finished
+# but not yet recorded
+runId = None
+finishedJobs = []
+# Name of the worker claiming the run's jobs, when run by worker.py
+workerId = None
+runStats = {'unchanged': 0, 'writesAvoided': 0,
+            'inserted': 0, 'updated': 0, 'untouched': 0}
+
+# Processes parsing payloads for pipelined scrapes, started on first use
+parsePool = None
+
+
+def _saveToArchive(content, name, slug=None, lookback=None):
+    """Save given entity to the raw response archive."""
+    global rawArchive
+    with archiveLock:
+        if rawArchive is None:
+            rawArchive = archive.Archive("{0}/archive".format(dataDir))
+    return rawArchive.put(content, name, slug=slug, lookback=lookback)
+
+
+def streamCurrencyList():
+    """Scrape currency list, yielding currencies while the rest is parsed.
+
+    Currencies are loaded into the DB currencyListBatch at a time as they
+    are parsed, and each batch is yielded once loaded, so market cap loads
+    for them find their currency IDs without waiting for the whole list.
+    """
+    html = coinmarketcap.requestCurrencyList('all')
+    _saveToArchive(html, 'currencylist')
+    countParsed = 0
+    batch = []
+    for datum in coinmarketcap.iterCurrencyListAll(html):
+        batch.append(datum)
+        if len(batch) >= currencyListBatch:
+            pg.insertCurrencyList(batch, withHistory=True)
+            countParsed += len(batch)
+            for loaded in batch:
+                yield loaded
+            batch = []
+    if len(batch) > 0:
+        pg.insertCurrencyList(batch, withHistory=True)
+        countParsed += len(batch)
+        for loaded in batch:
+            yield loaded
+    logging.info("Finished scraping currency list of {0} currencies.".format(
+        countParsed))
 
 
 def scrapeCurrencyList():
     """Scrape currency list."""
-    html = coinmarketcap.requestCurrencyList('all')
-    _saveToFile(html, 'currencylist', 'html')
-    data = coinmarketcap.parseCurrencyListAll(html)
-    pg.insertCurrencyList(data, withHistory=True)
-    return data
+    return list(streamCurrencyList())
+
+
+def _isUnchanged(slug, numDays, digest, countWrites):
+    """Check a payload digest against the one last loaded for the key."""
+    global fingerprints
+    with statsLock:
+        if fingerprints is None:
+            fingerprints = pg.selectFingerprints()
+        if fingerprints.get((slug, numDays)) != digest:
+            return False
+        runStats['unchanged'] += 1
+        runStats['writesAvoided'] += countWrites
+        return True
 
 
-def scrapeMarketCap(slug, numDays, includeVolume=False):
-    """Scrape market cap for the specified currency slug."""
+def _addCounts(counts):
+    """Add the row counts of a load to the run statistics."""
+    for key, count in counts.iteritems():
+        runStats[key] += count
+
+
+def _fetchPayload(slug, numDays, includeVolume):
+    """Fetch and archive the market cap payload of a currency slug.
+
+    Returns its digest and content, or None if it was unchanged since it
+    was last loaded, in which case the job is finished.
+    """
     jsonDump = coinmarketcap.requestMarketCap(slug, numDays)
-    _saveToFile(
-        jsonDump,
-        'marketcap_{0}_{1}d'.format(slug, numDays),
-        'json')
-    result = coinmarketcap.parseMarketCap(
-        jsonDump,
-        pg.selectCurrencyId(slug),
-        includeVolume=includeVolume)
+    digest = _saveToArchive(
+        jsonDump, 'marketcap', slug=slug, lookback=numDays)
+    if _isUnchanged(slug, numDays, digest, 2 if includeVolume else 1):
+        logging.info(">>Payload for {0}, lookback {1} is unchanged.".format(
+            slug, numDays))
+        _finishJob(slug, numDays, 'done')
+        return None
+    return digest, jsonDump
+
+
+def _parsePayload(jsonDump, currencyId, includeVolume):
+    """Parse a market cap payload into lists of market cap and volume rows
+    (None without volume). Runs in the parse processes of a pipeline."""
+    if streamParse:
+        result = coinmarketcap.streamMarketCap(
+            jsonDump,
+            currencyId,
+            includeVolume=includeVolume,
+            compact=compactRows)
+    else:
+        result = coinmarketcap.parseMarketCap(
+            jsonDump,
+            currencyId,
+            includeVolume=includeVolume,
+            compact=compactRows)
     if includeVolume:
         data, volData = result
-        pg.insertMarketCapVolume(volData)
     else:
-        data = result
-    pg.insertMarketCap(data, numDays)
-
-
-logging.info("Attempting to scrape currency list...")
-currencies = scrapeCurrencyList()
-logging.info("Finished scraping currency list. Starting on currencies...")
-for currency in currencies:
-    logging.info(">Starting scrape of currency {0}...".format(
-        currency['slug']))
-    for lookback in lookbacks:
-        includeVolume = True if lookback == 365 else False
-        logging.info(">>Starting scrape of lookback {0}...".format(
-            lookback))
+        data, volData = result, None
+    if streamParse:
+        data = list(data)
+        volData = list(volData) if includeVolume else None
+    return data, volData
+
+
+def _loadPayload(slug, numDays, includeVolume, digest, data, volData,
+                 onLoaded=None):
+    """Load parsed market cap rows and their fingerprint, finishing the job
+    and calling onLoaded, if given, once committed."""
+    if writeBehind:
+        onFlush = _onFlush(slug, numDays, digest, 2 if includeVolume else 1,
+                           onLoaded)
+        pg.bufferMarketCap(data, numDays, onFlush)
+        if includeVolume:
+            pg.bufferMarketCapVolume(volData, onFlush)
+        saveProgress()
+        return
+    with pg.checkout():
+        counts = [pg.insertMarketCap(data, numDays)]
+        if includeVolume:
+            counts.append(pg.insertMarketCapVolume(volData))
+        pg.upsertFingerprint(slug, numDays, digest)
+    with statsLock:
+        for count in counts:
+            _addCounts(count)
+        fingerprints[(slug, numDays)] = digest
+    _finishJob(slug, numDays, 'done')
+    if onLoaded is not None:
+        onLoaded()
+
+
+def scrapeMarketCap(slug, numDays, includeVolume=False, onLoaded=None):
+    """Scrape market cap for the specified currency slug.
+
+    onLoaded, if given, is called once the rows are committed (which with
+    writeBehind may be well after returning, or never if the flush fails),
+    or right away if the payload was unchanged. Returns False if the
+    payload was unchanged since it was last loaded and parsing and loading
+    were skipped, True otherwise.
+    """
+    fetched = _fetchPayload(slug, numDays, includeVolume)
+    if fetched is None:
+        if onLoaded is not None:
+            onLoaded()
+        return False
+    digest, jsonDump = fetched
+    data, volData = _parsePayload(
+        jsonDump, pg.lookupCurrencyId(slug), includeVolume)
+    _loadPayload(slug, numDays, includeVolume, digest, data, volData,
+                 onLoaded)
+    return True
+
+
+def _onFlush(slug, numDays, digest, countTables, onLoaded=None):
+    """Return a write-behind callback that queues the payload's fingerprint,
+    finishes its job and calls onLoaded once all of its tables are
+    committed."""
+    remaining = [countTables]
+
+    def onFlush():
+        with statsLock:
+            remaining[0] -= 1
+            loaded = remaining[0] == 0
+            if loaded:
+                loadedPayloads.append((slug, numDays, digest))
+                fingerprints[(slug, numDays)] = digest
+                if runId is not None:
+                    finishedJobs.append((slug, numDays, 'done'))
+        if loaded and onLoaded is not None:
+            onLoaded()
+    return onFlush
+
+
+def _finishJob(slug, numDays, status):
+    """Queue the status of a finished job of the current run."""
+    with statsLock:
+        if runId is not None:
+            finishedJobs.append((slug, numDays, status))
+
+
+def saveProgress(force=False):
+    """Save the fingerprints of payloads committed by write-behind flushes
+    and, once progressBatch have finished (or if forced), the status of
+    finished jobs."""
+    with statsLock:
+        payloads = loadedPayloads[:]
+        del loadedPayloads[:]
+        statuses = []
+        if force or len(finishedJobs) >= progressBatch:
+            statuses = finishedJobs[:]
+            del finishedJobs[:]
+    if len(payloads) > 0:
+        pg.upsertFingerprints(payloads)
+    if len(statuses) > 0:
+        countUpdated = pg.updateJobs(runId, statuses, worker=workerId)
+        if countUpdated < len(statuses):
+            logging.info(
+                "Lost the claim on {0} jobs of run {1} to other "
+                "workers.".format(len(statuses) - countUpdated, runId))
+
+
+def _failJob(slug, lookback):
+    """Report the exception being handled as the failure of a job."""
+    # Print as a single write so concurrent tracebacks don't interleave
+    sys.stdout.write("\n".join([
+        '-'*60,
+        "Could not scrape currency {0}, lookback {1}.".format(
+            slug, lookback),
+        traceback.format_exc(),
+        '-'*60,
+        '']))
+    logging.info(
+        ">>Could not scrape currency {0}, lookback {1}. Skipping.".format(
+            slug, lookback))
+    _finishJob(slug, lookback, 'failed')
+
+
+def _scrapeJob(job, onLoaded=None):
+    """Scrape a single (slug, lookback, includeVolume) job, isolating any
+    failure."""
+    slug, lookback, includeVolume = job
+    logging.info(">>Starting scrape of currency {0}, lookback {1}...".format(
+        slug, lookback))
+    try:
+        scrapeMarketCap(slug, lookback, includeVolume=includeVolume,
+                        onLoaded=onLoaded)
+    except Exception:
+        _failJob(slug, lookback)
+        return False
+    logging.info(">>Done with scrape of currency {0}, lookback {1}.".format(
+        slug, lookback))
+    return True
+
+
+def _scrapeScheduledJob(schedule, job):
+    """Scrape a job, recording it with the scheduler once its rows are
+    committed. A job whose rows are never committed stays due."""
+    return _scrapeJob(job, onLoaded=functools.partial(schedule.done, job))
+
+
+def _recordJobs(jobs):
+    """Record jobs with the current run as pending, in batches, before
+    yielding them, skipping jobs the run recorded before. The run is marked
+    enumerated once all of them are recorded."""
+    batch = []
+    for job in jobs:
+        batch.append(job)
+        if len(batch) >= progressBatch:
+            recorded = set(pg.insertJobs(runId, batch))
+            for batched in batch:
+                if batched[:2] in recorded:
+                    yield batched
+            batch = []
+    recorded = set(pg.insertJobs(runId, batch))
+    pg.markRunEnumerated(runId)
+    for batched in batch:
+        if batched[:2] in recorded:
+            yield batched
+
+
+def _iterJobs(currencies, plan=None):
+    """Yield a (slug, lookback, includeVolume) job per lookback of each
+    currency, or per lookback the plan (a planner.FetchPlan) keeps."""
+    for currency in currencies:
+        if plan is not None:
+            for job in plan.jobs(currency['slug']):
+                yield job
+        else:
+            for lookback in lookbacks:
+                yield currency['slug'], lookback, lookback == 365
+
+
+def _ignoreInterrupt():
+    """Leave interrupts to the parent of a parse process."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _getParsePool():
+    """Return the parse process pool, starting it if needed."""
+    global parsePool
+    if parsePool is None:
+        parsePool = multiprocessing.Pool(parseProcesses, _ignoreInterrupt)
+    return parsePool
+
+
+def closeParsePool():
+    """Stop the parse processes, if started."""
+    global parsePool
+    if parsePool is not None:
+        parsePool.close()
+        parsePool.join()
+        parsePool = None
+
+
+def _scrapePipelined(jobs, concurrency, schedule=None):
+    """Scrape jobs through a fetch, parse and load pipeline.
+
+    concurrency threads fetch payloads, parseProcesses threads hand them to
+    as many parse processes and loadThreads threads load the rows, each
+    stage fed by a bounded queue (see pipeline.py). Returns the number of
+    jobs that failed.
+    """
+    failed = []
+    pool = _getParsePool()
+
+    def succeed(job):
+        logging.info(">>Done with scrape of currency {0}, lookback "
+                     "{1}.".format(*job))
+
+    def loaded(job):
+        # Only once committed, so that jobs whose rows are lost stay due
+        if schedule is not None:
+            schedule.done(job)
+
+    def fetch(job):
+        logging.info(">>Starting scrape of currency {0}, lookback "
+                     "{1}...".format(*job))
+        try:
+            fetched = _fetchPayload(*job)
+        except Exception:
+            _failJob(*job[:2])
+            failed.append(job)
+            return None
+        if fetched is None:
+            succeed(job)
+            loaded(job)
+            return None
+        return job, fetched
+
+    def parse(item):
+        job, (digest, jsonDump) = item
+        try:
+            data, volData = pool.apply(_parsePayload, (
+                jsonDump, pg.lookupCurrencyId(job[0]), job[2]))
+        except Exception:
+            _failJob(*job[:2])
+            failed.append(job)
+            return None
+        return job, digest, data, volData
+
+    def load(item):
+        job, digest, data, volData = item
         try:
-            scrapeMarketCap(
-                currency['slug'], lookback, includeVolume=includeVolume)
-        except Exception as e:
-            print '-'*60
-            print "Could not scrape currency {0}, lookback {1}.".format(
-                currency['slug'], lookback)
-            print traceback.format_exc()
-            print '-'*60
+            _loadPayload(*(job + (digest, data, volData,
+                                  functools.partial(loaded, job))))
+        except Exception:
+            _failJob(*job[:2])
+            failed.append(job)
+            return None
+        succeed(job)
+
+    jobPipeline = pipeline.Pipeline([
+        pipeline.Stage('fetch', fetch, threads=concurrency),
+        pipeline.Stage('parse', parse, threads=parseProcesses),
+        pipeline.Stage('load', load, threads=loadThreads)])
+    jobPipeline.run(jobs)
+    if jobPipeline.stages[0].stats['items'] > 0:
+        for line in jobPipeline.summary():
+            logging.info(line)
+    return len(failed)
+
+
+def scrapeJobs(jobs, concurrency=1, schedule=None):
+    """Scrape (slug, lookback, includeVolume) jobs using a bounded worker
+    pool, or a pipeline of pools if pipelined, recording finished ones with
+    the schedule if given.
+
+    Returns the number of jobs that failed.
+    """
+    if pipelined and concurrency > 1:
+        return _scrapePipelined(jobs, concurrency, schedule)
+    scrapeJob = _scrapeJob
+    if schedule is not None:
+        scrapeJob = functools.partial(_scrapeScheduledJob, schedule)
+    if concurrency <= 1:
+        results = map(scrapeJob, list(jobs))
+    else:
+        pool = ThreadPool(concurrency)
+        try:
+            results = list(pool.imap_unordered(scrapeJob, jobs))
+        finally:
+            pool.close()
+            pool.join()
+    return results.count(False)
+
+
+def scrapeMarketCaps(currencies, concurrency=1, plan=None, schedule=None):
+    """Scrape every lookback of every currency using a bounded worker pool.
+
+    currencies may be a generator, such as streamCurrencyList(), in which
+    case workers start on the first currencies while the rest are parsed.
+    If a plan is given, only the lookbacks it keeps are scraped. If a
+    schedule (a scheduler.Scheduler) is given, all jobs are gathered first
+    and only the due ones are scraped, in priority order and within budget.
+    Jobs are recorded with the current run, if any, before they start.
+    Returns the number of (currency, lookback) jobs that failed.
+    """
+    jobs = _iterJobs(currencies, plan)
+    if schedule is not None:
+        jobs = schedule.order(list(jobs))
+    if runId is not None:
+        jobs = _recordJobs(jobs)
+    return scrapeJobs(jobs, concurrency=concurrency, schedule=schedule)
+
+
+def _resumeRun():
+    """Resume the unfinished run, if any. Returns its resumed jobs as
+    (slug, lookback, includeVolume, previous status) tuples, and whether
+    all of its jobs had been recorded (True if there is none). A run that
+    stopped while its jobs were being recorded is resumed even without
+    jobs to retry, so that the rest of them get recorded and scraped."""
+    global runId
+    unfinished = pg.selectUnfinishedRun()
+    if unfinished is None:
+        return [], True
+    resumed = pg.resumeJobs(unfinished, maxAttempts)
+    enumerated = pg.selectRunEnumerated(unfinished)
+    if len(resumed) > 0 or not enumerated:
+        runId = unfinished
+    return resumed, enumerated
+
+
+def main():
+    """Scrape the currency list and then market caps for every currency."""
+    coinmarketcap.poolMaxSize = max(coinmarketcap.poolMaxSize, concurrency)
+    pg.poolMaxSize = max(pg.poolMaxSize, concurrency)
+    coinmarketcap.validatorCacheFile = "{0}/validators".format(dataDir)
+    bufferedBefore = dict(pg.writeBehind.counts)
+    global runId
+    runId = None
+    resumed, enumerated = _resumeRun()
+    plan = None
+    if planFetches and (runId is None or not enumerated):
+        plan = planner.FetchPlan(lookbacks, skipFresh=not scheduleFetches)
+    schedule = scheduler.Scheduler() if scheduleFetches else None
+    try:
+        if runId is not None:
             logging.info(
-                ">>Could not scrape lookback {0}. Skipping.".format(
-                    lookback))
-            continue
-        logging.info(">>Done with scrape of lookback {0}.".format(
-            lookback))
-    logging.info(">Done with scrape of currency {0}.".format(
-        currency['slug']))
-logging.info("Finished scraping currencies. All done.")
-logging.info("Made {0} requests in total.".format(
-    coinmarketcap.countRequested))
+                "Resuming run {0}: {1} unfinished and {2} failed jobs with "
+                "concurrency {3}...".format(
+                    runId,
+                    len([job for job in resumed if job[3] == 'pending']),
+                    len([job for job in resumed if job[3] == 'failed']),
+                    concurrency))
+            countFailed = scrapeJobs(
+                [job[:3] for job in resumed], concurrency=concurrency,
+                schedule=schedule)
+            if not enumerated:
+                logging.info("Recording and scraping the rest of the jobs "
+                             "of run {0}...".format(runId))
+                countFailed += scrapeMarketCaps(
+                    streamCurrencyList(), concurrency=concurrency, plan=plan,
+                    schedule=schedule)
+        else:
+            runId = pg.createRun()
+            logging.info(
+                "Attempting to scrape currency list and currencies with "
+                "concurrency {0} (run {1})...".format(concurrency, runId))
+            countFailed = scrapeMarketCaps(
+                streamCurrencyList(), concurrency=concurrency, plan=plan,
+                schedule=schedule)
+    finally:
+        try:
+            pg.writeBehind.close()
+            saveProgress(force=True)
+            if schedule is not None:
+                schedule.save()
+        finally:
+            fetchStats = coinmarketcap.fetchStats()
+            coinmarketcap.closeSession()
+            if rawArchive is not None:
+                rawArchive.close()
+            closeParsePool()
+    pg.finishRun(runId)
+    _addCounts(dict((key, count - bufferedBefore[key])
+                    for key, count in pg.writeBehind.counts.iteritems()))
+    logging.info("Finished scraping currencies. All done.")
+    logging.info("Made {0} requests in total ({1} jobs failed).".format(
+        coinmarketcap.countRequested, countFailed))
+    if len(resumed) > 0:
+        logging.info("Resumed {0} jobs of run {1}.".format(
+            len(resumed), runId))
+    if plan is not None:
+        for line in plan.summary():
+            logging.info(line)
+    if schedule is not None:
+        logging.info(schedule.summary())
+    logging.info(
+        "{unchanged} payloads were unchanged, avoiding {writesAvoided} "
+        "table loads. Loads inserted {inserted} rows, updated {updated} and "
+        "left {untouched} untouched.".format(**runStats))
+    for method, stats in pg.loadStats.iteritems():
+        logging.info("Staged {0} rows via {1} at {2:.0f} rows/s.".format(
+            stats['rows'], method, stats['rows']/max(stats['seconds'], 1e-6)))
+    logging.info(
+        "Opened {connectionsOpened} connections and reused "
+        "{connectionsReused}. {notModified} responses were not modified. "
+        "Saved {bytesSaved} bytes. {throttled} responses were throttled "
+        "and {retried} requests retried.".format(**fetchStats))
+
+
+class ScrapeTest(unittest.TestCase):
+
+    """Testing suite for scrape module."""
+
+    testTables = ['currency', 'currency_historical', 'market_cap_7',
+                  'market_cap_hourly', 'market_cap_daily',
+                  'payload_fingerprint', 'scrape_run', 'scrape_job']
+
+    def setUp(self):
+        """Setup tables and local currency list and market cap sources."""
+        self.tablesOriginal = pg.tables
+        pg.tables = dict(pg.tables)
+        cur = pg.cursor()
+        for key in self.testTables:
+            pg.tables[key] = "{0}_test".format(self.tablesOriginal[key])
+            cur.execute("""CREATE TABLE {0}
+                (LIKE {1} INCLUDING ALL)""".format(
+                pg.tables[key], self.tablesOriginal[key]))
+        cur.execute("""COMMIT""")
+        pg.currencyCache.invalidate()
+        folder = os.path.dirname(os.path.abspath(__file__))
+        f = open("{0}/example/currencylist.html".format(folder), 'r')
+        html = f.read()
+        f.close()
+        f = open("{0}/example/marketcap_navajo_7d.json".format(folder), 'r')
+        jsonDump = f.read()
+        f.close()
+        self.requestCurrencyListOriginal = coinmarketcap.requestCurrencyList
+        self.requestMarketCapOriginal = coinmarketcap.requestMarketCap
+        coinmarketcap.requestCurrencyList = lambda key: html
+        coinmarketcap.requestMarketCap = lambda slug, numDays: jsonDump
+        self.dataDirOriginal = dataDir
+        self.configOriginal = (pipeline.queueSize, currencyListBatch)
+        self._setGlobals(tempfile.mkdtemp(), 2, 10)
+
+    def tearDown(self):
+        """Teardown test tables and restore the sources."""
+        global rawArchive
+        cur = pg.cursor()
+        for key in self.testTables:
+            cur.execute("""DROP TABLE IF EXISTS {0}""".format(pg.tables[key]))
+        cur.execute("""COMMIT""")
+        pg.tables = self.tablesOriginal
+        pg.currencyCache.invalidate()
+        coinmarketcap.requestCurrencyList = self.requestCurrencyListOriginal
+        coinmarketcap.requestMarketCap = self.requestMarketCapOriginal
+        if rawArchive is not None:
+            rawArchive.close()
+            rawArchive = None
+        shutil.rmtree(dataDir)
+        self._setGlobals(self.dataDirOriginal, *self.configOriginal)
+        closeParsePool()
+
+    def _setGlobals(self, folder, size, batch):
+        """Set the data folder, queue size and currency list batch."""
+        global dataDir
+        global currencyListBatch
+        global fingerprints
+        dataDir = folder
+        pipeline.queueSize = size
+        currencyListBatch = batch
+        fingerprints = None
+
+    def testScrapePipelinedStreamed(self):
+        """Test that a pipeline fed by a streamed currency list outgrowing
+        its queues loads every job."""
+        jobs = ((currency['slug'], 7, False) for currency in
+                itertools.islice(streamCurrencyList(), 30))
+        failed = []
+        thread = threading.Thread(target=lambda: failed.append(
+            _scrapePipelined(jobs, 3)))
+        thread.daemon = True
+        thread.start()
+        thread.join(60)
+        self.assertEqual(thread.is_alive(), False)
+        pg.writeBehind.flush()
+        saveProgress(force=True)
+        self.assertEqual(failed, [0])
+        cur = pg.cursor()
+        cur.execute("""SELECT COUNT(DISTINCT currency) FROM {0}""".format(
+            pg.tables['market_cap_7']))
+        self.assertEqual(cur.fetchone()[0], 30)
+        cur.execute("""SELECT COUNT(*) FROM {0}""".format(
+            pg.tables['payload_fingerprint']))
+        self.assertEqual(cur.fetchone()[0], 30)
+        cur.execute("""COMMIT""")
+
+    def testScheduleOnceCommitted(self):
+        """Test that jobs are recorded with the schedule only once their
+        rows are committed, and not at all if the flush fails."""
+        jobs = [(currency['slug'], 7, False) for currency in
+                itertools.islice(streamCurrencyList(), 2)]
+        schedule = scheduler.Scheduler(schedule={}, metrics={})
+        for concurrency, job in zip([1, 3], jobs):
+            self.assertEqual(scrapeJobs([job], concurrency=concurrency,
+                                        schedule=schedule), 0)
+        self.assertEqual(schedule.counts['done'], 0)
+
+        def mergeRows(*args):
+            raise ValueError("Merge failed.")
+
+        mergeRowsOriginal = pg._mergeRows
+        pg._mergeRows = mergeRows
+        try:
+            self.assertRaises(ValueError, pg.writeBehind.flush)
+        finally:
+            pg._mergeRows = mergeRowsOriginal
+        self.assertEqual(schedule.counts['done'], 0)
+
+        # Fetched and loaded again, as they were never fingerprinted
+        for concurrency, job in zip([1, 3], jobs):
+            scrapeJobs([job], concurrency=concurrency, schedule=schedule)
+        pg.writeBehind.flush()
+        self.assertEqual(schedule.counts['done'], 2)
+        self.assertEqual(sorted(done[:2] for done in schedule._done),
+                         sorted(job[:2] for job in jobs))
+
+    def testResumeUnenumeratedRun(self):
+        """Test that a run stopped while recording its jobs goes on to
+        record and scrape the rest of them when resumed."""
+        global runId
+        global progressBatch
+        jobs = [(currency['slug'], 7, False) for currency in
+                itertools.islice(streamCurrencyList(), 12)]
+        progressBatchOriginal = progressBatch
+        progressBatch = 5
+        try:
+            # Stopped after scraping the jobs of the first batch
+            runId = pg.createRun()
+            self.assertEqual(scrapeJobs(itertools.islice(
+                _recordJobs(iter(jobs)), 5)), 0)
+            pg.writeBehind.flush()
+            saveProgress(force=True)
+            runId = None
+            self.assertEqual(_resumeRun(), ([], False))
+            self.assertEqual(runId is not None, True)
+            self.assertEqual(list(_recordJobs(iter(jobs))), jobs[5:])
+            self.assertEqual(pg.selectRunEnumerated(runId), True)
+
+            # A run with every job recorded and done isn't resumed
+            pg.updateJobs(runId, [job[:2] + ('done',) for job in jobs])
+            runId = None
+            self.assertEqual(_resumeRun(), ([], True))
+            self.assertEqual(runId, None)
+        finally:
+            progressBatch = progressBatchOriginal
+            runId = None
+
+if __name__ == "__main__":
+    main()
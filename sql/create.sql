@@ -102,4 +102,92 @@ CREATE TABLE IF NOT EXISTS trade_volume_usd (
     PRIMARY KEY(currency, time)
 );
 
-CREATE UNIQUE INDEX ON trade_volume_usd (time, currency);
\ No newline at end of file
+CREATE UNIQUE INDEX ON trade_volume_usd (time, currency);
+
+CREATE TABLE IF NOT EXISTS payload_fingerprint (
+    slug VARCHAR(30),
+    lookback INTEGER,
+    digest CHAR(40),
+    db_update_time TIMESTAMP WITH TIME ZONE DEFAULT current_timestamp,
+    PRIMARY KEY(slug, lookback)
+);
+
+CREATE TABLE IF NOT EXISTS market_cap_hourly (
+    currency INTEGER,
+    lookback INTEGER,
+    bucket TIMESTAMP,
+    open DECIMAL,
+    high DECIMAL,
+    low DECIMAL,
+    close DECIMAL,
+    num_points INTEGER,
+    db_update_time TIMESTAMP WITH TIME ZONE DEFAULT current_timestamp,
+    PRIMARY KEY(currency, lookback, bucket)
+);
+
+CREATE TABLE IF NOT EXISTS market_cap_daily (
+    currency INTEGER,
+    lookback INTEGER,
+    bucket TIMESTAMP,
+    open DECIMAL,
+    high DECIMAL,
+    low DECIMAL,
+    close DECIMAL,
+    num_points INTEGER,
+    db_update_time TIMESTAMP WITH TIME ZONE DEFAULT current_timestamp,
+    PRIMARY KEY(currency, lookback, bucket)
+);
+
+CREATE TABLE IF NOT EXISTS trade_volume_usd_hourly (
+    currency INTEGER,
+    bucket TIMESTAMP,
+    volume DECIMAL,
+    num_points INTEGER,
+    db_update_time TIMESTAMP WITH TIME ZONE DEFAULT current_timestamp,
+    PRIMARY KEY(currency, bucket)
+);
+
+CREATE TABLE IF NOT EXISTS trade_volume_usd_daily (
+    currency INTEGER,
+    bucket TIMESTAMP,
+    volume DECIMAL,
+    num_points INTEGER,
+    db_update_time TIMESTAMP WITH TIME ZONE DEFAULT current_timestamp,
+    PRIMARY KEY(currency, bucket)
+);
+
+CREATE TABLE IF NOT EXISTS refresh_schedule (
+    slug VARCHAR(30),
+    lookback INTEGER,
+    last_fetch_time TIMESTAMP,
+    next_due_time TIMESTAMP,
+    interval_seconds DOUBLE PRECISION,
+    PRIMARY KEY(slug, lookback)
+);
+
+CREATE TABLE IF NOT EXISTS scrape_run (
+    id SERIAL,
+    status VARCHAR(10) DEFAULT 'running',
+    enumerated BOOLEAN DEFAULT FALSE,
+    start_time TIMESTAMP WITH TIME ZONE DEFAULT current_timestamp,
+    finish_time TIMESTAMP WITH TIME ZONE,
+    PRIMARY KEY(id)
+);
+
+CREATE TABLE IF NOT EXISTS scrape_job (
+    run_id INTEGER,
+    slug VARCHAR(30),
+    lookback INTEGER,
+    include_volume BOOLEAN,
+    seq INTEGER,
+    status VARCHAR(10) DEFAULT 'pending',
+    attempt INTEGER DEFAULT 1,
+    worker VARCHAR(64),
+    lease_until TIMESTAMP WITH TIME ZONE,
+    heartbeat_time TIMESTAMP WITH TIME ZONE,
+    db_update_time TIMESTAMP WITH TIME ZONE DEFAULT current_timestamp,
+    PRIMARY KEY(run_id, slug, lookback)
+);
+
+CREATE INDEX IF NOT EXISTS scrape_job_status_idx
+    ON scrape_job (status, run_id);
@@ -0,0 +1,16 @@
+CREATE TABLE IF NOT EXISTS market_cap (
+    currency INTEGER,
+    lookback INTEGER,
+    time TIMESTAMP,
+    market_cap_by_available_supply DECIMAL,
+    market_cap_by_total_supply DECIMAL,
+    price_usd DECIMAL,
+    price_btc DECIMAL,
+    est_available_supply DECIMAL,
+    est_total_supply DECIMAL,
+    db_update_time TIMESTAMP WITH TIME ZONE DEFAULT current_timestamp,
+    PRIMARY KEY(currency, lookback, time)
+) PARTITION BY RANGE (time);
+
+CREATE INDEX IF NOT EXISTS market_cap_time_brin
+    ON market_cap USING BRIN (time);
@@ -0,0 +1,274 @@
+"""Worker of a scrape distributed over machines through a Postgres queue."""
+import coinmarketcap
+import itertools
+import logging
+import multiprocessing
+import os
+import pg
+import planner
+import re
+import scheduler
+import scrape
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+
+# Configuration
+claimCount = 20
+leaseSeconds = 300
+heartbeatSeconds = 60
+idleSeconds = 30
+exitWhenIdle = False
+
+
+def enqueue():
+    """Scrape the currency list and queue a new run of the jobs planned for
+    it, leaving runs still being worked on alone. Returns the run ID."""
+    plan = None
+    if scrape.planFetches:
+        plan = planner.FetchPlan(scrape.lookbacks,
+                                 skipFresh=not scrape.scheduleFetches)
+    jobs = list(scrape._iterJobs(scrape.scrapeCurrencyList(), plan))
+    if scrape.scheduleFetches:
+        jobs = scheduler.Scheduler().order(jobs)
+    runId = pg.createRun(abandon=False)
+    # All at once, so that no worker finds the run drained half way
+    pg.insertJobs(runId, jobs)
+    pg.markRunEnumerated(runId)
+    logging.info("Queued {0} jobs as run {1}.".format(len(jobs), runId))
+    if plan is not None:
+        for line in plan.summary():
+            logging.info(line)
+    return runId
+
+
+class Worker(object):
+
+    """Worker claiming jobs of running runs from the scrape_job table.
+
+    Jobs are claimed claimCount at a time with a lease of leaseSeconds (see
+    pg.claimJobs) and scraped by scrape.scrapeJobs. A thread extends the
+    leases every heartbeatSeconds, so that the jobs of a worker that died
+    are claimed again by others once their lease runs out. Statuses are
+    only recorded for jobs the worker still holds a claim on. Runs are
+    marked finished by the first worker that finds them drained.
+    """
+
+    def __init__(self, name=None):
+        """Create a worker, named after its host and process by default."""
+        self.name = name or "{0}:{1}".format(socket.gethostname(), os.getpid())
+        self.stopping = threading.Event()
+        self.finished = threading.Event()
+        self.schedule = None
+        self.counts = {'batches': 0, 'claimed': 0, 'failed': 0}
+
+    def heartbeat(self):
+        """Extend the leases of claimed jobs until the worker finishes."""
+        while not self.finished.wait(heartbeatSeconds):
+            try:
+                pg.heartbeatJobs(self.name, leaseSeconds)
+            except Exception:
+                logging.exception("Could not extend leases.")
+
+    def runBatch(self):
+        """Claim and scrape a batch of jobs. Returns False if there were
+        none to claim."""
+        jobs = pg.claimJobs(self.name, claimCount, leaseSeconds,
+                            scrape.maxAttempts)
+        if len(jobs) == 0:
+            for runId in pg.finishDrainedRuns(scrape.maxAttempts):
+                logging.info("Run {0} is finished.".format(runId))
+            return False
+        self.counts['batches'] += 1
+        self.counts['claimed'] += len(jobs)
+        for runId, group in itertools.groupby(jobs, key=lambda job: job[0]):
+            scrape.runId = runId
+            try:
+                self.counts['failed'] += scrape.scrapeJobs(
+                    [job[1:] for job in group],
+                    concurrency=scrape.concurrency, schedule=self.schedule)
+            finally:
+                # Jobs loaded behind are only done once committed
+                pg.writeBehind.flush()
+                scrape.saveProgress(force=True)
+        if self.schedule is not None:
+            self.schedule.save()
+        return True
+
+    def run(self):
+        """Run batches until stopped, or until idle if exitWhenIdle."""
+        scrape.workerId = self.name
+        if scrape.scheduleFetches:
+            self.schedule = scheduler.Scheduler()
+        heartbeat = threading.Thread(target=self.heartbeat)
+        heartbeat.daemon = True
+        heartbeat.start()
+        try:
+            while not self.stopping.is_set():
+                if not self.runBatch():
+                    if exitWhenIdle:
+                        break
+                    self.stopping.wait(idleSeconds)
+        finally:
+            self.finished.set()
+            heartbeat.join()
+
+    def stop(self, *args):
+        """Stop after the current batch."""
+        logging.info("Stopping...")
+        self.stopping.set()
+
+
+def main():
+    """Queue a run ("python worker.py enqueue") or work on queued runs
+    until SIGTERM or SIGINT ("python worker.py [name]")."""
+    coinmarketcap.poolMaxSize = max(coinmarketcap.poolMaxSize,
+                                    scrape.concurrency)
+    pg.poolMaxSize = max(pg.poolMaxSize, scrape.concurrency + 1)
+    worker = None
+    try:
+        if len(sys.argv) > 1 and sys.argv[1] == 'enqueue':
+            enqueue()
+        else:
+            worker = Worker(sys.argv[1] if len(sys.argv) > 1 else None)
+            # shelve files can't be shared between processes
+            coinmarketcap.validatorCacheFile = "{0}/validators_{1}".format(
+                scrape.dataDir, re.sub(r'[^\w.-]', '_', worker.name))
+            signal.signal(signal.SIGTERM, worker.stop)
+            signal.signal(signal.SIGINT, worker.stop)
+            logging.info("Worker {0} started.".format(worker.name))
+            worker.run()
+    finally:
+        pg.writeBehind.close()
+        coinmarketcap.closeSession()
+        if scrape.rawArchive is not None:
+            scrape.rawArchive.close()
+        scrape.closeParsePool()
+    if worker is not None:
+        logging.info(
+            "Worker {0} scraped {claimed} jobs in {batches} batches ({failed} "
+            "failed).".format(worker.name, **worker.counts))
+
+
+class WorkerTest(unittest.TestCase):
+
+    """Testing suite for worker module."""
+
+    testTables = ['currency', 'market_cap_7', 'market_cap_30',
+                  'market_cap_hourly', 'market_cap_daily',
+                  'payload_fingerprint', 'scrape_run', 'scrape_job']
+
+    def setUp(self):
+        """Setup tables, currencies and a local market cap source."""
+        self.tablesOriginal = pg.tables
+        pg.tables = dict(pg.tables)
+        cur = pg.cursor()
+        for key in self.testTables:
+            pg.tables[key] = "{0}_test".format(self.tablesOriginal[key])
+            cur.execute("""CREATE TABLE {0}
+                (LIKE {1} INCLUDING ALL)""".format(
+                pg.tables[key], self.tablesOriginal[key]))
+        cur.execute("""COMMIT""")
+        pg.currencyCache.invalidate()
+        folder = os.path.dirname(os.path.abspath(__file__))
+        f = open("{0}/example/currencylist.html".format(folder), 'r')
+        currencies = coinmarketcap.parseCurrencyListAll(f.read())[:4]
+        f.close()
+        pg.insertCurrencyList(currencies)
+        self.slugs = [currency['slug'] for currency in currencies]
+        f = open("{0}/example/marketcap_navajo_7d.json".format(folder), 'r')
+        jsonDump = f.read()
+        f.close()
+
+        # Fetches are reported from the workers to the test
+        self.fetches = multiprocessing.Queue()
+
+        def requestMarketCap(slug, numDays):
+            self.fetches.put((slug, numDays))
+            return jsonDump
+
+        self.requestMarketCapOriginal = coinmarketcap.requestMarketCap
+        coinmarketcap.requestMarketCap = requestMarketCap
+        self.dataDirOriginal = scrape.dataDir
+        scrape.dataDir = tempfile.mkdtemp()
+        self.scheduleFetchesOriginal = scrape.scheduleFetches
+        scrape.scheduleFetches = False
+        scrape.fingerprints = None
+
+    def tearDown(self):
+        """Teardown test tables and restore the market cap source."""
+        cur = pg.cursor()
+        for key in self.testTables:
+            cur.execute("""DROP TABLE IF EXISTS {0}""".format(pg.tables[key]))
+        cur.execute("""COMMIT""")
+        pg.tables = self.tablesOriginal
+        pg.currencyCache.invalidate()
+        coinmarketcap.requestMarketCap = self.requestMarketCapOriginal
+        shutil.rmtree(scrape.dataDir)
+        scrape.dataDir = self.dataDirOriginal
+        scrape.scheduleFetches = self.scheduleFetchesOriginal
+        scrape.fingerprints = None
+        scrape.runId = None
+        scrape.workerId = None
+
+    def testWorkers(self):
+        """Test that worker processes share the jobs of a run, including
+        those of a dead worker."""
+        global claimCount
+        global exitWhenIdle
+        claimCountOriginal = claimCount
+        claimCount = 2
+        exitWhenIdle = True
+        try:
+            runId = pg.createRun(abandon=False)
+            jobs = [(slug, lookback, False)
+                    for slug in self.slugs for lookback in [30, 7]]
+            pg.insertJobs(runId, jobs)
+
+            # A worker that claimed jobs and died without heartbeating
+            dead = pg.claimJobs('dead', 3, 0, scrape.maxAttempts)
+            self.assertEqual(len(dead), 3)
+
+            def work(name):
+                Worker(name).run()
+
+            processes = [multiprocessing.Process(target=work, args=(name,))
+                         for name in ['a', 'b', 'c']]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+            self.assertEqual([process.exitcode for process in processes],
+                             [0, 0, 0])
+            fetches = [self.fetches.get(timeout=1) for job in jobs]
+            self.assertEqual(sorted(fetches),
+                             sorted(job[:2] for job in jobs))
+
+            cur = pg.cursor()
+            cur.execute("""SELECT slug, lookback, status, worker, attempt
+                FROM {0} ORDER BY slug, lookback""".format(
+                pg.tables['scrape_job']))
+            rows = cur.fetchall()
+            self.assertEqual(set(row[2] for row in rows), set(['done']))
+            self.assertEqual(set(row[3] for row in rows) <=
+                             set(['a', 'b', 'c']), True)
+            self.assertEqual(
+                sorted(row[4] for row in rows if row[:2] in
+                       [job[1:3] for job in dead]), [2, 2, 2])
+            cur.execute("""SELECT status FROM {0}""".format(
+                pg.tables['scrape_run']))
+            self.assertEqual(cur.fetchall(), [('finished',)])
+            cur.execute("""SELECT COUNT(*) FROM {0}""".format(
+                pg.tables['payload_fingerprint']))
+            self.assertEqual(cur.fetchone()[0], len(jobs))
+            cur.execute("""COMMIT""")
+        finally:
+            claimCount = claimCountOriginal
+            exitWhenIdle = False
+
+if __name__ == "__main__":
+    unittest.main()